@@ -0,0 +1,256 @@
+"""
+Benchmark of the notebook pipeline on a seeded synthetic corpus, with the stub LLM in place of Ollama.
+- `--mode nb` runs processNB in this process on every notebook
+- `--mode pipeline` runs main.py's processNBFolder on one env (venv copy, process_repo.py, ...)
+Reports notebooks/sec, p50/p95 per-notebook latency, peak memory (of the harness process and of the
+largest kernel) and the status counts, and saves them as JSON; `--compare` prints the change against
+a previous result file.
+
+    python benchmarks/run_benchmark.py --mode nb --repos 5 --nbs_per_repo 4 --seed 0 --output bench.json
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+UTILS_DIR = os.path.join(REPO_ROOT, 'project_main', 'RenoteUtils')
+MAIN_CODE_DIR = os.path.join(REPO_ROOT, 'project_main', 'main_code')
+sys.path.append(BENCH_DIR)
+sys.path.append(UTILS_DIR)
+
+from synthetic_corpus import generateCorpus, parseMix
+from stub_llm import stubChat
+
+
+def percentile(values, q):
+    """Nearest-rank percentile, None for an empty list"""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(int(round(q / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def kernelPeakRSS(result):
+    """Peak kernel RSS of a processNB result, from its execution profile"""
+    profile = (result or {}).get('execution_profile') or {}
+    return profile.get('peak_rss_mb')
+
+
+def gitCommit():
+    r = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True)
+    return r.stdout.strip() if r.returncode == 0 else None
+
+
+def runNBMode(corpus, work_dir, archive_path=None, archive_mode=None, notebook_budget=None, lean_execution=False):
+    """Run processNB on every notebook of the corpus, in this process"""
+    import ExecuteNoteBook
+    from interaction_archive import enableArchive
+    from localLLM import setChatBackend
+    from process_nb import processNB
+    from results_store import ShardedResultsStore
+    from run_config import RunConfig
+
+    ExecuteNoteBook.CELL_TIMEOUT = corpus['cell_timeout']
+    setChatBackend(stubChat)
+    enableArchive(archive_path, archive_mode)
+    run_config = RunConfig(lean_execution=lean_execution)
+    results_store = ShardedResultsStore(os.path.join(work_dir, 'results_cache'), shard_id='bench')
+    err_store = ShardedResultsStore(os.path.join(work_dir, 'err_cache'), shard_id='bench')
+
+    per_notebook = []
+    try:
+        for nb_path, kind in corpus['notebooks'].items():
+            repo_path = os.path.dirname(nb_path)
+            start = time.time()
+            try:
+                result = processNB(nb_path, None, None, 0, repo_path=repo_path,
+                                   results_store=results_store, err_store=err_store, notebook_budget=notebook_budget,
+                                   run_config=run_config)
+                status = result['Final_Status']
+            except Exception as e:
+                result = None
+                status = f'Exception={type(e).__name__}'
+            per_notebook.append({'nb_path': nb_path, 'kind': kind, 'status': status, 'latency': time.time() - start,
+                                 'kernel_peak_rss_mb': kernelPeakRSS(result)})
+    finally:
+        results_store.close()
+        err_store.close()
+        setChatBackend(None)
+    return per_notebook
+
+
+def runPipelineMode(corpus, work_dir, archive_path=None, archive_mode=None, notebook_budget=None, lean_execution=False):
+    """Run main.py's pipeline on one env on the corpus, in a venv inheriting the packages of this interpreter"""
+    backup_envs_path = os.path.join(work_dir, 'envs', 'backup')
+    source_envs_path = os.path.join(work_dir, 'envs', 'source')
+    os.makedirs(source_envs_path, exist_ok=True)
+    venv_path = os.path.join(backup_envs_path, 'nb1_venv')
+    subprocess.run([sys.executable, '-m', 'venv', '--system-site-packages', venv_path], check=True)
+    # nbconvert looks for its templates under the prefix of the venv
+    jupyter_data = os.path.join(sys.prefix, 'share', 'jupyter')
+    if os.path.isdir(jupyter_data):
+        os.makedirs(os.path.join(venv_path, 'share'), exist_ok=True)
+        os.symlink(jupyter_data, os.path.join(venv_path, 'share', 'jupyter'))
+
+    json_paths = os.path.join(work_dir, 'json_paths')
+    results_cache_path = os.path.join(work_dir, 'results_cache')
+    err_cache_path = os.path.join(work_dir, 'err_cache')
+    metrics_dir = os.path.join(work_dir, 'metrics')
+    for path in (json_paths, results_cache_path, err_cache_path):
+        os.makedirs(path, exist_ok=True)
+
+    # main.py and process_repo.py expect to be run from main_code
+    cwd = os.getcwd()
+    os.chdir(MAIN_CODE_DIR)
+    sys.path.insert(0, MAIN_CODE_DIR)
+    try:
+        from main import processNBFolder
+        processNBFolder(all_repo_dir_path=corpus['csv_dir'],
+                        json_paths=json_paths,
+                        results_cache_path=results_cache_path,
+                        err_cache_path=err_cache_path,
+                        resume=0,
+                        metrics_dir=metrics_dir,
+                        llm_backend=f"{os.path.join(BENCH_DIR, 'stub_llm.py')}:stubChat",
+                        archive_path=archive_path,
+                        archive_mode=archive_mode,
+                        notebook_budget=notebook_budget,
+                        lean_execution=lean_execution,
+                        n_envs=1,
+                        backup_envs_path=backup_envs_path,
+                        source_envs_path=source_envs_path)
+    finally:
+        os.chdir(cwd)
+
+    from results_store import ShardedResultsStore
+    kernel_peaks = {r['nb_path']: kernelPeakRSS(r) for _, r in ShardedResultsStore(results_cache_path).items()}
+
+    # The per-notebook latency and status come from the notebook_done events of the worker
+    per_notebook = []
+    events_dir = os.path.join(metrics_dir, 'events')
+    for filename in sorted(os.listdir(events_dir)):
+        with open(os.path.join(events_dir, filename), 'r', encoding='utf-8') as f:
+            for line in f:
+                event = json.loads(line)
+                if event['kind'] == 'notebook_done':
+                    per_notebook.append({'nb_path': event.get('nb'), 'kind': corpus['notebooks'].get(event.get('nb')),
+                                         'status': event.get('status'), 'latency': event.get('duration'),
+                                         'kernel_peak_rss_mb': kernel_peaks.get(event.get('nb'))})
+    return per_notebook
+
+
+def summarize(per_notebook, wall_time):
+    latencies = [r['latency'] for r in per_notebook if r['latency'] is not None]
+    kernel_peaks = [r['kernel_peak_rss_mb'] for r in per_notebook if r['kernel_peak_rss_mb'] is not None]
+    return {
+        'notebooks': len(per_notebook),
+        'wall_time': round(wall_time, 3),
+        'notebooks_per_sec': round(len(per_notebook) / wall_time, 4) if wall_time > 0 else None,
+        'latency_p50': round(percentile(latencies, 50), 3) if latencies else None,
+        'latency_p95': round(percentile(latencies, 95), 3) if latencies else None,
+        'peak_rss_mb': {
+            # ru_maxrss is in KB on Linux
+            'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'kernel': max(kernel_peaks) if kernel_peaks else None,
+        },
+        'status_counts': dict(collections.Counter(str(r['status']).split('=')[0] for r in per_notebook)),
+    }
+
+
+def compareResults(current, previous_path):
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)['results']
+    print(f"Compared to {previous_path}:")
+    for metric in ('notebooks_per_sec', 'latency_p50', 'latency_p95'):
+        old, new = previous.get(metric), current.get(metric)
+        if old and new is not None:
+            print(f"  {metric}: {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+    for kind in ('self', 'kernel'):
+        print(f"  peak_rss_mb[{kind}]: {previous['peak_rss_mb'].get(kind)} -> {current['peak_rss_mb'][kind]}")
+
+
+def uninstallBenchModules(module_names):
+    # The missing-module notebooks installed the wheelhouse modules into this interpreter
+    subprocess.run([sys.executable, '-m', 'pip', 'uninstall', '-y', *module_names], capture_output=True)
+
+
+def main(mode, repos, nbs_per_repo, seed, mix, cell_timeout, output, work_dir=None, keep=False, compare=None,
+         archive_path=None, archive_mode=None, notebook_budget=None, lean_execution=False):
+    work_dir = work_dir or tempfile.mkdtemp(prefix='renote_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    weights = parseMix(mix)
+    corpus = generateCorpus(os.path.join(work_dir, 'corpus'), repos=repos, nbs_per_repo=nbs_per_repo, seed=seed,
+                            mix=weights, sleep_seconds=cell_timeout + 1)
+    corpus['cell_timeout'] = cell_timeout
+    print(f"Generated {len(corpus['notebooks'])} notebooks in {work_dir}")
+
+    # Missing modules are installed from the local wheelhouse only
+    os.environ['PIP_FIND_LINKS'] = corpus['wheelhouse']
+    os.environ['PIP_NO_INDEX'] = '1'
+
+    start = time.time()
+    try:
+        if mode == 'nb':
+            per_notebook = runNBMode(corpus, work_dir, archive_path, archive_mode, notebook_budget, lean_execution)
+        else:
+            per_notebook = runPipelineMode(corpus, work_dir, archive_path, archive_mode, notebook_budget, lean_execution)
+    finally:
+        if mode == 'nb':
+            uninstallBenchModules(corpus['module_names'])
+    results = summarize(per_notebook, time.time() - start)
+
+    report = {
+        'benchmark': {'mode': mode, 'repos': repos, 'nbs_per_repo': nbs_per_repo, 'seed': seed, 'mix': weights,
+                      'cell_timeout': cell_timeout, 'archive_mode': archive_mode,
+                      'notebook_budget': notebook_budget, 'lean_execution': lean_execution},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'git_commit': gitCommit()},
+        'results': results,
+        'per_notebook': [{**r, 'nb_path': os.path.relpath(r['nb_path'], work_dir) if r['nb_path'] else None}
+                         for r in per_notebook],
+    }
+    print(json.dumps(results, indent=4))
+    if compare:
+        compareResults(results, compare)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        print(f"Benchmark results saved to {output}")
+
+    if not keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the notebook pipeline on a synthetic corpus with a stub LLM.')
+    parser.add_argument('--mode', type=str, choices=['nb', 'pipeline'], default='nb', help='processNB only, or the full main.py pipeline')
+    parser.add_argument('--repos', type=int, default=5, help='number of synthetic repositories')
+    parser.add_argument('--nbs_per_repo', type=int, default=4, help='number of notebooks per repository')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the corpus generator')
+    parser.add_argument('--mix', type=str, default=None, help='error mix, e.g. `executable=0.5,missing_module=0.5`')
+    parser.add_argument('--cell_timeout', type=int, default=5, help='cell timeout in seconds (nb mode); timeout notebooks sleep one second longer')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to save the results')
+    parser.add_argument('--compare', type=str, default=None, help='previous JSON result to compare with')
+    parser.add_argument('--work_dir', type=str, default=None, help='directory of the corpus and caches (default: a temporary directory)')
+    parser.add_argument('--keep', type=int, default=0, help='1 to keep the work directory')
+    parser.add_argument('--notebook_budget', type=int, default=None, help='wall-clock seconds allowed to all executions of a notebook')
+    parser.add_argument('--archive_path', type=str, default=None, help='Path to the interaction archive [DiskCache]')
+    parser.add_argument('--archive_mode', type=str, choices=['record', 'replay'], default=None, help='record the interactions, or replay a recorded run (same --work_dir and --seed)')
+    parser.add_argument('--lean_execution', type=int, default=0, help='1 to discard the notebook outputs during execution')
+    args = parser.parse_args()
+
+    main(mode=args.mode, repos=args.repos, nbs_per_repo=args.nbs_per_repo, seed=args.seed, mix=args.mix,
+         cell_timeout=args.cell_timeout, output=args.output, work_dir=args.work_dir, keep=args.keep > 0,
+         compare=args.compare, archive_path=args.archive_path, archive_mode=args.archive_mode,
+         notebook_budget=args.notebook_budget, lean_execution=args.lean_execution > 0)
@@ -0,0 +1,33 @@
+"""
+Deterministic stand-in for localLLM.localChat used by the benchmarks.
+It answers each prompt of the fix loop with a fixed, well-formed response, so runs are
+reproducible and do not need a model server.
+"""
+
+import re
+
+
+def stubChat(prompt):
+    # ExecuteNoteBook: cell number of a NameError
+    if prompt.startswith('Identify the cell number'):
+        match = re.search(r'In ?\[(\d+)\]', prompt)
+        return f"```{match.group(1) if match else 0}```"
+
+    # ExecuteNoteBook: name of an unrecognised error
+    if prompt.startswith('Identify the error name'):
+        return "```UnknownError```"
+
+    # FixModuleNotFound: no alternative package name
+    if prompt.startswith('Fix ModuleNotFoundError'):
+        return "`None`"
+
+    # FixFileNotFound: small CSV content
+    if prompt.startswith('Generate a sample input file'):
+        return "```\nid,value\n1,10\n2,20\n3,30\n```"
+
+    # FixNameErrorLLM: define the variable as a number
+    match = re.search(r'for undefined variable (\w+)', prompt)
+    if match:
+        return f"```\n{match.group(1)} = 1\n```"
+
+    return "```None```"
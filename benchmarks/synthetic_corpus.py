@@ -0,0 +1,147 @@
+"""
+Seeded generator of a synthetic corpus of repositories and notebooks with a controlled mix of errors:
+missing modules (served from a local wheelhouse), missing input files, undefined names, names
+defined after their use, cells running past the cell timeout and large outputs. It also writes the CSV read by main.py.
+"""
+
+import base64
+import csv
+import hashlib
+import os
+import random
+import zipfile
+import nbformat
+
+ERROR_KINDS = ['executable', 'missing_module', 'missing_file', 'undefined_name', 'defined_after', 'timeout', 'large_output']
+DEFAULT_MIX = {
+    'executable': 0.3,
+    'missing_module': 0.15,
+    'missing_file': 0.15,
+    'undefined_name': 0.15,
+    'defined_after': 0.1,
+    'timeout': 0.05,
+    'large_output': 0.1,
+}
+BENCH_MODULE_PREFIX = 'renote_bench_mod'
+
+
+def parseMix(mix):
+    """Parse `kind=weight,kind=weight` into a dict, defaulting to DEFAULT_MIX"""
+    if not mix:
+        return dict(DEFAULT_MIX)
+    weights = {}
+    for item in mix.split(','):
+        kind, weight = item.split('=')
+        if kind not in ERROR_KINDS:
+            raise ValueError(f"Unknown error kind {kind}, expected one of {ERROR_KINDS}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def buildWheel(wheelhouse, module_name, value):
+    """Build a minimal pure-Python wheel exposing `module_name.VALUE`"""
+    dist = module_name
+    version = '1.0'
+    files = {
+        f'{module_name}/__init__.py': f'VALUE = {value}\n',
+        f'{dist}-{version}.dist-info/METADATA': f'Metadata-Version: 2.1\nName: {dist}\nVersion: {version}\n',
+        f'{dist}-{version}.dist-info/WHEEL': 'Wheel-Version: 1.0\nGenerator: renote-bench\nRoot-Is-Purelib: true\nTag: py3-none-any\n',
+    }
+    record_path = f'{dist}-{version}.dist-info/RECORD'
+    record = []
+    for path, content in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(content.encode()).digest()).rstrip(b'=').decode()
+        record.append(f'{path},sha256={digest},{len(content.encode())}')
+    record.append(f'{record_path},,')
+    files[record_path] = '\n'.join(record) + '\n'
+
+    wheel_path = os.path.join(wheelhouse, f'{dist}-{version}-py3-none-any.whl')
+    with zipfile.ZipFile(wheel_path, 'w') as whl:
+        for path, content in files.items():
+            whl.writestr(path, content)
+    return wheel_path
+
+
+def notebookCells(kind, rng, nb_id, sleep_seconds, module_count):
+    """The code cells of one notebook of the given kind"""
+    n = rng.randint(100, 10000)
+    cells = [
+        'import math',
+        f'values = [math.sqrt(i) for i in range({n})]',
+        'total = sum(values)',
+        'print(round(total, 2))',
+    ]
+    if kind == 'missing_module':
+        module = f'{BENCH_MODULE_PREFIX}{rng.randrange(module_count)}'
+        cells.insert(1, f'import {module}')
+        cells.append(f'print({module}.VALUE)')
+    elif kind == 'missing_file':
+        cells.append(f'with open("data/input_{nb_id}.csv") as f:\n    rows = f.read().splitlines()')
+        cells.append('print(len(rows))')
+    elif kind == 'undefined_name':
+        cells.append('print(total > threshold)')
+    elif kind == 'defined_after':
+        cells.insert(3, 'print(total * scale)')
+        cells.append('scale = 2')
+    elif kind == 'timeout':
+        cells.append(f'import time\ntime.sleep({sleep_seconds})')
+    elif kind == 'large_output':
+        cells.append('for i in range(20000):\n    print("x" * 100)')
+    return cells
+
+
+def writeNotebook(nb_path, cells):
+    nb = nbformat.v4.new_notebook()
+    nb.metadata = {
+        'kernelspec': {'name': 'python3', 'display_name': 'Python 3', 'language': 'python'},
+        'language_info': {'name': 'python', 'version': '3.12'},
+    }
+    nb.cells = [nbformat.v4.new_markdown_cell('Synthetic benchmark notebook')]
+    nb.cells += [nbformat.v4.new_code_cell(source) for source in cells]
+    nbformat.write(nb, nb_path)
+
+
+def generateCorpus(out_dir, repos=5, nbs_per_repo=4, seed=0, mix=None, sleep_seconds=2, module_count=3):
+    """
+    Generate the corpus under out_dir
+    :return: dict with the repos and csv directories, the wheelhouse and the kind of every notebook
+    """
+    rng = random.Random(seed)
+    weights = mix or dict(DEFAULT_MIX)
+    kinds, kind_weights = zip(*weights.items())
+
+    repos_dir = os.path.join(out_dir, 'repos')
+    csv_dir = os.path.join(out_dir, 'csv')
+    wheelhouse = os.path.join(out_dir, 'wheelhouse')
+    for path in (repos_dir, csv_dir, wheelhouse):
+        os.makedirs(path, exist_ok=True)
+    for i in range(module_count):
+        buildWheel(wheelhouse, f'{BENCH_MODULE_PREFIX}{i}', i)
+
+    notebooks = {}
+    rows = []
+    for r in range(repos):
+        repo_path = os.path.join(repos_dir, f'repo_{r:04d}')
+        os.makedirs(repo_path, exist_ok=True)
+        nb_paths = []
+        for k in range(nbs_per_repo):
+            nb_id = f'{r:04d}_{k:03d}'
+            kind = rng.choices(kinds, weights=kind_weights)[0]
+            nb_path = os.path.join(repo_path, f'notebook_{k:03d}.ipynb')
+            writeNotebook(nb_path, notebookCells(kind, rng, nb_id, sleep_seconds, module_count))
+            notebooks[nb_path] = kind
+            nb_paths.append(nb_path)
+        rows.append({'project_path': repo_path, 'ipynb_files': ';'.join(nb_paths)})
+
+    with open(os.path.join(csv_dir, 'repos.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['project_path', 'ipynb_files'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return {
+        'repos_dir': repos_dir,
+        'csv_dir': csv_dir,
+        'wheelhouse': wheelhouse,
+        'module_names': [f'{BENCH_MODULE_PREFIX}{i}' for i in range(module_count)],
+        'notebooks': notebooks,
+    }
@@ -1,20 +1,170 @@
-from diskcache import Index
-import pip
-import pandas as pd
+import argparse
+import csv
+import hashlib
+import json
 import os
+import sys
+import time
+from diskcache import Index
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'project_main', 'RenoteUtils'))
+
+from results_store import ShardedResultsStore
+
+# Typed schema of the exported table. Fields not listed here are kept, JSON-encoded, in `extra`.
+INT_COLUMNS = [
+    'Initial Total Code Cells', 'Initial_max_execute_cells', 'Final Total Code Cells', 'Final_max_execute_cells',
+    'Increased_execution_cells', 'total_cell_ex_after_file_fix', 'total_cell_ex_after_module_fix',
+    'total_cell_ex_after_name_fix', 'total_module_not_found', 'total_file_not_found', 'total_name_error',
+    'total_module_fixing_using_llm', 'success_module_fixing_using_llm',
+]
+FLOAT_COLUMNS = ['Increased_exection_percentage']
+LIST_COLUMNS = ['all_unique_errors_during_execution', 'missing_modules']
+STRING_COLUMNS = [
+    'key', 'nb_path', 'repo_path', 'Initial_Status', 'Final_Status', 'ast_status', 'status',
+    'FileCreationError (Manual)', 'duplicate_of', 'last_name_error_found', 'extra',
+]
+COLUMNS = STRING_COLUMNS[:-1] + INT_COLUMNS + FLOAT_COLUMNS + LIST_COLUMNS + ['extra']
+
+
+def toRow(key, record):
+    """Flatten a cached record into a row matching COLUMNS"""
+    row = {column: None for column in COLUMNS}
+    row['key'] = key
+    extra = {}
+    for field, value in record.items():
+        if field not in row:
+            extra[field] = value
+        elif field in LIST_COLUMNS:
+            row[field] = sorted(str(v) for v in value) if value is not None else None
+        elif field in INT_COLUMNS:
+            row[field] = int(value) if value is not None else None
+        elif field in FLOAT_COLUMNS:
+            row[field] = float(value) if value is not None else None
+        elif isinstance(value, (dict, list, tuple, set)):
+            row[field] = json.dumps(value, default=list)
+        else:
+            row[field] = None if value is None else str(value)
+    if extra:
+        row['extra'] = json.dumps(extra, default=list)
+    return row
+
+
+def rowFingerprint(row):
+    """Version of an exported row: a record rewritten under the same key gets a new fingerprint"""
+    return hashlib.sha1(json.dumps(row, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def iterChunks(nb_cache, chunk_size, exported=None):
+    """Page through the store, yielding lists of (key, row, fingerprint), skipping rows already exported unchanged"""
+    chunk = []
+    for key, record in nb_cache.items():
+        row = toRow(key, record)
+        fingerprint = rowFingerprint(row)
+        if exported is not None and exported.get(key) == fingerprint:
+            continue
+        chunk.append((key, row, fingerprint))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class CSVSink:
+    def __init__(self, csv_path, append=False):
+        new_file = not append or not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+        self.f = open(csv_path, 'a' if append else 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.f, fieldnames=COLUMNS)
+        if new_file:
+            self.writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            self.writer.writerow({c: json.dumps(v) if c in LIST_COLUMNS and v is not None else v for c, v in row.items()})
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetSink:
+    """Writes one Parquet part file per chunk into a directory, so incremental exports only add files"""
+    def __init__(self, parquet_dir, append=False):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet export requires pyarrow: pip install pyarrow")
+        self.pa = pa
+        self.pq = pq
+        self.parquet_dir = parquet_dir
+        os.makedirs(parquet_dir, exist_ok=True)
+        if not append:
+            for name in os.listdir(parquet_dir):
+                if name.startswith('part-') and name.endswith('.parquet'):
+                    os.remove(os.path.join(parquet_dir, name))
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')
+        self.part = 0
+        types = {**{c: pa.int64() for c in INT_COLUMNS},
+                 **{c: pa.float64() for c in FLOAT_COLUMNS},
+                 **{c: pa.list_(pa.string()) for c in LIST_COLUMNS}}
+        self.schema = pa.schema([(c, types.get(c, pa.string())) for c in COLUMNS])
+
+    def write(self, rows):
+        table = self.pa.Table.from_pylist(rows, schema=self.schema)
+        self.pq.write_table(table, os.path.join(self.parquet_dir, f'part-{self.run_id}-{self.part:05d}.parquet'))
+        self.part += 1
+
+    def close(self):
+        pass
+
+
+def main(results_cache_path, csv=None, parquet=None, chunk_size=10000, incremental=False, state_path=None):
+    nb_cache = ShardedResultsStore(results_cache_path)
+    sinks = []
+    if csv:
+        sinks.append(CSVSink(csv, append=incremental))
+    if parquet:
+        sinks.append(ParquetSink(parquet, append=incremental))
+    if not sinks:
+        raise ValueError("Nothing to export, set --csv and/or --parquet")
+
+    # Fingerprint of each exported row, used by the next incremental export to only export new and rewritten
+    # records. A full export rewrites the output, so it starts the state over
+    if state_path is None:
+        state_path = f"{(parquet or csv).rstrip(os.sep)}.export_state"
+    state = Index(state_path)
+    if not incremental:
+        state.clear()
 
+    total = 0
+    try:
+        for chunk in iterChunks(nb_cache, chunk_size, state if incremental else None):
+            rows = [row for _, row, _ in chunk]
+            for sink in sinks:
+                sink.write(rows)
+            with state.transact():
+                for key, _, fingerprint in chunk:
+                    state[key] = fingerprint
+            total += len(rows)
+            print(f"Exported {total} records")
+    finally:
+        for sink in sinks:
+            sink.close()
+    return total
 
-def main(cache_path, csv):
-    nb_cache = Index(cache_path)
-    results = [v for k, v in nb_cache.items()]
-    df = pd.DataFrame(results)
-    df.to_csv(csv)
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Read all .ipynb files in a directory.')
+    parser = argparse.ArgumentParser(description='Export the results cache to CSV and/or Parquet.')
     parser.add_argument('--results_cache_path', type=str, required=True, help='Path to the results cache [DiskCache]')
-    parser.add_argument('--csv', type=str, default=True, help='csv file path to save the results')
+    parser.add_argument('--csv', type=str, default=None, help='csv file path to save the results')
+    parser.add_argument('--parquet', type=str, default=None, help='directory to save the results as Parquet part files')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='number of records written per chunk')
+    parser.add_argument('--incremental', type=int, default=0, help='1 to only export the records added or rewritten since the last export')
+    parser.add_argument('--state_path', type=str, default=None, help='Path to the export state [DiskCache], written by every export and read by --incremental')
 
     args = parser.parse_args()
-    main(results_cache_path=args.results_cache_path, csv= args.csv)
-    print(f"Results saved to {args.csv}")
+    total = main(results_cache_path=args.results_cache_path, csv=args.csv, parquet=args.parquet,
+                 chunk_size=args.chunk_size, incremental=args.incremental > 0, state_path=args.state_path)
+    print(f"{total} results saved to {', '.join(p for p in (args.csv, args.parquet) if p)}")
@@ -1,7 +1,12 @@
+import argparse
 import subprocess
 import os
+import sys
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'project_main', 'RenoteUtils'))
+from run_config import parseArgsWithConfig
+
 def create_and_setup_venv(base_path, venv_name):
     venv_path = os.path.join(base_path, venv_name)
     if not os.path.exists(venv_path):
@@ -29,13 +34,20 @@ def copy_to_backup(venv_name, source_path, backup_path):
         print(f"Source virtual environment {source_env} does not exist.")
 
 def main():
-    source_path = "path/to/source/envs"
-    backup_path = "path/to/backup/envs"
+    parser = argparse.ArgumentParser(description='Create the virtual environments of the workers (nb1_venv, nb2_venv, ...)')
+    parser.add_argument('--source_envs_path', type=str, help='Directory of the working copies of the envs')
+    parser.add_argument('--backup_envs_path', type=str, help='Directory of the backup envs')
+    parser.add_argument('--n_envs', type=int, default=0, help='Number of envs to create (default: --max_envs)')
+    parser.add_argument('--max_envs', type=int, default=32, help='Largest number of envs of the run')
+    args = parseArgsWithConfig(parser, required=['source_envs_path', 'backup_envs_path'])
+    source_path = args.source_envs_path
+    backup_path = args.backup_envs_path
     
     if not os.path.exists(backup_path):
         os.makedirs(backup_path)
     
-    num_envs = 32 # Change this to the number of virtual environments you want to create
+    # An automatically sized run clones the envs it needs beyond these, so fewer can be created
+    num_envs = args.n_envs or args.max_envs
     for i in  tqdm(range(1, num_envs + 1)):
         venv_name = f'nb{i}_venv'
         create_and_setup_venv(source_path, venv_name)
@@ -0,0 +1,17 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'project_main', 'RenoteUtils'))
+
+from trace_utils import mergeTraceFiles
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the per-worker trace files into one Chrome/Perfetto trace.')
+    parser.add_argument('--trace_dir', type=str, required=True, help='Directory of the trace files written with --trace_dir')
+    parser.add_argument('--output', type=str, required=True, help='Path of the merged trace JSON file')
+
+    args = parser.parse_args()
+    total = mergeTraceFiles(args.trace_dir, args.output)
+    print(f"{total} trace events saved to {args.output}")
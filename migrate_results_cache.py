@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+import pandas as pd
+from diskcache import Index
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'project_main', 'RenoteUtils'))
+
+from nb_dedup import computeCodeHash
+from results_store import ResultsStore, notebookIdentity
+
+
+def readRepoPaths(all_repo_dir_path):
+    """Read the project paths of all repositories from the CSV files used by main.py"""
+    repo_paths = set()
+    if all_repo_dir_path is None:
+        return repo_paths
+    for filename in os.listdir(all_repo_dir_path):
+        if filename.endswith('.csv'):
+            df = pd.read_csv(os.path.join(all_repo_dir_path, filename), usecols=['project_path'])
+            repo_paths.update(os.path.normpath(p) for p in df['project_path'].dropna())
+    return repo_paths
+
+
+def findRepoPath(nb_path, repo_paths):
+    """Return the longest repository path containing the notebook, or the notebook's directory"""
+    path = os.path.dirname(os.path.normpath(nb_path))
+    while path and path != os.path.dirname(path):
+        if path in repo_paths:
+            return path
+        path = os.path.dirname(path)
+    return os.path.dirname(nb_path)
+
+
+def migrate(old_cache_path, new_cache_path, repo_paths):
+    old_cache = Index(old_cache_path)
+    new_cache = ResultsStore(new_cache_path)
+    migrated, skipped = 0, 0
+    for old_key, record in old_cache.items():
+        nb_path = record.get('nb_path') if isinstance(record, dict) else None
+        if nb_path is None:
+            print(f"Skipping {old_key}: no nb_path in the record")
+            skipped += 1
+            continue
+        repo_path = record.get('repo_path') or findRepoPath(nb_path, repo_paths)
+        code_hash = computeCodeHash(nb_path) if os.path.exists(nb_path) else None
+        new_cache[notebookIdentity(repo_path, nb_path, code_hash)] = {**record, 'repo_path': repo_path}
+        migrated += 1
+    print(f"{old_cache_path}: migrated {migrated} records, skipped {skipped}")
+
+
+def main(old_results_cache_path, old_err_cache_path, results_cache_path, err_cache_path, all_repo_dir_path):
+    repo_paths = readRepoPaths(all_repo_dir_path)
+    migrate(old_results_cache_path, results_cache_path, repo_paths)
+    if old_err_cache_path:
+        migrate(old_err_cache_path, err_cache_path, repo_paths)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate basename-keyed result caches to the versioned results store.')
+    parser.add_argument('--old_results_cache_path', type=str, required=True, help='Path to the legacy results cache [DiskCache]')
+    parser.add_argument('--old_err_cache_path', type=str, default=None, help='Path to the legacy error cache [DiskCache]')
+    parser.add_argument('--results_cache_path', type=str, required=True, help='Path to the new results cache [DiskCache]')
+    parser.add_argument('--err_cache_path', type=str, required=True, help='Path to the new error cache [DiskCache]')
+    parser.add_argument('--all_repo_dir_path', type=str, default=None, help='Directory of the repository CSV files, used to recover repo paths')
+
+    args = parser.parse_args()
+    main(old_results_cache_path=args.old_results_cache_path,
+         old_err_cache_path=args.old_err_cache_path,
+         results_cache_path=args.results_cache_path,
+         err_cache_path=args.err_cache_path,
+         all_repo_dir_path=args.all_repo_dir_path)
@@ -3,33 +3,64 @@ import os
 from nb_utils import readNoteBook
 import localLLM as llm
 import papermill as pm
+from trace_utils import span
+from exec_profile import CellProfiler
+from interaction_archive import archived
+from nb_dedup import computeCodeHash
+from exec_budget import BUDGET_EXHAUSTED
+from kernel_limits import KernelGuard
+from network_guard import kernelNetworkGuard, isNetworkBlockedError, NETWORK_ACCESS_BLOCKED
+from lean_execution import executionEngine, leanKernelEnvironment
+from disk_governor import isDiskFullError, DISK_FULL
+from run_config import RunConfig
 
-def papermillExecution(orignal_nb_path):
+# Seconds a single cell may run before papermill raises a timeout
+CELL_TIMEOUT = 300
+
+def papermillExecution(orignal_nb_path, profiler=None, timeout_func=None, run_config=None):
     """
     Execute the notebook using papermill
     :param orignal_nb_path: The path of the notebook to execute
+    :param profiler: optional CellProfiler recording per-cell timing and memory
+    :param timeout_func: optional function giving the timeout of each cell, instead of CELL_TIMEOUT
+    :param run_config: RunConfig of the execution (network blocking, lean execution)
     """
+    run_config = run_config or RunConfig()
     notebook_dir = os.path.dirname(orignal_nb_path)
+    hooks = profiler.hooks() if profiler is not None else {}
+    if timeout_func is not None:
+        hooks['timeout_func'] = timeout_func
     try:
-        pm.execute_notebook(
-            input_path = orignal_nb_path,
-            output_path = None,
-            timeout=300, 
-            kernel_name="python3",
-            progress_bar=False,
-            cwd=notebook_dir
-        )
+        with span('papermill_execution'), kernelNetworkGuard(run_config.block_network), \
+                leanKernelEnvironment(run_config.lean_execution):
+            pm.execute_notebook(
+                input_path = orignal_nb_path,
+                output_path = None,
+                engine_name=executionEngine(run_config.lean_execution),
+                timeout=CELL_TIMEOUT,
+                kernel_name="python3",
+                progress_bar=False,
+                cwd=notebook_dir,
+                **hooks
+            )
     except Exception as e:
         raise e
 
 
 class ExecuteNoteBook:
-    def __init__(self, nb_path):
+    def __init__(self, nb_path, budget=None, run_config=None):
+        """
+        :param nb_path: The path of the notebook to execute
+        :param budget: optional ExecutionBudget shared by all executions of the notebook
+        :param run_config: RunConfig of the execution (kernel limits, network blocking, lean execution)
+        """
         nb, status = readNoteBook(nb_path)
         assert status == "Success", f"{status} in {nb_path}"
         code_cells = nb.readCodeCells()
         self.total_code_cells = len(code_cells)
         self.original_nb_path = nb_path
+        self.budget = budget
+        self.run_config = run_config or RunConfig()
 
 
     def _findErrorCellNumForNameError(self, err):
@@ -113,22 +144,76 @@ class ExecuteNoteBook:
         - total_code_cells: The total number of code cells in the notebook
         - err_cell_num: The cell number where the error occurred
         """
+        with span('execute_notebook', total_code_cells=self.total_code_cells) as exec_span:
+            # Recorded executions are looked up by the hash of the code cells
+            code_key = computeCodeHash(self.original_nb_path) or self.original_nb_path
+            result = archived('exec', code_key, self._profiledExecution)
+            exec_span['status'] = result['status']
+            exec_span['err_cell_num'] = result['err_cell_num']
+        return result
+
+    def _profiledExecution(self):
+        if self.budget is not None and self.budget.isExhausted():
+            print(f'>> Execution budget of {self.budget.total_seconds}s exhausted, not executing {self.original_nb_path}')
+            return {
+                'status': BUDGET_EXHAUSTED,
+                'total_code_cells': self.total_code_cells,
+                'err_cell_num': -1
+            }
+        limits = self.run_config.kernel_limits
+        guard = KernelGuard(limits) if limits is not None else None
+        profiler = CellProfiler(on_kernel_start=guard.onKernelStart if guard is not None else None)
+        try:
+            result = self._executeNotebook(profiler, guard)
+        finally:
+            if guard is not None:
+                guard.stop()
+                guard.removeCgroup()
+        result['profile'] = profiler.summary()
+        if guard is not None:
+            result['resource_usage'] = guard.usage()
+        if self.budget is not None:
+            self.budget.observe(profiler)
+        return result
+
+    def _executeNotebook(self, profiler, guard=None):
+        timeout_func = None
+        if self.budget is not None:
+            timeout_func = lambda cell: self.budget.cellTimeout(cell, CELL_TIMEOUT)
         try:
-            papermillExecution(self.original_nb_path)
+            papermillExecution(self.original_nb_path, profiler, timeout_func, self.run_config)
             return {
                 'status': "executable", 
                 'total_code_cells': self.total_code_cells,
                 'err_cell_num': self.total_code_cells
             }
         except TimeoutError as e:
+            # A cell cut off by the end of the notebook budget rather than by its own timeout
+            budget_exhausted = self.budget is not None and self.budget.last_timeout_from_budget
             return {
-                'status': "TimeoutError", 
+                'status': BUDGET_EXHAUSTED if budget_exhausted else "TimeoutError",
                 'total_code_cells': self.total_code_cells,
                 'err_cell_num': -1
             }
            
         except Exception as e:
-            err_cell_num, err_type = self._findErrorCellNumANDType(str(e))
+            # A resource limit of the kernel was hit, the network was used while blocked or the disk is full:
+            # no fix applies, and the error text needs no classification
+            limit_status = guard.classifyError(str(e)) if guard is not None else None
+            if limit_status is None and self.run_config.block_network and isNetworkBlockedError(str(e)):
+                limit_status = NETWORK_ACCESS_BLOCKED
+            if limit_status is None and isDiskFullError(str(e)):
+                limit_status = DISK_FULL
+            if limit_status is not None:
+                print(f'>> {limit_status}: {str(e)[:500]}')
+                return {
+                    'status': limit_status,
+                    'total_code_cells': self.total_code_cells,
+                    'err_cell_num': profiler.currentCellNumber()
+                }
+
+            with span('classify_error'):
+                err_cell_num, err_type = self._findErrorCellNumANDType(str(e))
 
             # CASE 1: ModuleNotFoundError
             if "ModuleNotFoundError" and "No module named" in str(e):
@@ -145,9 +230,6 @@ class ExecuteNoteBook:
 
             # CASE 2: Undetectable Error
             elif err_type is None:
-                if str(e).find("No space left on device") != -1:
-                    print(f'>> No space left on device, error: {str(e)}, exiting...')
-                    exit(0)
                 print(f'>> Fixing Unknown Error with LLM: {str(e)}')
                 err = str(e)
                 llm_error_type = self._getErrorTypeFromLLM(err)
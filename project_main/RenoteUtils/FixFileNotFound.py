@@ -4,6 +4,10 @@ from nb_utils import readNoteBook
 import localLLM as llm
 from pathlib import Path
 from contextlib import contextmanager
+from trace_utils import span
+from work_journal import addCleanupObligation, firstMissingAncestor
+from metrics import emitEvent
+from fix_validation import checkDataFile, fixFeedback, MAX_FIX_ATTEMPTS
 
 
 class FixFileNotFound:
@@ -39,6 +43,7 @@ class FixFileNotFound:
     def write_file(self, file_name, content):
         directory = os.path.dirname(file_name)
         try:
+            addCleanupObligation(firstMissingAncestor(file_name))
             if directory != "":
                 os.makedirs(directory, exist_ok=True)
             with open(file_name, "w", encoding='utf-8') as f:
@@ -83,17 +88,25 @@ class FixFileNotFound:
             print(f">> Generating the missing directory {self.missing_file_true_path}")
             return True
 
+        feedback = ""
         while True:
             print(f">> Generating content for input file {self.missing_file_path}")
             prompt = f"Generate a sample input file {self.missing_file_path} for the source code below. Format the response with only the needed data between ``` and ```. Just data and No fluff.\n\n{nb_source_code}"
-            response = llm.localChat(prompt)
-            content = self.get_file_data(response)
+            with span('generate_input_file_llm', missing_file=self.missing_file_path, attempt=time_run + 1):
+                response = llm.localChat(prompt + feedback)
+                content = self.get_file_data(response)
             print(f"-----------------------------\n{content}\n-----------------------------")
             time_run += 1
-            if content.strip().replace(" ", "") != "":
-                break
-            if time_run == 3:
+            # The file must parse with the reader of the notebook before the notebook runs again
+            rejection = checkDataFile(content, self.missing_file_path, nb_source_code)
+            if rejection is None:
                 break
+            print(f">> Content of {self.missing_file_path} rejected (attempt {time_run}/{MAX_FIX_ATTEMPTS}): {rejection}")
+            emitEvent('fix_rejected', fix='input_file', attempt=time_run)
+            if time_run == MAX_FIX_ATTEMPTS:
+                print(f"> LLM Failed to create {self.missing_file_path}")
+                return False
+            feedback = fixFeedback(content, rejection)
                 
         if self.write_file(self.missing_file_true_path, content) == True:
             print(f"> File created with LLM for {self.missing_file_path}")
@@ -1,5 +1,6 @@
 from localLLM import localChat as llm
 import re
+from trace_utils import span
 
 class FixModuleNotFound:
     def __init__(self, module_name):
@@ -24,6 +25,7 @@ class FixModuleNotFound:
     def fixModuleNotFound(self):
         prompt = f"""Fix ModuleNotFoundError for module `{self.module_name}`. Provide the exact open-source module name to install using pip, formatted as `module_name`.
                     Format the correct module name exactly between ` and ` in 1 line. If no module is found, return `None`. Do not generate a random module name. No fluff."""
-        response = llm(prompt)
-        correct_module = self._processRawResponse(response)
+        with span('fix_module_llm', module=self.module_name):
+            response = llm(prompt)
+            correct_module = self._processRawResponse(response)
         return correct_module
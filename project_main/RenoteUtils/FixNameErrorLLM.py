@@ -1,17 +1,27 @@
 import localLLM as llm
 import nbformat as nbf
 from nbconvert import PythonExporter
-from nb_utils import readNoteBook
+from nb_utils import readNoteBook, StaticAST
 import os
 import json
 import uuid
+from trace_utils import span
+from work_journal import addCleanupObligation
+from metrics import emitEvent
+from fix_validation import checkDefinitionCode, codeDefinitions, definedNamesBefore, fixFeedback, MAX_FIX_ATTEMPTS
 
 
 class FixNameErrorLLM:
-    def __init__(self, nb_path, undefined_var, undefined_var_cell):
+    def __init__(self, nb_path, undefined_var, undefined_var_cell, batch_repair=False):
+        '''
+        :param batch_repair: fix every variable the notebook never defines with the NameError, in one LLM call
+        '''
         self.nb_path = nb_path
         self.undefined_var = undefined_var
         self.undefined_var_cell = undefined_var_cell
+        self.batch_repair = batch_repair
+        # Definition cells inserted in the new notebook, which shift the cell numbers of its executions
+        self.inserted_cells = 0
 
     def _processRawResponse(self, response):
         '''
@@ -36,6 +46,28 @@ class FixNameErrorLLM:
         
         return file_content
 
+    def _processRawBlocks(self, response):
+        '''
+        Process the raw response from the model to get every code block, in order
+        :param response: The raw response from the model
+        :return: The list of the codes in text
+        '''
+        blocks = []
+        block = None
+        for line in response.splitlines():
+            if line.startswith("#"):
+                continue
+            if "```" in line:
+                if block is None:
+                    block = ""
+                else:
+                    blocks.append(block)
+                    block = None
+                continue
+            if block is not None:
+                block += line + "\n"
+        return blocks
+
     def _getNBSourceCode(self):
         '''
         Get the source code of the notebook
@@ -47,34 +79,45 @@ class FixNameErrorLLM:
 
         # Export the notebook to Python code
         exporter = PythonExporter()
-        source, _ = exporter.from_notebook_node(nb.readNB())
+        source, _ = exporter.from_notebook_node(nb.nb_content)
 
         return source 
 
     def _generateDefinitionCode(self):
         '''
         Generate the code cell containing the definition of the undefined variable
-        :return: The new code cell
+        :return: The new code cell, None if no valid definition was generated
         '''
 
         code_in_text = ''''''
 
         # Get the source code of the notebook
         source_code = self._getNBSourceCode()
+        defined_names = definedNamesBefore(self.nb_path, self.undefined_var_cell)
 
         # Generate the prompt
         prompt = f"""Generate code cell containing a definition (not None) for undefined variable {self.undefined_var} in cell {self.undefined_var_cell} of the source code below. 
                 Provide the corrected code between ``` and ```. No fluff.\n\n
                 {source_code}"""
         
-        # Get the response from the model
-        response = llm.localChat(prompt)
-
-        # Process the response to get the code
-        code_in_text = self._processRawResponse(response)
-
-        # Generate the new cell
-        new_cell = {
+        # Check each answer before the notebook is executed again, sending the reason of a rejection back to the model
+        feedback = ''
+        for attempt in range(1, MAX_FIX_ATTEMPTS + 1):
+            response = llm.localChat(prompt + feedback)
+            code_in_text = self._processRawResponse(response)
+            rejection = checkDefinitionCode(code_in_text, [self.undefined_var], defined_names)
+            if rejection is None:
+                break
+            print(f">> Definition of {self.undefined_var} rejected (attempt {attempt}/{MAX_FIX_ATTEMPTS}): {rejection}")
+            emitEvent('fix_rejected', fix='name_error', attempt=attempt)
+            feedback = fixFeedback(code_in_text, rejection)
+        else:
+            return None
+
+        return self._newCodeCell(code_in_text)
+
+    def _newCodeCell(self, code_in_text):
+        return {
             "cell_type": "code",
             "execution_count": None,
             "metadata": {},
@@ -83,30 +126,116 @@ class FixNameErrorLLM:
             "id": str(uuid.uuid4())
         }
 
-        return new_cell
+    def _checkDefinitionCodes(self, codes, first_uses, static_ast):
+        '''
+        Check the generated cells of a batched repair
+        :return: None if every cell is valid, else the reason of the rejection
+        '''
+        if len(codes) != len(first_uses):
+            return f"Expected {len(first_uses)} code blocks, one per variable ({', '.join(first_uses)}), got {len(codes)}."
+        generated_names = set()
+        for code, (var, cell) in zip(codes, first_uses.items()):
+            # The cells generated for the variables used earlier are inserted before this one
+            rejection = checkDefinitionCode(code, [var], definedNamesBefore(self.nb_path, cell, static_ast) | generated_names)
+            if rejection is not None:
+                return f"Code block for {var}: {rejection}"
+            generated_names |= codeDefinitions(code)
+        return None
+
+    def _generateDefinitionCodes(self, first_uses, static_ast):
+        '''
+        Generate the code cells containing the definitions of several undefined variables, in one LLM call
+        :param first_uses: dict {undefined variable: number of the cell of its first use}, in order of first use
+        :return: The list of the codes, one per variable, None if no valid definitions were generated
+        '''
+        source_code = self._getNBSourceCode()
+        variables = "\n".join(f"- {var} (first used in cell {cell})" for var, cell in first_uses.items())
+        prompt = f"""Generate one code cell per undefined variable listed below, each containing a definition (not None) of the variable for the source code below.
+                Provide each code cell between ``` and ```, in the order of the list. No fluff.\n\n
+                {variables}\n\n
+                {source_code}"""
+
+        feedback = ''
+        for attempt in range(1, MAX_FIX_ATTEMPTS + 1):
+            response = llm.localChat(prompt + feedback)
+            codes = self._processRawBlocks(response)
+            rejection = self._checkDefinitionCodes(codes, first_uses, static_ast)
+            if rejection is None:
+                return codes
+            print(f">> Definitions of {', '.join(first_uses)} rejected (attempt {attempt}/{MAX_FIX_ATTEMPTS}): {rejection}")
+            emitEvent('fix_rejected', fix='name_error_batch', attempt=attempt)
+            feedback = fixFeedback("\n```\n```\n".join(codes), rejection)
+        return None
+
+    def _undefinedVariables(self):
+        '''
+        Find the variables to define with the NameError in a batched repair
+        :return: (dict {variable: number of the cell of its first use}, the analyzed StaticAST), None for a single repair
+        '''
+        static_ast = StaticAST(self.nb_path)
+        first_uses = static_ast.findAllUndefinedVariables()
+        if not first_uses or (len(first_uses) == 1 and self.undefined_var in first_uses):
+            return None
+        # The NameError cell is an execution count: number it as the StaticAST cells are
+        first_uses.setdefault(self.undefined_var, static_ast.findUseCell(self.undefined_var, self.undefined_var_cell))
+        first_uses = dict(sorted(first_uses.items(), key=lambda item: item[1]))
+        return first_uses, static_ast
+
+    def _saveNotebook(self, notebook):
+        output_name = os.path.basename(self.nb_path).replace(".ipynb", "_NameFixed.ipynb")
+        nb_dir = os.path.dirname(self.nb_path)
+        output_nb_path = os.path.join(nb_dir, output_name)
+
+        addCleanupObligation(output_nb_path)
+        with open(output_nb_path, "w", encoding="utf-8") as f:
+            json.dump(notebook, f, indent=2)
+            print(f"NameError fixed notebook saved to {output_nb_path}")
+
+        return output_nb_path
+
+    def _fixAllNameErrors(self, notebook, first_uses, static_ast):
+        '''
+        Insert the definitions of all the undefined variables, each before the cell of its first use
+        :return: the path of the new notebook, None if no valid definitions were generated
+        '''
+        print(f">> Batched NameError repair of {len(first_uses)} variables: {', '.join(first_uses)}")
+        with span('fix_name_error_llm', undefined_var=self.undefined_var, batch=len(first_uses)):
+            codes = self._generateDefinitionCodes(first_uses, static_ast)
+        if codes is None:
+            print(f"No valid definitions generated for {', '.join(first_uses)}")
+            return None
+        emitEvent('name_error_batch', variables=len(first_uses))
+
+        # From the last insertion point, so the indices of the earlier cells do not move
+        for code, cell in reversed(list(zip(codes, first_uses.values()))):
+            notebook['cells'].insert(static_ast.cell_indices.get(cell, cell - 1), self._newCodeCell(code))
+        self.inserted_cells = len(codes)
+        return self._saveNotebook(notebook)
 
     
     def fixNameErrorANDGetNewNBPath(self):
         '''
-        Fix the NameError in the notebook and return the path of the new notebook
+        Fix the NameError in the notebook and return the path of the new notebook, None if it cannot be fixed
         '''
         # Load the notebook
         with open(self.nb_path, 'r') as f:
             notebook = json.load(f)
 
+        if self.batch_repair:
+            batch = self._undefinedVariables()
+            if batch is not None:
+                return self._fixAllNameErrors(notebook, *batch)
+
         # Generate the new cell containing the definition of the undefined variable
-        new_cell = self._generateDefinitionCode()
+        with span('fix_name_error_llm', undefined_var=self.undefined_var):
+            new_cell = self._generateDefinitionCode()
+        if new_cell is None:
+            print(f"No valid definition generated for {self.undefined_var}")
+            return None
 
         # Insert the new cell at the correct position
         notebook['cells'].insert(self.undefined_var_cell - 1, new_cell)
+        self.inserted_cells = 1
     
         # Save the notebook with the new cell
-        output_name = os.path.basename(self.nb_path).replace(".ipynb", "_NameFixed.ipynb")
-        nb_dir = os.path.dirname(self.nb_path)
-        output_nb_path = os.path.join(nb_dir, output_name)
-
-        with open(output_nb_path, "w", encoding="utf-8") as f:
-            json.dump(notebook, f, indent=2)
-            print(f"NameError fixed notebook saved to {output_nb_path}")
-
-        return output_nb_path
+        return self._saveNotebook(notebook)
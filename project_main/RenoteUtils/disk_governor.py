@@ -0,0 +1,286 @@
+"""
+Disk-space governor of the env, repo and cache volumes.
+Before a repo is dispatched to an env, and before each notebook, the free space of every volume is checked:
+- below the low watermark, reusable space is evicted: the pip cache entries older than an hour (unless a
+  pip install is running), env copies that are not in use, and orphaned temporary notebooks and scratch
+  copies left by crashed runs
+- if a volume is still below the low watermark, the dispatch pauses until every volume is back above the
+  resume watermark (twice the low watermark by default), then resumes on its own; after max_pause seconds
+  without space, the waiting repo or notebook fails with NoSpaceLeftOnDevice instead
+A notebook that still runs out of space gets the status NoSpaceLeftOnDevice instead of stopping its worker.
+Pressure, eviction, pause and resume are reported as metrics events.
+"""
+
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from metrics import emitEvent
+from scratch_workspace import SCRATCH_PREFIX
+
+DISK_FULL = 'NoSpaceLeftOnDevice'
+DEFAULT_LOW_WATERMARK_MB = 5 * 1024
+ORPHAN_AGE_SECONDS = 6 * 3600       # temporary notebooks older than this belong to no running notebook
+ORPHAN_SUFFIXES = ('_NameFixed.ipynb', '_reordered_temp.ipynb')
+PIP_CACHE_MIN_AGE_SECONDS = 3600    # newer pip cache entries are likely to be used again soon
+DEFAULT_MAX_PAUSE_SECONDS = 3600
+
+_governor = None
+
+
+class DiskSpaceExhausted(OSError):
+    """No space came back within the maximum pause"""
+
+
+def isDiskFullError(err):
+    return 'No space left on device' in err or 'Errno 28' in err
+
+
+def setDiskGovernor(config):
+    """
+    Govern the disk space of this process
+    :param config: dict of DiskGovernor arguments, as given by DiskGovernor.asDict(); None to disable
+    """
+    global _governor
+    _governor = DiskGovernor(**config) if config else None
+
+
+def getDiskGovernor():
+    return _governor
+
+
+def directorySize(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+def isOwnerGone(scratch_name):
+    """Whether the process that made a scratch copy (renote-scratch-<pid>-<id>) has exited"""
+    try:
+        pid = int(scratch_name[len(SCRATCH_PREFIX):].split('-')[0])
+        os.kill(pid, 0)
+    except (ValueError, ProcessLookupError):
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def pipCacheDir():
+    return os.environ.get('PIP_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'pip')
+
+
+def _openPipCacheLock():
+    # Next to the cache, so that evicting the cache leaves the lock in place
+    path = pipCacheDir().rstrip(os.sep) + '.renote-lock'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, 'a')
+    except OSError:
+        return None
+
+
+def acquirePipCacheLock():
+    """
+    Take a shared lock on the pip cache for the duration of a pip install, so it is not evicted under the install
+    :return: the lock, to close when pip is done; None if the lock file cannot be created
+    """
+    lock = _openPipCacheLock()
+    if lock is not None:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+    return lock
+
+
+@contextmanager
+def pipCacheInUse():
+    lock = acquirePipCacheLock()
+    try:
+        yield
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+class DiskGovernor:
+    def __init__(self, paths, low_watermark_mb=DEFAULT_LOW_WATERMARK_MB, resume_watermark_mb=None, source_envs_path=None,
+                 active_envs=None, orphan_dirs=None, scratch_dir=None, poll_interval=30, max_pause=DEFAULT_MAX_PAUSE_SECONDS):
+        """
+        :param paths: paths on the volumes to watch (envs, repos, caches); one path per volume is enough
+        :param low_watermark_mb: free space in MB below which space is evicted and dispatch pauses
+        :param resume_watermark_mb: free space in MB every volume needs before a paused dispatch resumes
+        :param source_envs_path: directory of the env copies; copies of envs not in active_envs are evicted
+        :param active_envs: names of the envs of this run
+        :param orphan_dirs: directories searched for orphaned `_NameFixed` / `_reordered_temp` notebooks
+        :param scratch_dir: directory of the scratch copies of the repos (the temp directory if None)
+        :param poll_interval: seconds between two checks while paused
+        :param max_pause: seconds a pause may last before the waiting work fails; None for no limit
+        """
+        self.paths = [p for p in paths if p]
+        self.low_watermark_mb = low_watermark_mb
+        self.resume_watermark_mb = resume_watermark_mb or 2 * low_watermark_mb
+        self.source_envs_path = source_envs_path
+        self.active_envs = list(active_envs or [])
+        self.orphan_dirs = list(orphan_dirs or [])
+        self.scratch_dir = scratch_dir
+        self.poll_interval = poll_interval
+        self.max_pause = max_pause
+        # Envs supervised in one process wait for space concurrently: one eviction at a time
+        self._evict_lock = threading.Lock()
+
+    def asDict(self):
+        return {'paths': self.paths, 'low_watermark_mb': self.low_watermark_mb,
+                'resume_watermark_mb': self.resume_watermark_mb, 'source_envs_path': self.source_envs_path,
+                'active_envs': self.active_envs, 'scratch_dir': self.scratch_dir, 'poll_interval': self.poll_interval,
+                'max_pause': self.max_pause}
+
+    def volumes(self):
+        """One existing path per watched volume"""
+        volumes = {}
+        for path in self.paths:
+            while path and not os.path.exists(path):
+                parent = os.path.dirname(path)
+                path = parent if parent != path else None
+            if path:
+                volumes.setdefault(os.stat(path).st_dev, path)
+        return list(volumes.values())
+
+    def lowVolumes(self, threshold_mb):
+        """(path, free MB) of the volumes with less than threshold_mb free"""
+        low = []
+        for path in self.volumes():
+            free_mb = shutil.disk_usage(path).free / 1024 / 1024
+            if free_mb < threshold_mb:
+                low.append((path, round(free_mb)))
+        return low
+
+    def _remove(self, path, kind, freed):
+        try:
+            size = directorySize(path) if os.path.isdir(path) else os.path.getsize(path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError as e:
+            print(f'>> Cannot evict {path}: {e}')
+            return
+        freed[kind] = freed.get(kind, 0) + size
+
+    def _evictPipCache(self, now, freed):
+        cache_dir = pipCacheDir()
+        if not os.path.isdir(cache_dir):
+            return
+        lock = _openPipCacheLock()
+        if lock is None:
+            return
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print('>> pip installs are running, the pip cache is not evicted')
+                return
+            for root, dirs, files in os.walk(cache_dir, topdown=False):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        old = now - os.lstat(path).st_mtime > PIP_CACHE_MIN_AGE_SECONDS
+                    except OSError:
+                        continue
+                    if old:
+                        self._remove(path, 'pip_cache', freed)
+                for name in dirs:
+                    try:
+                        os.rmdir(os.path.join(root, name))
+                    except OSError:
+                        continue
+
+    def evict(self):
+        """Remove the reusable caches and orphaned files; return the bytes freed by kind"""
+        freed = {}
+        now = time.time()
+        self._evictPipCache(now, freed)
+
+        if self.source_envs_path and os.path.isdir(self.source_envs_path):
+            for name in os.listdir(self.source_envs_path):
+                path = os.path.join(self.source_envs_path, name)
+                if name not in self.active_envs and os.path.isdir(path):
+                    self._remove(path, 'stale_env', freed)
+
+        scratch_dir = self.scratch_dir or tempfile.gettempdir()
+        if os.path.isdir(scratch_dir):
+            for name in os.listdir(scratch_dir):
+                if name.startswith(SCRATCH_PREFIX) and isOwnerGone(name):
+                    self._remove(os.path.join(scratch_dir, name), 'orphan_scratch', freed)
+
+        for directory in self.orphan_dirs:
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    if not name.endswith(ORPHAN_SUFFIXES):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        # The notebook using it may delete it meanwhile
+                        old = now - os.path.getmtime(path) > ORPHAN_AGE_SECONDS
+                    except OSError:
+                        continue
+                    if old:
+                        self._remove(path, 'orphan_notebook', freed)
+
+        for kind, size in freed.items():
+            emitEvent('disk_evicted', what=kind, bytes=size)
+        print(f'>> Disk governor evicted {sum(freed.values()) / 1024 / 1024:.0f} MB: {freed}')
+        return freed
+
+    def releaseEnvCopy(self, venv_path):
+        """Remove the copy of an env that finished its repo if space is short; it is copied again for the next repo"""
+        if self.lowVolumes(self.resume_watermark_mb) and os.path.isdir(venv_path):
+            freed = {}
+            self._remove(venv_path, 'idle_env', freed)
+            for kind, size in freed.items():
+                emitEvent('disk_evicted', what=kind, bytes=size)
+
+    def waitForSpace(self, env=None):
+        """
+        Block until every volume has enough free space, evicting what can be evicted first
+        :return: seconds spent paused
+        :raise: DiskSpaceExhausted if the space did not come back within max_pause
+        """
+        low = self.lowVolumes(self.low_watermark_mb)
+        if not low:
+            return 0.0
+        for path, free_mb in low:
+            emitEvent('disk_pressure', env=env, path=path, free_mb=free_mb)
+        with self._evict_lock:
+            # Another env may have freed the space while this one waited for the lock
+            if self.lowVolumes(self.low_watermark_mb):
+                self.evict()
+        low = self.lowVolumes(self.low_watermark_mb)
+        if not low:
+            return 0.0
+
+        start = time.time()
+        print(f'>> Disk space low on {low}, pausing until {self.resume_watermark_mb} MB are free')
+        for path, free_mb in low:
+            emitEvent('disk_paused', env=env, path=path, free_mb=free_mb)
+        while True:
+            time.sleep(self.poll_interval)
+            low = self.lowVolumes(self.resume_watermark_mb)
+            if not low:
+                break
+            if self.max_pause is not None and time.time() - start > self.max_pause:
+                # Every env may be paused, so nothing would free the space: give up on this work
+                emitEvent('disk_pause_expired', env=env, waited=time.time() - start)
+                raise DiskSpaceExhausted(f'No space left on device: disk space low on {low} for more than {self.max_pause}s')
+            print(f'>> Still paused, disk space low on {low}')
+        waited = time.time() - start
+        emitEvent('disk_resumed', env=env, waited=waited)
+        print(f'>> Disk space back after {waited:.0f}s, resuming')
+        return waited
@@ -0,0 +1,182 @@
+"""
+Asyncio supervisor of the env workers.
+The orchestrator runs one coroutine per env in its own process, instead of one Python process per env
+blocked on shell commands. Each env takes the next repository from a shared queue as soon as it is free,
+and runs the stages of the repository (venv copy, requirements install, notebook execution) as async
+subprocesses:
+- each stage has its own timeout; a stage that runs out of time is terminated with its whole process
+  tree (the notebook kernels run in their own sessions), and the repository moves on
+- the output of the stages is streamed line by line, prefixed with the env name
+- the start and end of every stage are reported as metrics events (stage_start, stage_done)
+- SIGINT/SIGTERM cancel the run: the running stages are terminated and no other repository is started
+- with a WorkerPoolSizer, envs join and leave the pool during the run (see worker_pool.py)
+"""
+
+import asyncio
+import os
+import signal
+import time
+from collections import deque
+from metrics import emitEvent
+from kernel_limits import findDescendants
+
+COPY = 'copy'
+INSTALL = 'install'
+EXECUTE = 'execute'
+DEFAULT_STAGE_TIMEOUTS = {COPY: 1800, INSTALL: 3600, EXECUTE: None}
+KILL_GRACE_SECONDS = 10
+READ_CHUNK_BYTES = 1 << 16
+
+_running_stages = {}    # env -> process of its running stage
+
+
+def _signalAll(pids, signum):
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except (ProcessLookupError, PermissionError):
+            continue
+
+
+async def terminateProcessTree(process):
+    """SIGTERM a stage and every process below it, then SIGKILL what is left after the grace period"""
+    pids = [process.pid] + findDescendants(process.pid)
+    _signalAll(pids, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), KILL_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        pass
+    _signalAll(pids, signal.SIGKILL)
+    await process.wait()
+
+
+async def _streamOutput(stream, prefix):
+    """Print the output of a stage line by line as it arrives; long lines are not held back"""
+    pending = b''
+    while True:
+        chunk = await stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        *lines, pending = (pending + chunk).split(b'\n')
+        for line in lines:
+            print(f"{prefix} {line.decode('utf-8', errors='replace')}", flush=True)
+    if pending:
+        print(f"{prefix} {pending.decode('utf-8', errors='replace')}", flush=True)
+
+
+async def runStage(command, stage, env, timeout=None, cwd=None, **fields):
+    """
+    Run one stage of a repository as a bash command, streaming its output
+    :param command: the bash command line
+    :param stage: COPY, INSTALL or EXECUTE
+    :param env: the env running the stage, used as the output prefix
+    :param timeout: seconds the stage may run; None for no limit
+    :param fields: extra values of the stage events, e.g. repo=...
+    :return: the return code of the command, None if it timed out
+    """
+    emitEvent('stage_start', env=env, stage=stage, **fields)
+    start = time.time()
+    process = await asyncio.create_subprocess_exec('/bin/bash', '-c', command, cwd=cwd,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                                                   env={**os.environ, 'PYTHONUNBUFFERED': '1'})
+    reader = asyncio.ensure_future(_streamOutput(process.stdout, f'[{env}]'))
+    _running_stages[env] = process
+    returncode = None
+    try:
+        returncode = await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        print(f'>> [{env}] Stage {stage} timed out after {timeout}s, terminating it')
+        await terminateProcessTree(process)
+    except asyncio.CancelledError:
+        await terminateProcessTree(process)
+        raise
+    finally:
+        _running_stages.pop(env, None)
+        # Orphaned grandchildren may keep the pipe open: do not wait for them
+        await asyncio.wait([reader], timeout=5)
+        reader.cancel()
+        emitEvent('stage_done', env=env, stage=stage, duration=time.time() - start, returncode=returncode,
+                  timed_out=returncode is None, **fields)
+    return returncode
+
+
+class EnvPool:
+    """Env workers sharing one queue of repositories; the envs taking new repositories can change during the run"""
+    def __init__(self, tasks, process_repo):
+        self.queue = deque(tasks)
+        self.process_repo = process_repo
+        self.active = []
+        self.workers = {}
+
+    def scaleTo(self, envs):
+        """Let envs take new repositories; the envs left out finish their current repository and stop"""
+        self.active = list(envs)
+        for env in self.active:
+            if env not in self.workers:
+                self.workers[env] = asyncio.ensure_future(self._envWorker(env))
+
+    def runningStages(self):
+        """dict {env: process of its running stage}, for the envs of this pool"""
+        return {env: process for env, process in _running_stages.items() if env in self.workers}
+
+    async def _envWorker(self, env):
+        try:
+            while self.queue and env in self.active:
+                config = self.queue.popleft()
+                try:
+                    await self.process_repo(env, config)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"Error in processing the repository {config.get('repo_path')} on {env}, Error: {e}")
+                    print('>>> EXITING THE PROCESSING OF THE REPOSITORY DUE TO ERROR <<<')
+        finally:
+            self.workers.pop(env, None)
+
+    async def join(self):
+        # Workers started by a resize while waiting are waited for too
+        while self.workers:
+            await asyncio.gather(*list(self.workers.values()), return_exceptions=True)
+
+    def cancel(self):
+        self.queue.clear()
+        for worker in list(self.workers.values()):
+            worker.cancel()
+
+
+async def superviseEnvs(envs, tasks, process_repo, sizer=None):
+    """
+    Process the tasks on the envs, each env taking the next task as soon as it is free
+    :param envs: names of the envs to start with; one task runs on each env at a time
+    :param tasks: repository configs, in dispatch order
+    :param process_repo: coroutine function (env, config) processing one repository
+    :param sizer: WorkerPoolSizer resizing the pool during the run, None for a fixed pool
+    :return: False if the run was cancelled
+    """
+    pool = EnvPool(tasks, process_repo)
+    pool.scaleTo(envs)
+    autoscaler = asyncio.ensure_future(sizer.autoscale(pool)) if sizer is not None else None
+    cancelled = False
+
+    def cancel(signum):
+        nonlocal cancelled
+        print(f'>> Received {signal.Signals(signum).name}, terminating the running stages ({len(pool.queue)} repos not started)')
+        cancelled = True
+        pool.cancel()
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, cancel, signum)
+    try:
+        await pool.join()
+    finally:
+        if autoscaler is not None:
+            autoscaler.cancel()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+    return not cancelled
+
+
+def runSupervisor(envs, tasks, process_repo, sizer=None):
+    """Blocking entry point of superviseEnvs"""
+    return asyncio.run(superviseEnvs(envs, tasks, process_repo, sizer))
@@ -0,0 +1,69 @@
+"""
+Wall-clock budget of a notebook over all its executions: the initial run and every re-run of the fix loop.
+Per-cell timeouts are set through nbclient's timeout_func:
+- a cell that already completed in a previous execution (same source) gets a few times its observed duration
+- any other cell gets the per-cell cap (ExecuteNoteBook.CELL_TIMEOUT)
+and no cell may run past the end of the budget. Once the budget is spent, executions stop with the
+status `BudgetExhausted`, so the worst-case cost of a notebook is bounded by the budget.
+"""
+
+import hashlib
+import time
+
+DEFAULT_NOTEBOOK_BUDGET = 3600  # seconds per notebook, over all fix iterations
+BUDGET_EXHAUSTED = 'BudgetExhausted'
+MIN_CELL_TIMEOUT = 30           # seconds given to a known cell, however fast it was
+OBSERVED_FACTOR = 3             # a known cell may take up to this many times its observed duration
+
+
+def cellSourceHash(source):
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+class ExecutionBudget:
+    def __init__(self, total_seconds=DEFAULT_NOTEBOOK_BUDGET):
+        """
+        :param total_seconds: wall-clock allowance of the notebook over all its executions
+        """
+        self.total_seconds = total_seconds
+        self.start_time = time.time()
+        self.deadline = self.start_time + total_seconds
+        self.observed = {}  # cell source hash -> longest wall time of a successful run
+        self.last_timeout_from_budget = False
+
+    def remaining(self):
+        return self.deadline - time.time()
+
+    def isExhausted(self):
+        return self.remaining() <= 0
+
+    def cellTimeout(self, cell, max_cell_timeout):
+        """
+        Timeout in seconds of the next execution of the cell
+        :param cell: the notebook cell, as passed to nbclient's timeout_func
+        :param max_cell_timeout: cap of the timeout of a single cell
+        """
+        timeout = max_cell_timeout
+        observed = self.observed.get(cellSourceHash(cell.source))
+        if observed is not None:
+            timeout = min(timeout, max(observed * OBSERVED_FACTOR, MIN_CELL_TIMEOUT))
+        remaining = self.remaining()
+        # Remember whether a timeout of this cell would mean the budget is spent
+        self.last_timeout_from_budget = remaining <= timeout
+        # nbclient treats 0 as no timeout, so always leave at least one second
+        return max(int(min(timeout, remaining)), 1)
+
+    def observe(self, profiler):
+        """Learn the durations of the cells that completed in an execution profiled by CellProfiler"""
+        for cell in profiler.cells:
+            if cell.get('error') or cell.get('source_hash') is None:
+                continue
+            previous = self.observed.get(cell['source_hash'], 0)
+            self.observed[cell['source_hash']] = max(previous, cell['wall_time'])
+
+    def summary(self):
+        return {
+            'budget': self.total_seconds,
+            'used': round(time.time() - self.start_time, 3),
+            'exhausted': self.isExhausted(),
+        }
@@ -0,0 +1,185 @@
+"""
+Per-cell execution profile of a notebook run: wall time and kernel peak RSS of each code cell,
+and the kernel startup time. The profiler is plugged into papermill/nbclient through the
+on_notebook_start / on_cell_execute / on_cell_executed / on_cell_error hooks.
+Memory is read from /proc, so peak RSS is only available on Linux.
+"""
+
+import os
+import time
+from exec_budget import cellSourceHash
+
+
+def findKernelPid(parent_pid=None):
+    """Find the ipykernel process started by this process, by scanning /proc"""
+    parent_pid = parent_pid or os.getpid()
+    if not os.path.isdir('/proc'):
+        return None
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                # The command may contain spaces, the fields after it are space separated
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            if ppid != parent_pid:
+                continue
+            with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                cmdline = f.read()
+            if b'kernel' in cmdline:
+                return int(entry)
+        except (OSError, IndexError, ValueError):
+            continue
+    return None
+
+
+def readProcStatusKB(pid, field):
+    """Read a memory field (VmHWM, VmRSS) of /proc/<pid>/status, in KB"""
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def resetPeakRSS(pid):
+    """Reset VmHWM of the process so that the next reading is the peak of the current cell"""
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class CellProfiler:
+    def __init__(self, on_kernel_start=None):
+        """
+        :param on_kernel_start: optional function called with the kernel pid once the kernel is started
+        """
+        self.on_kernel_start = on_kernel_start
+        self.start_time = time.time()
+        self.end_time = None
+        self.kernel_startup_time = None
+        self.kernel_pid = None
+        self.cells = []
+        self._current = None
+
+    def hooks(self):
+        """The nbclient hooks to pass to papermill.execute_notebook"""
+        return {
+            'on_notebook_start': self.onNotebookStart,
+            'on_cell_execute': self.onCellExecute,
+            'on_cell_executed': self.onCellExecuted,
+            'on_cell_error': self.onCellError,
+        }
+
+    def onNotebookStart(self, notebook=None, **kwargs):
+        self.kernel_startup_time = time.time() - self.start_time
+        self.kernel_pid = findKernelPid()
+        if self.on_kernel_start is not None:
+            self.on_kernel_start(self.kernel_pid)
+
+    def onCellExecute(self, cell=None, cell_index=None, **kwargs):
+        self._closeCell()
+        if self.kernel_pid is not None:
+            resetPeakRSS(self.kernel_pid)
+        # Code cells are numbered like the execution counts used in err_cell_num
+        self._current = {'cell': len(self.cells) + 1, 'cell_index': cell_index, 'start': time.time(),
+                         'source_hash': cellSourceHash(cell.source) if cell is not None else None}
+
+    def onCellExecuted(self, cell=None, cell_index=None, execute_reply=None, **kwargs):
+        # nbclient calls on_cell_error after this hook, once the cell is closed: the error is read from the reply
+        error = execute_reply is not None and execute_reply.get('content', {}).get('status') == 'error'
+        self._closeCell(error=error)
+
+    def onCellError(self, cell=None, cell_index=None, **kwargs):
+        self._closeCell(error=True)
+
+    def _closeCell(self, error=False):
+        if self._current is None:
+            return
+        current = self._current
+        self._current = None
+        current['wall_time'] = time.time() - current.pop('start')
+        current['peak_rss_mb'] = None
+        if self.kernel_pid is not None:
+            peak = readProcStatusKB(self.kernel_pid, 'VmHWM')
+            if peak is not None:
+                current['peak_rss_mb'] = round(peak / 1024, 1)
+        if error:
+            current['error'] = True
+        self.cells.append(current)
+
+    def currentCellNumber(self):
+        """Number of the code cell running, or of the last cell that ran"""
+        if self._current is not None:
+            return self._current['cell']
+        return len(self.cells)
+
+    def finish(self):
+        """Close the profile; a cell still running (timeout, dead kernel) is closed now"""
+        self._closeCell(error=True)
+        self.end_time = time.time()
+
+    def summary(self, top_n=3):
+        """
+        Compact summary of the run
+        :return: dict with total and startup times, the slowest cells, peak RSS and the per-cell times
+        """
+        if self.end_time is None:
+            self.finish()
+        slowest = sorted(self.cells, key=lambda c: c['wall_time'], reverse=True)[:top_n]
+        peaks = [c['peak_rss_mb'] for c in self.cells if c['peak_rss_mb'] is not None]
+        return {
+            'total_exec_time': round(self.end_time - self.start_time, 3),
+            'kernel_startup_time': round(self.kernel_startup_time, 3) if self.kernel_startup_time is not None else None,
+            'cells_executed': len(self.cells),
+            'slowest_cells': [{'cell': c['cell'], 'wall_time': round(c['wall_time'], 3), 'peak_rss_mb': c['peak_rss_mb']} for c in slowest],
+            'peak_rss_mb': max(peaks) if peaks else None,
+            'cell_times': [round(c['wall_time'], 3) for c in self.cells],
+        }
+
+
+def summarizeExecutionProfiles(all_exec_results, top_n=3):
+    """
+    Combine the profiles of all executions of a notebook across the fix iterations
+    - total_execution_time: wall time of all executions
+    - kernel_startup_time: time spent starting kernels
+    - rerun_prefix_time: time spent re-running cells that already succeeded in the previous execution
+    - slowest_cells: slowest cells over all executions, with the execution they belong to
+    """
+    profiles = [r.get('profile') for r in all_exec_results]
+    if not any(profiles):
+        return None
+
+    total_time = 0.0
+    startup_time = 0.0
+    rerun_prefix_time = 0.0
+    peak_rss = None
+    cells = []
+    previous_ok_cells = 0
+    for run, (exec_r, profile) in enumerate(zip(all_exec_results, profiles)):
+        if profile:
+            total_time += profile['total_exec_time']
+            startup_time += profile['kernel_startup_time'] or 0.0
+            rerun_prefix_time += sum(profile['cell_times'][:previous_ok_cells])
+            if profile['peak_rss_mb'] is not None:
+                peak_rss = max(peak_rss or 0, profile['peak_rss_mb'])
+            cells += [{**c, 'execution': run} for c in profile['slowest_cells']]
+        if exec_r['status'] == 'executable':
+            previous_ok_cells = exec_r['err_cell_num']
+        else:
+            previous_ok_cells = max(exec_r['err_cell_num'] - 1, 0)
+
+    return {
+        'executions': len(all_exec_results),
+        'total_execution_time': round(total_time, 3),
+        'kernel_startup_time': round(startup_time, 3),
+        'rerun_prefix_time': round(rerun_prefix_time, 3),
+        'peak_rss_mb': peak_rss,
+        'slowest_cells': sorted(cells, key=lambda c: c['wall_time'], reverse=True)[:top_n],
+    }
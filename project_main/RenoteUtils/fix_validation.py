@@ -0,0 +1,218 @@
+"""
+Validation of the fixes generated by the LLM, before the notebook is executed again.
+A rejected fix costs one more LLM call instead of a full notebook execution:
+- a definition cell (FixNameErrorLLM) must parse, define the undefined variables in the module scope of the
+  cell (not only inside a function or class), and use no name that is neither defined in the cell,
+  defined earlier in the notebook nor a builtin
+- a generated input file (FixFileNotFound) must parse with the reader the notebook uses for it
+  (pandas, json, numpy, yaml), or with the parser of its extension when the reader is not found
+The reason of a rejection is sent back to the model with the next attempt, up to MAX_FIX_ATTEMPTS attempts.
+"""
+
+import ast
+import csv
+import io
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+from ast_visit import ASTNodeVisitor
+from nb_utils import StaticAST, getCellSourceCode, IPYTHON_NAMES
+
+MAX_FIX_ATTEMPTS = 3
+# Nodes whose body has its own scope: the names bound inside do not reach the module
+_NESTED_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda,
+                  ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+
+def fixFeedback(previous, reason):
+    """Text appended to the prompt of the next attempt after a rejected answer"""
+    return f"\n\nYour previous answer was rejected: {reason}\nPrevious answer:\n```\n{previous}```\nCorrect it."
+
+
+def definedNamesBefore(nb_path, cell_number, static_ast=None):
+    """
+    Names defined in the code cells before cell_number (numbered as in StaticAST), None if the notebook cannot be analyzed
+    :param static_ast: the StaticAST of the notebook, already analyzed
+    """
+    if static_ast is None:
+        static_ast = StaticAST(nb_path)
+        if not static_ast.analyze_notebook():
+            return None
+    return {var for cell, defs in static_ast.variable_defs.items() if cell < cell_number for var in defs}
+
+
+def codeDefinitions(code):
+    """Names a code cell defines, in any scope; empty if it does not parse"""
+    try:
+        tree = ast.parse(getCellSourceCode({'source': code}))
+    except SyntaxError:
+        return set()
+    def_list, _ = ASTNodeVisitor().analyze(tree)
+    return {name.split('.')[0] for names in def_list.values() for name in names}
+
+
+def moduleLevelNames(tree):
+    """
+    Names a module binds in its own scope, including inside if, for, while, with and try blocks
+    (ASTNodeVisitor numbers those blocks as nested scopes)
+    """
+    names = set()
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update(alias.asname or alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+        if not isinstance(node, _NESTED_SCOPES):
+            nodes.extend(ast.iter_child_nodes(node))
+    return names
+
+
+def checkDefinitionCode(code, undefined_vars, defined_names=None):
+    """
+    Check a generated code cell before it is inserted in the notebook
+    :param undefined_vars: names the cell must define
+    :param defined_names: names defined before the cell runs; None to skip the check of the names it uses
+    :return: None if the cell is valid, else the reason of the rejection
+    """
+    source = getCellSourceCode({'source': code})
+    if not source.strip():
+        return 'The code is empty.'
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        return f'The code is not valid Python: {e.msg} (line {e.lineno}).'
+
+    module_names = moduleLevelNames(tree)
+    missing = [var for var in undefined_vars if var not in module_names]
+    if missing:
+        return f"The code does not define {', '.join(missing)} outside of a function or class."
+    if defined_names is None:
+        return None
+    _, use_list = ASTNodeVisitor().analyze(tree)
+    cell_defs = codeDefinitions(code)
+    uses = {name for names in use_list.values() for name in names}
+    undefined = sorted(uses - cell_defs - set(defined_names) - IPYTHON_NAMES)
+    if undefined:
+        return f"The code uses names that are not defined in the notebook: {', '.join(undefined)}."
+    return None
+
+
+def findFileReader(nb_source, missing_path):
+    """Name of the function the notebook reads missing_path with (e.g. read_csv), None if not found"""
+    name = re.escape(os.path.basename(missing_path))
+    match = re.search(rf"([A-Za-z_][\w.]*)\(\s*[rbfuRBFU]*['\"][^'\"\n]*{name}['\"]", nb_source)
+    return match.group(1).split('.')[-1] if match else None
+
+
+def _parseJson(content):
+    try:
+        json.loads(content)
+    except ValueError:
+        # JSON lines
+        for line in content.splitlines():
+            if line.strip():
+                json.loads(line)
+
+
+def _parseCsv(content, delimiter=None):
+    if delimiter is None:
+        try:
+            delimiter = csv.Sniffer().sniff(content[:4096]).delimiter
+        except csv.Error:
+            # A single column
+            delimiter = ','
+    rows = [row for row in csv.reader(io.StringIO(content), delimiter=delimiter) if row]
+    if len({len(row) for row in rows}) > 1:
+        raise ValueError('the rows do not have the same number of columns')
+
+
+def _parsePandas(content, reader):
+    try:
+        import pandas as pd
+    except ImportError:
+        return _parseCsv(content, '\t' if reader == 'read_table' else None) if reader != 'read_json' else _parseJson(content)
+    if reader == 'read_json':
+        try:
+            pd.read_json(io.StringIO(content))
+        except ValueError:
+            pd.read_json(io.StringIO(content), lines=True)
+    else:
+        getattr(pd, reader)(io.StringIO(content))
+
+
+def _parseNumpy(content, reader):
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+    error = None
+    for delimiter in (None, ',', '\t', ';'):
+        try:
+            getattr(np, reader)(io.StringIO(content), delimiter=delimiter)
+            return None
+        except ValueError as e:
+            error = error or e
+    raise error
+
+
+def _parseYaml(content):
+    try:
+        import yaml
+    except ImportError:
+        return None
+    yaml.safe_load(content)
+
+
+_READERS = {
+    'read_csv': lambda content: _parsePandas(content, 'read_csv'),
+    'read_table': lambda content: _parsePandas(content, 'read_table'),
+    'read_json': lambda content: _parsePandas(content, 'read_json'),
+    'loadtxt': lambda content: _parseNumpy(content, 'loadtxt'),
+    'genfromtxt': lambda content: _parseNumpy(content, 'genfromtxt'),
+    'load': _parseJson,
+    'loads': _parseJson,
+    'safe_load': _parseYaml,
+}
+_EXTENSION_PARSERS = {
+    '.json': _parseJson,
+    '.jsonl': _parseJson,
+    '.csv': lambda content: _parseCsv(content),
+    '.tsv': lambda content: _parseCsv(content, '\t'),
+    '.yaml': _parseYaml,
+    '.yml': _parseYaml,
+    '.xml': ET.fromstring,
+}
+
+
+def checkDataFile(content, missing_path, nb_source=''):
+    """
+    Check a generated input file before it is written
+    :param nb_source: the Python source of the notebook, used to find the function reading the file
+    :return: None if the file is valid, else the reason of the rejection
+    """
+    if not content.strip():
+        return 'The file is empty.'
+    reader = findFileReader(nb_source, missing_path)
+    extension = os.path.splitext(missing_path)[1].lower()
+    if reader in _READERS and not (reader in ('load', 'loads') and extension not in ('.json', '.jsonl')):
+        parse, parser_name = _READERS[reader], reader
+    elif extension in _EXTENSION_PARSERS:
+        parse, parser_name = _EXTENSION_PARSERS[extension], f'a {extension} parser'
+    else:
+        return None
+    try:
+        parse(content)
+    except Exception as e:
+        return f'The file cannot be read with {parser_name}: {e}'
+    return None
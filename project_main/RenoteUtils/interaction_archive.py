@@ -0,0 +1,110 @@
+"""
+Record and replay of the slow and non-deterministic interactions of the fix loop: LLM calls,
+pip installs of missing modules and notebook executions.
+In record mode every interaction is stored in a DiskCache archive; in replay mode the recorded
+result is served back instead, so the fix loop of process_nb.py can be re-evaluated without a
+model server, package index or kernel.
+
+Interactions are keyed by the notebook being processed (archiveScope), their kind, their input
+(the prompt, the module name, the hash of the executed code cells) and their occurrence, so an
+input seen twice (e.g. the same notebook executed before and after a pip install) replays in order.
+"""
+
+import builtins
+import hashlib
+import threading
+from contextlib import contextmanager
+from diskcache import Index
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+_archive = None
+_mode = None
+_context = threading.local()
+
+
+class ReplayMissError(KeyError):
+    """The interaction was not recorded, so it cannot be replayed"""
+
+
+def enableArchive(archive_path, mode):
+    """
+    Start recording to, or replaying from, the archive
+    :param archive_path: path to the archive [DiskCache], shared by all workers
+    :param mode: `record` or `replay`
+    """
+    global _archive, _mode
+    if not archive_path or not mode:
+        return
+    if mode not in (RECORD, REPLAY):
+        raise ValueError(f"Unknown archive mode {mode}, expected `{RECORD}` or `{REPLAY}`")
+    _archive = Index(archive_path)
+    _mode = mode
+
+
+def getArchiveMode():
+    return _mode
+
+
+def isReplaying():
+    return _mode == REPLAY
+
+
+def _currentScope():
+    if not hasattr(_context, 'scope'):
+        _context.scope = ''
+        _context.counts = {}
+    return _context
+
+
+@contextmanager
+def archiveScope(scope):
+    """Key the interactions inside this block by scope (the notebook identity), with fresh occurrence counts"""
+    context = _currentScope()
+    previous = (context.scope, context.counts)
+    context.scope, context.counts = scope, {}
+    try:
+        yield
+    finally:
+        context.scope, context.counts = previous
+
+
+def _interactionKey(kind, key):
+    context = _currentScope()
+    digest = hashlib.sha256(str(key).encode('utf-8')).hexdigest()
+    occurrence = context.counts.get((kind, digest), 0)
+    context.counts[(kind, digest)] = occurrence + 1
+    return f"{context.scope}|{kind}|{digest}|{occurrence}"
+
+
+def archived(kind, key, compute):
+    """
+    Run compute() and return its result, recording it in record mode, or return the recorded result in replay mode
+    :param kind: `llm`, `pip` or `exec`
+    :param key: the input of the interaction
+    :param compute: function without arguments doing the interaction
+    """
+    if _mode is None:
+        return compute()
+
+    archive_key = _interactionKey(kind, key)
+    if _mode == REPLAY:
+        if archive_key not in _archive:
+            raise ReplayMissError(f"No recorded {kind} interaction for {archive_key}")
+        record = _archive[archive_key]
+        if 'error' in record:
+            # Re-raise recorded errors with their builtin type when possible, so statuses match the recorded run
+            error_type = getattr(builtins, record['error_type'], None)
+            if not (isinstance(error_type, type) and issubclass(error_type, Exception)):
+                error_type = RuntimeError
+            raise error_type(record['error'])
+        return record['result']
+
+    try:
+        result = compute()
+    except Exception as e:
+        _archive[archive_key] = {'error': str(e), 'error_type': type(e).__name__}
+        raise
+    _archive[archive_key] = {'result': result}
+    return result
@@ -0,0 +1,266 @@
+"""
+Resource limits of the notebook kernels, so one runaway notebook cannot starve the other envs.
+The limits are applied to the kernel as soon as it is started (on_notebook_start), before any cell runs,
+and are inherited by the processes it spawns:
+- memory: memory.max of a cgroup v2 when a delegated cgroup root is given, otherwise the monitor kills the
+  kernel when the RSS of the kernel and its descendants goes above the limit. The RSS is sampled, so a fast
+  allocation can overshoot the limit between two samples. Address space is not limited: torch, jax,
+  TensorFlow and malloc arenas reserve far more of it than they use
+- CPU time: RLIMIT_CPU of the kernel
+- processes: pids.max of the cgroup, otherwise the monitor kills the kernel when it has too many descendants
+- scratch disk: RLIMIT_FSIZE, the largest file the kernel may write
+A monitor thread samples the kernel and its descendants to record peak usage. Limit hits are reported
+with their own status (MemoryLimitExceeded, CPULimitExceeded, ProcessLimitExceeded, DiskQuotaExceeded).
+"""
+
+import os
+import resource
+import signal
+import threading
+from exec_profile import readProcStatusKB
+
+MEMORY_LIMIT_EXCEEDED = 'MemoryLimitExceeded'
+CPU_LIMIT_EXCEEDED = 'CPULimitExceeded'
+PROCESS_LIMIT_EXCEEDED = 'ProcessLimitExceeded'
+DISK_QUOTA_EXCEEDED = 'DiskQuotaExceeded'
+
+NEAR_LIMIT = 0.9  # a kernel that died above this fraction of a limit is taken to have hit it
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def kernelLimitsFromConfig(limits):
+    """
+    :param limits: dict with any of memory_mb, cpu_seconds, max_procs, max_file_mb, cgroup_root
+    :return: the KernelLimits, None if no limit is set
+    """
+    limits = KernelLimits(**limits) if limits else None
+    return limits if limits is not None and limits.isEnabled() else None
+
+
+def findDescendants(pid):
+    """Pids of all processes below pid, from /proc/<pid>/task/<tid>/children"""
+    descendants = []
+    pending = [pid]
+    while pending:
+        parent = pending.pop()
+        try:
+            tids = os.listdir(f'/proc/{parent}/task')
+        except OSError:
+            continue
+        for tid in tids:
+            try:
+                with open(f'/proc/{parent}/task/{tid}/children', 'r') as f:
+                    children = [int(c) for c in f.read().split()]
+            except (OSError, ValueError):
+                continue
+            descendants += children
+            pending += children
+    return descendants
+
+
+def readCPUSeconds(pid):
+    """CPU time of the process and of its waited-for children, in seconds"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return sum(int(v) for v in fields[11:15]) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class KernelLimits:
+    def __init__(self, memory_mb=None, cpu_seconds=None, max_procs=None, max_file_mb=None, cgroup_root=None):
+        """
+        :param memory_mb: address space of the kernel (and memory of its cgroup) in MB
+        :param cpu_seconds: CPU time of the kernel in seconds
+        :param max_procs: number of processes the kernel may have running below it
+        :param max_file_mb: size of the largest file the kernel may write, in MB
+        :param cgroup_root: a cgroup v2 directory delegated to this user; each kernel gets a child cgroup in it
+        """
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.max_procs = max_procs
+        self.max_file_mb = max_file_mb
+        self.cgroup_root = cgroup_root
+
+    def isEnabled(self):
+        return any(v for v in (self.memory_mb, self.cpu_seconds, self.max_procs, self.max_file_mb))
+
+    def asDict(self):
+        return {'memory_mb': self.memory_mb, 'cpu_seconds': self.cpu_seconds, 'max_procs': self.max_procs,
+                'max_file_mb': self.max_file_mb}
+
+
+class KernelGuard:
+    """Applies the limits to one kernel, monitors its usage and classifies its failures"""
+    def __init__(self, limits, sample_interval=0.5):
+        self.limits = limits
+        self.sample_interval = sample_interval
+        self.pid = None
+        self.cgroup = None
+        self.killed_reason = None
+        self.peak_rss_mb = 0.0
+        self.peak_procs = 0
+        self.cpu_seconds = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def onKernelStart(self, pid):
+        if pid is None:
+            print('>> Kernel process not found, resource limits not applied')
+            return
+        self.pid = pid
+        if self.limits.cgroup_root:
+            self._applyCgroup()
+        self._applyRLimits()
+        self._thread = threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+
+    def _applyRLimits(self):
+        limits = self.limits
+        rlimits = []
+        if limits.max_file_mb:
+            rlimits.append((resource.RLIMIT_FSIZE, limits.max_file_mb * 1024 * 1024))
+        for rlimit, value in rlimits:
+            try:
+                resource.prlimit(self.pid, rlimit, (value, value))
+            except (OSError, ValueError) as e:
+                print(f'>> Cannot set resource limit {rlimit} of the kernel: {e}')
+        if limits.cpu_seconds:
+            # SIGXCPU at the soft limit, SIGKILL a few seconds later
+            try:
+                resource.prlimit(self.pid, resource.RLIMIT_CPU, (limits.cpu_seconds, limits.cpu_seconds + 5))
+            except (OSError, ValueError) as e:
+                print(f'>> Cannot set the CPU time limit of the kernel: {e}')
+
+    def _applyCgroup(self):
+        cgroup = os.path.join(self.limits.cgroup_root, f'renote-kernel-{self.pid}')
+        try:
+            os.makedirs(cgroup, exist_ok=True)
+            if self.limits.memory_mb:
+                self._writeCgroup(cgroup, 'memory.max', self.limits.memory_mb * 1024 * 1024)
+                self._writeCgroup(cgroup, 'memory.swap.max', 0)
+            if self.limits.max_procs:
+                # pids.max counts threads, so leave room for the threads of the kernel itself
+                kernel_threads = readProcStatusKB(self.pid, 'Threads') or 0
+                self._writeCgroup(cgroup, 'pids.max', self.limits.max_procs + kernel_threads)
+            self._writeCgroup(cgroup, 'cgroup.procs', self.pid)
+            self.cgroup = cgroup
+        except OSError as e:
+            print(f'>> Cannot use cgroup {cgroup}, falling back to rlimits: {e}')
+
+    @staticmethod
+    def _writeCgroup(cgroup, name, value):
+        with open(os.path.join(cgroup, name), 'w') as f:
+            f.write(str(value))
+
+    def _readCgroupEvents(self, name):
+        try:
+            with open(os.path.join(self.cgroup, name), 'r') as f:
+                return {k: int(v) for k, v in (line.split() for line in f if line.strip())}
+        except (OSError, ValueError):
+            return {}
+
+    def _monitor(self):
+        while True:
+            if not os.path.exists(f'/proc/{self.pid}'):
+                return
+            descendants = findDescendants(self.pid)
+            rss_kb = sum(readProcStatusKB(p, 'VmRSS') or 0 for p in [self.pid] + descendants)
+            self.peak_rss_mb = max(self.peak_rss_mb, rss_kb / 1024)
+            self.peak_procs = max(self.peak_procs, len(descendants))
+            cpu = readCPUSeconds(self.pid)
+            if cpu is not None:
+                self.cpu_seconds = cpu
+            if self.limits.memory_mb and self.cgroup is None and rss_kb / 1024 > self.limits.memory_mb:
+                print(f'>> Kernel uses {rss_kb / 1024:.0f} MB, above the limit of {self.limits.memory_mb} MB, killing it')
+                self._kill(descendants, MEMORY_LIMIT_EXCEEDED)
+                return
+            if self.limits.max_procs and self.cgroup is None and len(descendants) > self.limits.max_procs:
+                print(f'>> Kernel has {len(descendants)} processes, above the limit of {self.limits.max_procs}, killing it')
+                self._kill(descendants, PROCESS_LIMIT_EXCEEDED)
+                return
+            if self._stop.wait(self.sample_interval):
+                return
+
+    def _kill(self, descendants, reason):
+        self.killed_reason = reason
+        for pid in descendants + [self.pid]:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.cgroup is not None:
+            peak = self._readCgroupValue('memory.peak')
+            if peak is not None:
+                self.peak_rss_mb = max(self.peak_rss_mb, peak / 1024 / 1024)
+
+    def _readCgroupValue(self, name):
+        try:
+            with open(os.path.join(self.cgroup, name), 'r') as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def removeCgroup(self):
+        """Remove the cgroup of the kernel, once the kernel has exited"""
+        if self.cgroup is not None:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError:
+                pass
+
+    def classifyError(self, err):
+        """
+        Status of an execution error caused by a limit, or None if the error is not a limit hit
+        :param err: the error message of the execution
+        """
+        limits = self.limits
+        if self.killed_reason is not None:
+            return self.killed_reason
+        if self.cgroup is not None:
+            if self._readCgroupEvents('memory.events').get('oom_kill', 0) > 0:
+                return MEMORY_LIMIT_EXCEEDED
+            if self._readCgroupEvents('pids.events').get('max', 0) > 0:
+                return PROCESS_LIMIT_EXCEEDED
+        if limits.memory_mb and 'MemoryError' in err and self.peak_rss_mb >= NEAR_LIMIT * limits.memory_mb:
+            return MEMORY_LIMIT_EXCEEDED
+        if limits.max_file_mb and ('File too large' in err or 'Errno 27' in err):
+            return DISK_QUOTA_EXCEEDED
+        if limits.max_procs and ("Resource temporarily unavailable" in err or "can't start new thread" in err):
+            return PROCESS_LIMIT_EXCEEDED
+        if 'Kernel died' in err or 'DeadKernelError' in err:
+            if limits.cpu_seconds and self.cpu_seconds >= NEAR_LIMIT * limits.cpu_seconds:
+                return CPU_LIMIT_EXCEEDED
+            if limits.memory_mb and self.peak_rss_mb >= NEAR_LIMIT * limits.memory_mb:
+                return MEMORY_LIMIT_EXCEEDED
+        return None
+
+    def usage(self):
+        return {
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+            'cpu_seconds': round(self.cpu_seconds, 2),
+            'peak_procs': self.peak_procs,
+            'cgroup': self.cgroup is not None,
+        }
+
+
+def summarizeResourceUsage(all_exec_results, limits=None):
+    """
+    Peak resource usage over all executions of a notebook, with the limits in force
+    :param limits: the KernelLimits of the executions
+    """
+    usages = [r['resource_usage'] for r in all_exec_results if r.get('resource_usage')]
+    if not usages:
+        return None
+    return {
+        'peak_rss_mb': max(u['peak_rss_mb'] for u in usages),
+        'cpu_seconds': round(sum(u['cpu_seconds'] for u in usages), 2),
+        'peak_procs': max(u['peak_procs'] for u in usages),
+        'limits': limits.asDict() if limits is not None else None,
+    }
@@ -0,0 +1,115 @@
+"""
+Lean execution mode: a papermill engine that does not keep the outputs of the notebook.
+With output_path=None the executed notebook is thrown away, yet papermill/nbclient still collect every
+stream, image and rich output in memory. The lean engine drops them as the kernel messages arrive:
+- error outputs are kept, papermill builds the execution error from them
+- stdout is kept as one stream output per cell holding its last STDOUT_TAIL_CHARS characters
+- display data, execute results and stderr are discarded
+It also skips papermill's per-cell timestamps and save calls, and starts the kernels with the
+non-interactive Agg matplotlib backend, so figures are not rendered and sent to the client at all.
+"""
+
+import os
+from contextlib import contextmanager
+from papermill.clientwrap import PapermillNotebookClient
+from papermill.engines import NBClientEngine, NotebookExecutionManager, papermill_engines
+from papermill.log import logger
+from papermill.utils import merge_kwargs, remove_args
+
+LEAN_ENGINE = 'renote_lean'
+STDOUT_TAIL_CHARS = 2000
+
+def executionEngine(lean):
+    """The papermill engine name to execute notebooks with"""
+    return LEAN_ENGINE if lean else None
+
+
+@contextmanager
+def leanKernelEnvironment(lean):
+    """Start the kernels inside this block with the Agg matplotlib backend, if lean"""
+    if not lean or 'MPLBACKEND' in os.environ:
+        yield
+        return
+    os.environ['MPLBACKEND'] = 'agg'
+    try:
+        yield
+    finally:
+        os.environ.pop('MPLBACKEND', None)
+
+
+class LeanExecutionManager(NotebookExecutionManager):
+    """Only keeps the cell state papermill needs to raise execution errors"""
+    def notebook_start(self, **kwargs):
+        self.set_timer()
+        self.nb.metadata.papermill['exception'] = None
+        for cell in self.nb.cells:
+            cell.metadata.papermill = dict(exception=None, status=self.PENDING)
+            if cell.get("cell_type") == "code":
+                cell.execution_count = None
+                cell.outputs = []
+
+    def cell_start(self, cell, cell_index=None, **kwargs):
+        cell.metadata.papermill['exception'] = False
+
+    def cell_complete(self, cell, cell_index=None, **kwargs):
+        pass
+
+    def notebook_complete(self, **kwargs):
+        self.cleanup_pbar()
+
+
+class LeanNotebookClient(PapermillNotebookClient):
+    """Drops all outputs but errors and a tail of stdout as they are received"""
+    def output(self, outs, msg, display_id, cell_index):
+        msg_type = msg["msg_type"]
+        if msg_type == "error":
+            return super().output(outs, msg, None, cell_index)
+        if msg_type != "stream" or msg["content"].get("name") != "stdout":
+            return None
+        if self.output_hook_stack[msg["parent_header"].get("msg_id")]:
+            # Output widgets capture their own outputs
+            return None
+
+        text = msg["content"].get("text", "")
+        tail = next((o for o in outs if o.get("output_type") == "stream"), None)
+        if tail is None or self.clear_before_next_output:
+            out = super().output(outs, msg, None, cell_index)
+            if out is not None:
+                out.text = out.text[-STDOUT_TAIL_CHARS:]
+            return out
+        tail.text = (tail.text + text)[-STDOUT_TAIL_CHARS:]
+        return tail
+
+
+class LeanEngine(NBClientEngine):
+    @classmethod
+    def execute_notebook(cls, nb, kernel_name, output_path=None, progress_bar=True, log_output=False,
+                         autosave_cell_every=30, **kwargs):
+        nb_man = LeanExecutionManager(nb, output_path=output_path, progress_bar=progress_bar,
+                                      log_output=log_output, autosave_cell_every=0)
+        nb_man.notebook_start()
+        try:
+            cls.execute_managed_notebook(nb_man, kernel_name, log_output=log_output, **kwargs)
+        finally:
+            nb_man.notebook_complete()
+        return nb_man.nb
+
+    @classmethod
+    def execute_managed_notebook(cls, nb_man, kernel_name, log_output=False, stdout_file=None, stderr_file=None,
+                                 start_timeout=60, execution_timeout=None, **kwargs):
+        kwargs = remove_args(['input_path'], **kwargs)
+        safe_kwargs = remove_args(['timeout', 'startup_timeout'], **kwargs)
+        final_kwargs = merge_kwargs(
+            safe_kwargs,
+            timeout=execution_timeout if execution_timeout else kwargs.get('timeout'),
+            startup_timeout=start_timeout,
+            kernel_name=kernel_name,
+            log=logger,
+            log_output=log_output,
+            stdout_file=stdout_file,
+            stderr_file=stderr_file,
+        )
+        return LeanNotebookClient(nb_man, **final_kwargs).execute()
+
+
+papermill_engines.register(LEAN_ENGINE, LeanEngine)
@@ -1,13 +1,56 @@
 """
 This module is used to chat with the local LLM Llama3 model.
+The backend can be replaced (e.g. by the deterministic stub of the benchmarks) with setChatBackend.
+Calls are recorded to, or replayed from, the interaction archive when it is enabled.
 """
 
+import importlib
+import importlib.util
+import os
+import time
 import ollama
+from trace_utils import span
+from metrics import emitEvent
+from interaction_archive import archived
 
-def localChat(msg):
+_chat_backend = None
+
+def ollamaChat(msg):
   response = ollama.chat(
       model='llama3',
       messages=[{'role': 'user', 'content': msg}]
   )
-
   return response['message']['content']
+
+def loadChatBackend(spec):
+  """
+  Load a chat function from `module:function` or `path/to/file.py:function`
+  """
+  module_name, func_name = spec.rsplit(':', 1)
+  if module_name.endswith('.py'):
+    module_spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(module_name))[0], module_name)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+  else:
+    module = importlib.import_module(module_name)
+  return getattr(module, func_name)
+
+def setChatBackend(backend):
+  """
+  Replace the model behind localChat
+  :param backend: a function taking the prompt and returning the response text, a `module:function`
+                  spec, or None to go back to Ollama
+  """
+  global _chat_backend
+  if isinstance(backend, str):
+    backend = loadChatBackend(backend)
+  _chat_backend = backend
+
+def localChat(msg):
+  with span('llm_call', prompt_chars=len(msg)) as llm_span:
+    start = time.time()
+    response = archived('llm', msg, lambda: (_chat_backend or ollamaChat)(msg))
+    llm_span['response_chars'] = len(response)
+    emitEvent('llm_call', latency=time.time() - start)
+
+  return response
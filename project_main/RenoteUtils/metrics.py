@@ -0,0 +1,270 @@
+"""
+Live throughput and progress metrics for long corpus runs.
+Workers append events (one JSON object per line) to their own file in `<metrics_dir>/events`.
+The orchestrator runs a MetricsAggregator that tails these files and periodically rewrites
+`<metrics_dir>/metrics.prom` in the Prometheus text format, and optionally serves it over HTTP.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EVENTS_DIR = 'events'
+METRICS_FILE = 'metrics.prom'
+
+_metrics_dir = None
+_worker_id = None
+_events_file = None
+_events_file_pid = None
+_lock = threading.Lock()
+
+
+def enableMetrics(metrics_dir, worker_id=None):
+    """Start writing the events of this process (and of its forked children) to metrics_dir"""
+    global _metrics_dir, _worker_id
+    if not metrics_dir:
+        return
+    os.makedirs(os.path.join(metrics_dir, EVENTS_DIR), exist_ok=True)
+    _metrics_dir = metrics_dir
+    _worker_id = worker_id
+
+
+def emitEvent(kind, **fields):
+    """
+    Record one event, e.g. emitEvent('notebook_done', status='executable', duration=12.3)
+    :param kind: notebook_done, repo_start, repo_done, llm_call, pip_install, ...
+    """
+    global _events_file, _events_file_pid
+    if _metrics_dir is None:
+        return
+    event = {'kind': kind, 'ts': time.time(), 'worker': _worker_id, **fields}
+    with _lock:
+        pid = os.getpid()
+        if _events_file is None or _events_file_pid != pid:
+            path = os.path.join(_metrics_dir, EVENTS_DIR, f'events-{_worker_id or "main"}-{pid}.jsonl')
+            _events_file = open(path, 'a', encoding='utf-8')
+            _events_file_pid = pid
+        _events_file.write(json.dumps(event, default=str) + '\n')
+        _events_file.flush()
+
+
+def statusClass(status):
+    """Group statuses such as `LLM_ERROR_Extract=ValueError` into one class"""
+    return str(status).split('=')[0] if status else 'None'
+
+
+class MetricsAggregator:
+    """
+    Aggregates the worker events into live metrics.
+    :param metrics_dir: the directory passed to enableMetrics in the workers
+    :param total_repos: number of repositories queued for this run
+    :param total_nbs: number of notebooks queued for this run
+    :param envs: names of the envs (workers)
+    :param interval: seconds between two rewrites of metrics.prom
+    :param port: if set, also serve the metrics at http://127.0.0.1:<port>/metrics
+    """
+    RATE_WINDOW = 900  # seconds used for the recent notebooks/hour rate
+
+    def __init__(self, metrics_dir, total_repos, total_nbs, envs, interval=30, port=None):
+        self.metrics_dir = metrics_dir
+        self.total_repos = total_repos
+        self.total_nbs = total_nbs
+        self.envs = list(envs)
+        self.interval = interval
+        self.port = port
+        os.makedirs(os.path.join(metrics_dir, EVENTS_DIR), exist_ok=True)
+
+        self.start_time = time.time()
+        self.offsets = {}
+        self.partial = {}
+        self.nbs_done = 0
+        self.repos_done = 0
+        self.status_counts = defaultdict(int)
+        self.recent_nbs = deque()
+        self.env_busy_since = {}
+        self.env_busy_seconds = defaultdict(float)
+        self.llm_calls = 0
+        self.llm_latency = 0.0
+        self.pip_installs = 0
+        self.pip_failures = 0
+        self.pip_seconds = 0.0
+        self.counters = defaultdict(int)
+        self.disk_free_mb = {}
+        self.disk_paused_envs = set()
+        self.disk_evicted_bytes = defaultdict(int)
+        self.pip_skipped = defaultdict(int)
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+        self._text = ''
+
+    def _handle(self, event):
+        kind = event.get('kind')
+        ts = event.get('ts', time.time())
+        if kind == 'notebook_done':
+            self.nbs_done += 1
+            self.status_counts[statusClass(event.get('status'))] += 1
+            self.recent_nbs.append(ts)
+        elif kind == 'repo_start':
+            self.env_busy_since[event.get('env')] = ts
+        elif kind == 'repo_done':
+            self.repos_done += 1
+            started = self.env_busy_since.pop(event.get('env'), None)
+            if started is not None:
+                self.env_busy_seconds[event.get('env')] += ts - started
+        elif kind == 'llm_call':
+            self.llm_calls += 1
+            self.llm_latency += event.get('latency', 0.0)
+        elif kind == 'pip_install':
+            self.pip_installs += 1
+            self.pip_seconds += event.get('duration', 0.0)
+            if event.get('returncode', 0) != 0:
+                self.pip_failures += 1
+        elif kind in ('disk_pressure', 'disk_paused'):
+            self.counters[kind] += 1
+            self.disk_free_mb[event.get('path')] = event.get('free_mb', 0)
+            if kind == 'disk_paused':
+                self.disk_paused_envs.add(event.get('env'))
+        elif kind in ('disk_resumed', 'disk_pause_expired'):
+            self.counters[kind] += 1
+            self.disk_paused_envs.discard(event.get('env'))
+        elif kind == 'disk_evicted':
+            self.disk_evicted_bytes[event.get('what')] += event.get('bytes', 0)
+        elif kind == 'pip_install_skipped':
+            self.pip_skipped[event.get('reason')] += 1
+        else:
+            self.counters[kind] += 1
+
+    def poll(self):
+        """Read the events appended since the last poll"""
+        events_dir = os.path.join(self.metrics_dir, EVENTS_DIR)
+        for filename in os.listdir(events_dir):
+            path = os.path.join(events_dir, filename)
+            with open(path, 'r', encoding='utf-8') as f:
+                f.seek(self.offsets.get(path, 0))
+                data = self.partial.pop(path, '') + f.read()
+                self.offsets[path] = f.tell()
+            lines = data.split('\n')
+            if lines[-1]:
+                # The worker is in the middle of writing this line
+                self.partial[path] = lines[-1]
+            for line in lines[:-1]:
+                if line.strip():
+                    try:
+                        self._handle(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+
+    def render(self):
+        """Render the current metrics in the Prometheus text format"""
+        now = time.time()
+        elapsed = max(now - self.start_time, 1e-6)
+        while self.recent_nbs and self.recent_nbs[0] < now - self.RATE_WINDOW:
+            self.recent_nbs.popleft()
+        window = min(self.RATE_WINDOW, elapsed)
+        recent_rate = len(self.recent_nbs) / window * 3600
+        overall_rate = self.nbs_done / elapsed * 3600
+        remaining_nbs = max(self.total_nbs - self.nbs_done, 0)
+        rate = recent_rate or overall_rate
+        eta = remaining_nbs / rate * 3600 if rate > 0 else -1
+
+        lines = [
+            '# TYPE renote_notebooks_done_total counter',
+            f'renote_notebooks_done_total {self.nbs_done}',
+            '# TYPE renote_notebooks_by_status_total counter',
+        ]
+        lines += [f'renote_notebooks_by_status_total{{status="{s}"}} {c}' for s, c in sorted(self.status_counts.items())]
+        lines += [
+            '# TYPE renote_notebooks_per_hour gauge',
+            f'renote_notebooks_per_hour{{window="run"}} {overall_rate:.2f}',
+            f'renote_notebooks_per_hour{{window="{self.RATE_WINDOW}s"}} {recent_rate:.2f}',
+            '# TYPE renote_queue_backlog gauge',
+            f'renote_queue_backlog{{unit="repos"}} {max(self.total_repos - self.repos_done, 0)}',
+            f'renote_queue_backlog{{unit="notebooks"}} {remaining_nbs}',
+            '# TYPE renote_eta_seconds gauge',
+            f'renote_eta_seconds {eta:.0f}',
+            '# TYPE renote_env_busy gauge',
+        ]
+        lines += [f'renote_env_busy{{env="{env}"}} {int(env in self.env_busy_since)}' for env in self.envs]
+        lines.append('# TYPE renote_env_utilisation gauge')
+        for env in self.envs:
+            busy = self.env_busy_seconds[env]
+            if env in self.env_busy_since:
+                busy += now - self.env_busy_since[env]
+            lines.append(f'renote_env_utilisation{{env="{env}"}} {min(busy / elapsed, 1.0):.3f}')
+        lines += [
+            '# TYPE renote_llm_calls_total counter',
+            f'renote_llm_calls_total {self.llm_calls}',
+            '# TYPE renote_llm_latency_seconds summary',
+            f'renote_llm_latency_seconds_sum {self.llm_latency:.3f}',
+            f'renote_llm_latency_seconds_count {self.llm_calls}',
+            '# TYPE renote_pip_install_seconds summary',
+            f'renote_pip_install_seconds_sum {self.pip_seconds:.3f}',
+            f'renote_pip_install_seconds_count {self.pip_installs}',
+            '# TYPE renote_pip_install_failures_total counter',
+            f'renote_pip_install_failures_total {self.pip_failures}',
+            '# TYPE renote_events_total counter',
+        ]
+        lines += [f'renote_events_total{{kind="{k}"}} {c}' for k, c in sorted(self.counters.items())]
+        lines.append('# TYPE renote_pip_install_skipped_total counter')
+        lines += [f'renote_pip_install_skipped_total{{reason="{r}"}} {c}' for r, c in sorted(self.pip_skipped.items())]
+        lines += ['# TYPE renote_disk_paused_envs gauge', f'renote_disk_paused_envs {len(self.disk_paused_envs)}',
+                  '# TYPE renote_disk_free_mb gauge']
+        lines += [f'renote_disk_free_mb{{path="{p}"}} {mb}' for p, mb in sorted(self.disk_free_mb.items())]
+        lines.append('# TYPE renote_disk_evicted_bytes_total counter')
+        lines += [f'renote_disk_evicted_bytes_total{{what="{w}"}} {b}' for w, b in sorted(self.disk_evicted_bytes.items())]
+        lines += ['# TYPE renote_uptime_seconds gauge', f'renote_uptime_seconds {elapsed:.0f}']
+        return '\n'.join(lines) + '\n'
+
+    def writeMetricsFile(self):
+        self.poll()
+        self._text = self.render()
+        path = os.path.join(self.metrics_dir, METRICS_FILE)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            f.write(self._text)
+        os.replace(f'{path}.tmp', path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.writeMetricsFile()
+            except Exception as e:
+                print(f"Cannot write the metrics: {e}")
+
+    def _startServer(self):
+        aggregator = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = aggregator._text.encode('utf-8')
+                self.send_response(200 if self.path.startswith('/metrics') else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def start(self):
+        self.writeMetricsFile()
+        if self.port:
+            self._startServer()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.writeMetricsFile()
+        if self._server is not None:
+            self._server.shutdown()
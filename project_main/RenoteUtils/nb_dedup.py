@@ -0,0 +1,85 @@
+"""
+Content-hash deduplication of notebooks.
+Forks of the same repository carry byte-identical notebooks; a notebook is executed once per
+(code cells, resolved requirement set) and every later copy reuses the stored result.
+The index is a DiskCache, so it is shared by all workers and survives resume runs.
+"""
+
+import copy
+import hashlib
+from diskcache import Index
+from nb_stream import readNotebookSources
+
+
+def computeCodeHash(nb_path):
+    """
+    Hash the source of the code cells of a notebook, ignoring outputs, metadata and markdown
+    :param nb_path: path to the notebook file
+    :return: hex digest, or None if the notebook cannot be read
+    """
+    try:
+        notebook = readNotebookSources(nb_path)
+    except Exception as e:
+        print(f"Cannot hash the notebook {nb_path}: {e}")
+        return None
+
+    h = hashlib.sha256()
+    for cell in notebook.get('cells', []):
+        if cell.get('cell_type') != 'code':
+            continue
+        source = cell.get('source') or ''
+        if isinstance(source, list):
+            source = ''.join(source)
+        source = '\n'.join(line.rstrip() for line in source.strip().splitlines())
+        if source:
+            h.update(source.encode('utf-8'))
+            h.update(b'\x00')
+    return h.hexdigest()
+
+
+def computeDedupKey(code_hash, requirements=None):
+    """
+    Combine the code hash with the resolved requirement set of the repository
+    :param code_hash: the hash returned by computeCodeHash
+    :param requirements: list of requirement strings installed before the execution
+    :return: hex digest
+    """
+    h = hashlib.sha256(code_hash.encode())
+    for requirement in sorted(set(requirements or [])):
+        h.update(requirement.encode())
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+class NBDeduplicator:
+    def __init__(self, dedup_cache_path):
+        self.index = Index(dedup_cache_path)
+
+    def reuseResult(self, dedup_key, nb_path, repo_path=None):
+        """
+        Return a copy of the stored result of an identical notebook, rewritten for this notebook,
+        and record the duplication. Returns None if no identical notebook was evaluated yet.
+        """
+        with self.index.transact():
+            entry = self.index.get(dedup_key)
+            if entry is None or entry['nb_path'] == nb_path:
+                return None
+            if nb_path not in entry['duplicates']:
+                entry['duplicates'].append(nb_path)
+                self.index[dedup_key] = entry
+
+        result = copy.deepcopy(entry['result'])
+        result['nb_path'] = nb_path
+        result['repo_path'] = repo_path
+        result['duplicate_of'] = entry['nb_path']
+        return result
+
+    def recordResult(self, dedup_key, nb_path, result):
+        """Store the result of an executed notebook, unless another worker stored one first."""
+        with self.index.transact():
+            if dedup_key not in self.index:
+                self.index[dedup_key] = {'nb_path': nb_path, 'result': result, 'duplicates': []}
+
+    def getDuplicates(self, dedup_key):
+        entry = self.index.get(dedup_key)
+        return [] if entry is None else entry['duplicates']
@@ -0,0 +1,63 @@
+"""
+Streaming notebook reader for validation, hashing and static analysis.
+Public notebooks often weigh hundreds of MB because of embedded images and large DataFrame outputs,
+while these steps only need the metadata and the cell sources. The notebook is parsed incrementally
+with ijson, and the `outputs` and `attachments` of the cells are dropped as they are parsed, so the
+memory used does not grow with the outputs. Without ijson (an optional dependency), the notebook is
+loaded with json and the outputs are dropped afterwards.
+Execution still reads the full notebook.
+"""
+
+import json
+import nbformat
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+SKIPPED_CELL_KEYS = ('outputs', 'attachments')
+READ_BUFFER_BYTES = 1 << 20     # large base64 strings are parsed much faster than with ijson's 64 KB default
+_SKIPPED_CONTAINERS = tuple(f'cells.item.{key}' for key in SKIPPED_CELL_KEYS)
+_SKIPPED_CONTENTS = tuple(f'{prefix}.' for prefix in _SKIPPED_CONTAINERS)
+
+
+def _streamNotebookDict(nb_path):
+    builder = ijson.ObjectBuilder()
+    with open(nb_path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, buf_size=READ_BUFFER_BYTES, use_float=True):
+            # The outputs and attachments are kept as empty containers, their content is never built
+            if prefix.startswith(_SKIPPED_CONTENTS):
+                continue
+            builder.event(event, value)
+    return builder.value
+
+
+def _loadNotebookDict(nb_path):
+    with open(nb_path, 'r', encoding='utf-8') as f:
+        notebook = json.load(f)
+    for cell in notebook.get('cells', []):
+        for key in SKIPPED_CELL_KEYS:
+            if key in cell:
+                cell[key] = [] if key == 'outputs' else {}
+    return notebook
+
+
+def readNotebookSources(nb_path):
+    """
+    Read the metadata and the cells of a notebook without their outputs
+    :param nb_path: path to the notebook file
+    :return: the notebook [NotebookNode], with the cell sources as strings and empty outputs
+    :raise: ValueError (or ijson.JSONError) if the file is not valid JSON
+    """
+    notebook = _streamNotebookDict(nb_path) if ijson is not None else _loadNotebookDict(nb_path)
+    if not isinstance(notebook, dict):
+        raise ValueError(f'{nb_path} is not a notebook')
+    if notebook.get('nbformat', 4) < 4:
+        # Old notebooks keep their cells in worksheets: let nbformat convert them
+        return nbformat.read(nb_path, as_version=4)
+
+    for cell in notebook.get('cells', []):
+        if isinstance(cell.get('source'), list):
+            cell['source'] = ''.join(cell['source'])
+    return nbformat.from_dict(notebook)
@@ -2,21 +2,29 @@ import nbformat
 import ast
 import papermill as pm
 import os
-import subprocess
 import sys
-import json
+import time
+import fcntl
 from ast_visit import ASTNodeVisitor
+from trace_utils import span
+from metrics import emitEvent
+from interaction_archive import archived
+from work_journal import addCleanupObligation
+from nb_stream import readNotebookSources
+from disk_governor import pipCacheInUse
+from pip_policy import PipPolicy, isLocalModule, LOCAL_MODULE, PIP_CACHED_FAILURE
 
 
-def get_notebook_language(notebook_path):
+def get_notebook_language(notebook_path, notebook=None):
+    # notebook: the notebook already read by ReadNB, to avoid parsing the file again
     if os.path.getsize(notebook_path) == 0:
         print(f"Notebook file {notebook_path} is empty.")
         return None
     
-    with open(notebook_path, 'r', encoding='utf-8') as f:
+    if notebook is None:
         try:
-            notebook = json.load(f)
-        except json.JSONDecodeError as e:
+            notebook = readNotebookSources(notebook_path)
+        except Exception as e:
             print(f"Failed to decode JSON from {notebook_path}: {e}")
             return None
     
@@ -49,7 +57,7 @@ def readNoteBook(nb_path):
         return nb, "No code cells"
 
     # 3. Check the language of the notebook. If not Python, we will move it to the error directory
-    check_language = get_notebook_language(nb_path)
+    check_language = get_notebook_language(nb_path, nb_content)
     if check_language is None:
         return nb, "Cannot read"
     language_name, version, kernel_name = check_language
@@ -80,17 +88,51 @@ def readNoteBook(nb_path):
  
     return nb, "Success"
 
-def addMissingModule(missing_module):
-    r =  subprocess.run([f"pip install {missing_module}"], capture_output=True, shell=True)
-    if r.returncode == 0:
+def _pipInstall(missing_module, pip_policy):
+    # Notebooks of a repo may run in parallel on the same env: one pip install at a time
+    with open(os.path.join(sys.prefix, '.renote-pip.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Checked under the lock, so a failure of the notebook that held it is not tried again
+        failure = pip_policy.cachedFailure(missing_module)
+        if failure is not None:
+            print(f"===> {missing_module} failed to install {(time.time() - failure['time']) / 3600:.1f} hours ago, not trying again")
+            emitEvent('pip_install_skipped', module=missing_module, reason='cached_failure')
+            return PIP_CACHED_FAILURE, failure['stderr']
+        start = time.time()
+        with pipCacheInUse():
+            returncode, stderr = pip_policy.runPipInstall(missing_module)
+    pip_policy.recordOutcome(missing_module, returncode, stderr, time.time() - start)
+    return returncode, stderr
+
+def addMissingModule(missing_module, repo_path=None, pip_policy=None):
+    """
+    Install a module missing from a notebook in the current env
+    :param repo_path: the repository of the notebook; its own modules are not installed
+    :param pip_policy: PipPolicy of the install, None for the default policy
+    :return: 0 if installed, LOCAL_MODULE for a module of the repository, PIP_CACHED_FAILURE for a module that
+             failed to install recently, else the pip return code
+    """
+    if isLocalModule(missing_module, repo_path):
+        print(f"===> {missing_module} is a module of the repository, not installing it")
+        emitEvent('pip_install_skipped', module=missing_module, reason='local_module')
+        return LOCAL_MODULE
+    with span('pip_install', module=missing_module) as pip_span:
+        start = time.time()
+        returncode, stderr = archived('pip', missing_module, lambda: _pipInstall(missing_module, pip_policy or PipPolicy()))
+        pip_span['returncode'] = returncode
+        emitEvent('pip_install', module=missing_module, duration=time.time() - start, returncode=returncode)
+    if returncode == 0:
         print(f"===> Successfully installed {missing_module}")
         return 0
     else:
-        print(f"===> Error installing {missing_module}: {r.stderr}")
-        return r.returncode
+        print(f"===> Error installing {missing_module}: {stderr}")
+        return returncode
 
 ############################################################################################################   
 
+# Names the IPython kernel defines in every notebook
+IPYTHON_NAMES = {'get_ipython', 'display', 'In', 'Out', 'exit', 'quit'}
+
 def getCellSourceCode(cell):
     source = ""
     lines = cell['source'].splitlines()
@@ -105,6 +147,7 @@ class StaticAST:
         # Store detailed variable usage information
         self.variable_uses = {}  # Format: {cell_number: {variable_name: [scope_ids]}}
         self.variable_defs = {}  # Format: {cell_number: {variable_name: [scope_ids]}}
+        self.cell_indices = {}  # Format: {cell_number: index of the cell in the notebook}
 
     def _getNotebookCells(self, notebook_path):
         """
@@ -113,10 +156,7 @@ class StaticAST:
         :return: list of code cells
         """
         try:
-            with open(notebook_path, 'r', encoding='utf-8') as f:
-                notebook = nbformat.read(f, as_version=4)
-                cells = notebook['cells']
-            return cells
+            return readNotebookSources(notebook_path)['cells']
         except Exception as e:
             print(f"CAN'T OPEN NOTEBOOK: {notebook_path}")
             return None
@@ -204,7 +244,7 @@ class StaticAST:
             return False
             
         valid_cell_count = 0
-        for cell in cells:
+        for index, cell in enumerate(cells):
             if cell['cell_type'] == 'code':
                 if cell["source"] is None:
                     continue
@@ -212,6 +252,7 @@ class StaticAST:
                 cell_content = ''.join(cell['source'].split())
                 if cell_content:
                     valid_cell_count += 1
+                    self.cell_indices[valid_cell_count] = index
                     source_code = getCellSourceCode(cell)
                     result = self._analyzeNotebookCell(source_code, global_scope, valid_cell_count)
                     
@@ -264,9 +305,41 @@ class StaticAST:
             
         return "undefined", -1
 
+    def findUseCell(self, variable, cell_number):
+        """
+        Number of the cell using variable that the execution reported as cell_number, once the notebook is analyzed.
+        The execution count of a cell may differ from its number here, e.g. when the kernel skipped cells
+        or the count was read from the error message
+        :return: cell_number if that cell uses variable, else the closest cell that does, else cell_number
+        """
+        use_cells = [cell for cell, uses in self.variable_uses.items() if variable in uses]
+        if not use_cells or cell_number in use_cells:
+            return cell_number
+        return min(use_cells, key=lambda cell: (abs(cell - cell_number), cell))
+
+    def findAllUndefinedVariables(self):
+        """
+        Find the variables that no cell of the notebook defines, in any scope.
+        Variables defined after their use or in a scope the use cannot see are left to findOneVariableDefinition.
+        :return: dict {variable: number of the cell of its first use}, in order of first use; None if the notebook
+                 cannot be analyzed or a star import hides which names are defined
+        """
+        if not self.analyze_notebook():
+            return None
+        defined = {var.split('.')[0] for defs in self.variable_defs.values() for var in defs}
+        if '*' in defined:
+            return None
+        undefined = {}
+        for use_cell in sorted(self.variable_uses):
+            for var in self.variable_uses[use_cell]:
+                if var not in defined and var not in IPYTHON_NAMES and var not in undefined:
+                    undefined[var] = use_cell
+        return undefined
+
 
 ############################################################################################################
 
+
 class ReadNB:
     def __init__(self, nb_path):
         self.nb_path = nb_path
@@ -274,18 +347,25 @@ class ReadNB:
 
     def readNB(self):
         """
-        Read a notebook file and return the code cells
-        :param nb_path: path to the notebook file
-        :return: list of code cells
+        Read the metadata and the cells of a notebook file, without their outputs
+        :return: the notebook, None if it cannot be read
         """
         try:
-            with open(self.nb_path, 'r', encoding='utf-8') as f:
-                self.nb_content = nbformat.read(f, as_version=4)
-                return self.nb_content
+            self.nb_content = readNotebookSources(self.nb_path)
+            return self.nb_content
         except Exception as e:
             print(f"CAN'T OPEN NOTEBOOK: {e}")
             return None
 
+    def getTotalCodeCells(self):
+        """
+        Count the non-empty code cells in the notebook
+        :return: number of code cells, 0 if the notebook cannot be read
+        """
+        if self.nb_content is None and self.readNB() is None:
+            return 0
+        return len(self.readCodeCells())
+
     def readCodeCells(self):
         """
         Read the code cells in the notebook
@@ -355,6 +435,7 @@ class ReOrderCellsTempNBForDefinedAfter:
         output_nb_name = nb_name.replace(".ipynb", "_reordered_temp.ipynb")
         new_notebook_path = os.path.join(os.path.dirname(self.nb_path), output_nb_name)
 
+        addCleanupObligation(new_notebook_path)
         with open(new_notebook_path, "w", encoding="utf-8") as f:
             nbformat.write(new_content, f)
         return new_notebook_path
@@ -0,0 +1,56 @@
+"""
+Fail-fast network sandbox for notebook kernels.
+On offline execution hosts, downloads (urlopen, requests, kaggle, !wget) hang until the cell timeout.
+When network access is blocked, kernels are started with:
+- network_guard_site/ first on PYTHONPATH: its sitecustomize makes connections and name lookups to
+  anything but the local host raise NetworkAccessBlocked at once, in the kernel and its Python children
+- proxy variables pointing to a closed local port, so wget, curl and other tools fail at once too
+Executions failing this way get the status NetworkAccessBlocked.
+"""
+
+import os
+from contextlib import contextmanager
+
+NETWORK_ACCESS_BLOCKED = 'NetworkAccessBlocked'
+GUARD_SITE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'network_guard_site')
+CLOSED_PROXY = 'http://127.0.0.1:9'
+PROXY_VARIABLES = ['http_proxy', 'https_proxy', 'ftp_proxy', 'all_proxy', 'HTTP_PROXY', 'HTTPS_PROXY', 'FTP_PROXY', 'ALL_PROXY']
+
+def guardEnvironment(environ):
+    """The environment variables to set for a kernel without network access"""
+    python_path = environ.get('PYTHONPATH')
+    overrides = {
+        'RENOTE_BLOCK_NETWORK': '1',
+        'PYTHONPATH': GUARD_SITE_DIR + (os.pathsep + python_path if python_path else ''),
+        'no_proxy': 'localhost,127.0.0.1,::1',
+        'NO_PROXY': 'localhost,127.0.0.1,::1',
+    }
+    overrides.update({name: CLOSED_PROXY for name in PROXY_VARIABLES})
+    return overrides
+
+
+@contextmanager
+def kernelNetworkGuard(blocked):
+    """
+    Block the network of the kernels started inside this block, if blocked.
+    The kernel inherits the environment of this process when it is spawned; it is restored afterwards.
+    """
+    if not blocked:
+        yield
+        return
+
+    overrides = guardEnvironment(os.environ)
+    previous = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def isNetworkBlockedError(err):
+    return NETWORK_ACCESS_BLOCKED in err
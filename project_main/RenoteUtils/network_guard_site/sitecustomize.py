@@ -0,0 +1,73 @@
+"""
+Socket guard loaded by the notebook kernels when network access is blocked (see network_guard.py).
+Connections and name lookups to anything but the local host fail at once with NetworkAccessBlocked,
+instead of hanging until the cell timeout. The sitecustomize this file shadows, if any, is still loaded.
+"""
+
+import importlib.machinery
+import importlib.util
+import os
+import socket
+import sys
+
+LOCAL_HOSTS = {'localhost', '127.0.0.1', '::1', '0.0.0.0', '', None}
+CLOSED_PROXY_PORT = 9  # the proxy variables point HTTP clients to this closed local port
+
+
+class NetworkAccessBlocked(ConnectionRefusedError):
+    pass
+
+
+def _isLocal(host):
+    if isinstance(host, bytes):
+        host = host.decode('utf-8', 'ignore')
+    return host in LOCAL_HOSTS or (isinstance(host, str) and host.startswith('127.'))
+
+
+def _isBlockedAddress(address):
+    host, port = address[:2]
+    return not _isLocal(host) or port == CLOSED_PROXY_PORT
+
+
+def _blocked(host, port=None):
+    target = f'{host}:{port}' if port is not None else str(host)
+    return NetworkAccessBlocked(111, f'NetworkAccessBlocked: network access is disabled during notebook execution ({target})')
+
+
+def _installGuard():
+    original_connect = socket.socket.connect
+    original_connect_ex = socket.socket.connect_ex
+    original_getaddrinfo = socket.getaddrinfo
+
+    def connect(self, address):
+        if self.family in (socket.AF_INET, socket.AF_INET6) and _isBlockedAddress(address):
+            raise _blocked(*address[:2])
+        return original_connect(self, address)
+
+    def connect_ex(self, address):
+        if self.family in (socket.AF_INET, socket.AF_INET6) and _isBlockedAddress(address):
+            raise _blocked(*address[:2])
+        return original_connect_ex(self, address)
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        if not _isLocal(host):
+            raise socket.gaierror(socket.EAI_NONAME, f'NetworkAccessBlocked: name resolution is disabled during notebook execution ({host})')
+        return original_getaddrinfo(host, port, *args, **kwargs)
+
+    socket.socket.connect = connect
+    socket.socket.connect_ex = connect_ex
+    socket.getaddrinfo = getaddrinfo
+
+
+def _loadShadowedSitecustomize():
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = [p for p in sys.path if os.path.abspath(p or os.curdir) != here]
+    spec = importlib.machinery.PathFinder.find_spec('sitecustomize', paths)
+    if spec is not None and spec.loader is not None:
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+
+if os.environ.get('RENOTE_BLOCK_NETWORK') == '1':
+    _installGuard()
+_loadShadowedSitecustomize()
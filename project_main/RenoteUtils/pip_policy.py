@@ -0,0 +1,124 @@
+"""
+Policy of the pip installs of the modules missing from notebooks (nb_utils.addMissingModule).
+The same hopeless names (internal packages, typos, helper modules such as `utils`) come up in many
+notebooks, and each install of them could spend minutes resolving or building a source distribution:
+- a name that is a module or package of the repository itself is never installed
+- every install gets a wall-clock budget; when it runs out, pip and its build processes are killed
+- with only_binary, pip refuses to build source distributions
+- the outcomes are shared by all workers [DiskCache], keyed on the module and the python version of the
+  env; a failed install is not tried again until failure_ttl has passed. An install that timed out or failed
+  on the network or the disk may succeed later, so it is only remembered for TRANSIENT_FAILURE_TTL.
+  The module name the LLM proposes instead of a failed one is cached with it, so it is asked only once
+"""
+
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+from functools import lru_cache
+from diskcache import Index
+
+DEFAULT_FAILURE_TTL = 7 * 24 * 3600
+TRANSIENT_FAILURE_TTL = 3600
+PIP_TIMED_OUT = -1          # return code of an install that ran out of time
+LOCAL_MODULE = -2           # return code of a module of the repository, which is not installed
+PIP_CACHED_FAILURE = -3     # return code of a module whose install failed recently, which is not tried again
+MAX_STDERR_BYTES = 4000     # tail of the pip error kept in the cache
+SKIPPED_DIRS = {'__pycache__', 'site-packages', 'node_modules'}
+# pip errors of the host rather than of the package
+TRANSIENT_ERRORS = (b'No space left on device', b'Errno 28', b'Connection', b'connection', b'Temporary failure in name resolution',
+                    b'Name or service not known', b'Read timed out', b'ProxyError', b'SSLError', b'HTTP error 5',
+                    b'Network is unreachable')
+
+
+def _outcomeKey(module):
+    # PEP 503 normalization, so `Foo_Bar` and `foo-bar` share their outcome
+    return f"{re.sub(r'[-_.]+', '-', module).lower()}|py{sys.version_info.major}.{sys.version_info.minor}"
+
+
+def isTransientFailure(returncode, stderr):
+    """Whether a failed install may succeed when tried again: a timeout, a network or a disk error"""
+    return returncode == PIP_TIMED_OUT or returncode < 0 or any(error in stderr for error in TRANSIENT_ERRORS)
+
+
+class PipPolicy:
+    def __init__(self, cache_path=None, failure_ttl=None, timeout=None, only_binary=False):
+        """
+        :param cache_path: outcomes shared by the workers [DiskCache], None to remember nothing
+        :param failure_ttl: seconds a failure is remembered
+        :param timeout: seconds allowed to an install, None for no limit
+        :param only_binary: install wheels only
+        """
+        self.outcomes = Index(cache_path) if cache_path else None
+        self.failure_ttl = failure_ttl or DEFAULT_FAILURE_TTL
+        self.timeout = timeout or None
+        self.only_binary = bool(only_binary)
+
+    def cachedFailure(self, module):
+        """The recorded outcome of a failed install of module that has not expired, else None"""
+        if self.outcomes is None:
+            return None
+        outcome = self.outcomes.get(_outcomeKey(module))
+        if outcome is None or outcome['returncode'] == 0:
+            return None
+        ttl = TRANSIENT_FAILURE_TTL if outcome.get('transient') else self.failure_ttl
+        if time.time() - outcome['time'] > min(ttl, self.failure_ttl):
+            return None
+        return outcome
+
+    def recordOutcome(self, module, returncode, stderr, duration):
+        if self.outcomes is not None:
+            self.outcomes[_outcomeKey(module)] = {'returncode': returncode, 'stderr': stderr[-MAX_STDERR_BYTES:],
+                                                  'duration': duration, 'time': time.time(),
+                                                  'transient': returncode != 0 and isTransientFailure(returncode, stderr)}
+
+    def cachedCorrection(self, module):
+        """The module name the LLM proposed for module, None if it was not asked yet or the answer expired"""
+        if self.outcomes is None:
+            return None
+        correction = self.outcomes.get(f'correction|{_outcomeKey(module)}')
+        if correction is None or time.time() - correction['time'] > self.failure_ttl:
+            return None
+        return correction['module']
+
+    def recordCorrection(self, module, correct_module):
+        if self.outcomes is not None and correct_module:
+            self.outcomes[f'correction|{_outcomeKey(module)}'] = {'module': correct_module, 'time': time.time()}
+
+    def runPipInstall(self, module):
+        """
+        pip install module within the budget
+        :return: (return code, stderr [bytes]); PIP_TIMED_OUT if the budget ran out
+        """
+        command = ['pip', 'install'] + (['--only-binary', ':all:'] if self.only_binary else []) + [module]
+        # pip runs in its own session, so the build processes it spawns are killed with it
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        try:
+            _, stderr = process.communicate(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.communicate()
+            return PIP_TIMED_OUT, f'pip install {module} timed out after {self.timeout}s'.encode()
+        return process.returncode, stderr
+
+
+@lru_cache(maxsize=16)
+def localModuleNames(repo_path):
+    """Names importable from the repository: its .py files and the directories with an __init__.py"""
+    names = set()
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d not in SKIPPED_DIRS]
+        if '__init__.py' in files and root != repo_path:
+            names.add(os.path.basename(root))
+        names.update(f[:-3] for f in files if f.endswith('.py'))
+    return frozenset(names)
+
+
+def isLocalModule(module, repo_path):
+    return bool(repo_path) and os.path.isdir(repo_path) and module in localModuleNames(repo_path)
+
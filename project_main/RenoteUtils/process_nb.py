@@ -1,12 +1,21 @@
 from nb_utils import StaticAST, addMissingModule, ReadNB, ReOrderCellsTempNBForDefinedAfter
+from pip_policy import PipPolicy, LOCAL_MODULE, PIP_CACHED_FAILURE
+from run_config import RunConfig
 from ExecuteNoteBook import ExecuteNoteBook
 from FixFileNotFound import FixFileNotFound
 from FixNameErrorLLM import FixNameErrorLLM
 from FixModuleNotFound import FixModuleNotFound
 from ast_visit import ASTNodeVisitor
+from nb_dedup import NBDeduplicator, computeCodeHash, computeDedupKey
+from results_store import ShardedResultsStore, notebookIdentity
+from trace_utils import span
+from exec_profile import summarizeExecutionProfiles
+from interaction_archive import archiveScope
+from exec_budget import ExecutionBudget
+from kernel_limits import summarizeResourceUsage
+from scratch_workspace import scratchWorkspace
 
 from tqdm import tqdm
-from diskcache import Index
 
 import os
 import shutil
@@ -17,6 +26,15 @@ import copy
 import ast
 
 
+def insertedCells(exec_r):
+    """Definition cells the fix of this NameError inserted; results recorded without the count inserted one per undefined variable"""
+    if exec_r.get('status') != 'NameError':
+        return 0
+    if 'inserted_cells' in exec_r:
+        return exec_r['inserted_cells']
+    return 1 if exec_r.get('NameError_type') == 'undefined' else 0
+
+
 def aggregateFileModuleNameFixingResults(all_exec_results):
     total_cell_ex_after_file_fix = 0
     total_cell_ex_after_module_fix = 0
@@ -31,13 +49,13 @@ def aggregateFileModuleNameFixingResults(all_exec_results):
     all_unique_errors_during_execution = list(set([d['status'] for d in all_exec_results]))
     for i in range(len(all_exec_results) - 1):
         d1 = all_exec_results[i]
-        j = i
-        d2 = all_exec_results[j]
+        d2_index = i
         for j in range(i + 1, len(all_exec_results)):
-            if d2['err_cell_num'] == d1['err_cell_num']:
-                d2 = all_exec_results[j]
+            if all_exec_results[d2_index]['err_cell_num'] == d1['err_cell_num']:
+                d2_index = j
             else:
                 break
+        d2 = all_exec_results[d2_index]
 
         if d1['status'] == 'ModuleNotFoundError':
             total_cell_ex_after_module_fix += (d2['err_cell_num'] - d1['err_cell_num'])
@@ -46,9 +64,8 @@ def aggregateFileModuleNameFixingResults(all_exec_results):
             total_cell_ex_after_file_fix += (d2['err_cell_num'] - d1['err_cell_num'])
             total_file_not_found += 1
         elif d1['status'] == 'NameError':
-            true_cell_count = d2['err_cell_num']
-            if d1['NameError_type'] == 'undefined':
-                true_cell_count = d2['err_cell_num'] - 1
+            # The definition cells inserted by the fixes between the two executions are not executed cells of the notebook
+            true_cell_count = d2['err_cell_num'] - sum(insertedCells(d) for d in all_exec_results[i:d2_index])
 
             increase = true_cell_count - d1['err_cell_num']
             total_cell_ex_after_name_fix += increase
@@ -72,7 +89,9 @@ def aggregateFileModuleNameFixingResults(all_exec_results):
     return results
 
 
-def nbExecutionWithFixingMissingModuleANDInputDataANDNameError(nb_path):
+def nbExecutionWithFixingMissingModuleANDInputDataANDNameError(nb_path, budget=None, repo_path=None, run_config=None):
+    run_config = run_config or RunConfig()
+    pip_policy = run_config.pip_policy or PipPolicy()
     all_exec_results = []
     missing_files_paths = set()
     missing_files_paths_to_remove = set()
@@ -86,7 +105,7 @@ def nbExecutionWithFixingMissingModuleANDInputDataANDNameError(nb_path):
     name_err_exec = []
     
     # Initial Execution
-    exec_r = ExecuteNoteBook(nb_path).executeNotebook()
+    exec_r = ExecuteNoteBook(nb_path, budget, run_config).executeNotebook()
     all_exec_results.append(exec_r)
 
     while True:
@@ -100,12 +119,13 @@ def nbExecutionWithFixingMissingModuleANDInputDataANDNameError(nb_path):
                 break
 
             missing_files_paths.add(missing_file_p)
-            f = FixFileNotFound(nb_path, exec_r)
-            create_status = f.create_input_file()
+            with span('fix_file_not_found', missing_file=missing_file_p):
+                f = FixFileNotFound(nb_path, exec_r)
+                create_status = f.create_input_file()
             if f.missing_file_true_path is not None:
                 missing_files_paths_to_remove.add(f.missing_file_true_path)
             if create_status:
-                exec_r = ExecuteNoteBook(nb_path).executeNotebook()
+                exec_r = ExecuteNoteBook(nb_path, budget, run_config).executeNotebook()
                 all_exec_results.append(exec_r)
             else:
                 err_in_file_creation = f'Fix it. File creation problem with {missing_file_p}'
@@ -120,20 +140,30 @@ def nbExecutionWithFixingMissingModuleANDInputDataANDNameError(nb_path):
             if m not in installed_modules:
                 installed_modules.add(m)
                 print(f">> ReNote: Fixing Missing module: {m}")
-                result_code = addMissingModule(m)
-                if result_code != 0:
-                    fix_module = FixModuleNotFound(m)
-                    correct_module = fix_module.fixModuleNotFound().strip().split('.')[0]
-                    total_module_fixing_llm += 1
-                    if correct_module is not None:
-                        returncode = addMissingModule(correct_module)
-                        if returncode == 0:
-                            installed_modules.add(correct_module)
-                            success_module_fixing_llm += 1
+                with span('fix_module_not_found', module=m):
+                    result_code = addMissingModule(m, repo_path, pip_policy)
+                    if result_code == LOCAL_MODULE:
+                        print(f'>> ReNote: {m} is a module of the repository, breaking the loop')
+                        break
+                    if result_code != 0:
+                        # A module that failed recently keeps the name the LLM proposed for it then
+                        correct_module = pip_policy.cachedCorrection(m) if result_code == PIP_CACHED_FAILURE else None
+                        if correct_module is None:
+                            fix_module = FixModuleNotFound(m)
+                            correct_module = fix_module.fixModuleNotFound().strip().split('.')[0]
+                            total_module_fixing_llm += 1
+                            pip_policy.recordCorrection(m, correct_module)
                         else:
-                            print(f'>> ReNote: {correct_module} cannot be installed, breaking the loop')
-                            break
-                exec_r = ExecuteNoteBook(nb_path).executeNotebook()
+                            print(f'>> ReNote: {m} failed to install before, trying {correct_module} as proposed then')
+                        if correct_module is not None:
+                            returncode = addMissingModule(correct_module, repo_path, pip_policy)
+                            if returncode == 0:
+                                installed_modules.add(correct_module)
+                                success_module_fixing_llm += 1
+                            else:
+                                print(f'>> ReNote: {correct_module} cannot be installed, breaking the loop')
+                                break
+                exec_r = ExecuteNoteBook(nb_path, budget, run_config).executeNotebook()
                 all_exec_results.append(exec_r)
             else:
                 print(f'>> ReNote: {m} cannot be installed, breaking the loop')
@@ -150,8 +180,9 @@ def nbExecutionWithFixingMissingModuleANDInputDataANDNameError(nb_path):
                 if prev_name_err['err_cell_num'] <= undefined_var_cell:
                     break
             # Static AST
-            staticAST = StaticAST(nb_path)
-            result = staticAST.findOneVariableDefinition(undefined_var, undefined_var_cell)
+            with span('static_ast', undefined_var=undefined_var):
+                staticAST = StaticAST(nb_path)
+                result = staticAST.findOneVariableDefinition(undefined_var, undefined_var_cell)
             print(f"========== Found NameError {undefined_var} in cell {undefined_var_cell} ==========")
 
             if result is None:
@@ -159,13 +190,19 @@ def nbExecutionWithFixingMissingModuleANDInputDataANDNameError(nb_path):
             err_type, defined_cell = result
             exec_r['NameError_type'] = err_type
 
-            # If the variable is undefined, then fix the NameError with LLM
-            if err_type == "undefined" or defined_cell == undefined_var_cell:
-                n = FixNameErrorLLM(nb_path, undefined_var, undefined_var_cell)
-                nb_path = n.fixNameErrorANDGetNewNBPath()
-            # If the variable is defined after the cell, then reorder the cells
-            elif err_type == "defined_after":
-                nb_path = ReOrderCellsTempNBForDefinedAfter(nb_path, defined_cell, undefined_var_cell).getReorderedNBPath()
+            with span('fix_name_error', undefined_var=undefined_var, err_type=err_type):
+                # If the variable is undefined, then fix the NameError with LLM
+                if err_type == "undefined" or defined_cell == undefined_var_cell:
+                    n = FixNameErrorLLM(nb_path, undefined_var, undefined_var_cell, run_config.batch_name_repair)
+                    fixed_nb_path = n.fixNameErrorANDGetNewNBPath()
+                    if fixed_nb_path is None:
+                        # No valid definition: running the notebook again would fail the same way
+                        break
+                    nb_path = fixed_nb_path
+                    exec_r['inserted_cells'] = n.inserted_cells
+                # If the variable is defined after the cell, then reorder the cells
+                elif err_type == "defined_after":
+                    nb_path = ReOrderCellsTempNBForDefinedAfter(nb_path, defined_cell, undefined_var_cell).getReorderedNBPath()
 
             print(f"New path generated: {nb_path}")
             ast_status.append(err_type)
@@ -175,7 +212,7 @@ def nbExecutionWithFixingMissingModuleANDInputDataANDNameError(nb_path):
             name_error_count += 1
 
             # Rerun the notebook
-            exec_r = ExecuteNoteBook(nb_path).executeNotebook()
+            exec_r = ExecuteNoteBook(nb_path, budget, run_config).executeNotebook()
             all_exec_results.append(exec_r)
 
         # Case 4: No error or other ERR, break the loop
@@ -227,28 +264,48 @@ def checkIfNBIsAlreadyEvaluated(results_cache, nb_path):
         return None
 
 
-def processNB(nb_path, results_cache_path, err_cache_path, resume):
+def processNB(nb_path, results_cache_path, err_cache_path, resume, repo_path=None, requirements=None, dedup_cache_path=None,
+              results_store=None, err_store=None, notebook_budget=None, scratch_root=None, run_config=None):
     """
     Process the notebook and return the results, if the notebook is already evaluated then return the cache
+    0. If an identical notebook (same code cells and requirements) was already executed, reuse its results
     1. Read the notebook and get the code cells
     2. AST analysis: parse the code cells
     3. If AST analysis is not successful, then do the execution
     4. Fix the import error and file error
     5. Aggregate the results
     6. Return the results
+    Workers pass their own sharded stores (results_store, err_store), otherwise the stores are opened from the paths.
+    notebook_budget bounds the wall time in seconds of all executions of the notebook (no bound if None).
+    With scratch_root, the notebook is executed in a scratch copy of repo_path made under scratch_root.
+    run_config (RunConfig) sets how the notebook is executed and fixed; the defaults if None.
     """
-    nb_name = os.path.basename(nb_path)
-    nb_cache = Index(results_cache_path)
-    err_cache = Index(err_cache_path)
+    run_config = run_config or RunConfig()
+    nb_cache = results_store if results_store is not None else ShardedResultsStore(results_cache_path)
+    err_cache = err_store if err_store is not None else ShardedResultsStore(err_cache_path)
+    code_hash = computeCodeHash(nb_path)
+    nb_key = notebookIdentity(repo_path, nb_path, code_hash)
 
     # If resume is 1, then check if the notebook is already evaluated
     if resume > 0:
-        res = checkIfNBIsAlreadyEvaluated(nb_cache, nb_name)
-        res_err = checkIfNBIsAlreadyEvaluated(err_cache, nb_path)
+        res = checkIfNBIsAlreadyEvaluated(nb_cache, nb_key)
+        res_err = checkIfNBIsAlreadyEvaluated(err_cache, nb_key)
         if res is not None or res_err is not None:
             print(f"NB {nb_path} is already evaluated, using the cache results")
             return res
 
+    # If an identical notebook was already executed, reuse its results
+    dedup = None
+    dedup_key = None
+    if dedup_cache_path and code_hash is not None:
+        dedup = NBDeduplicator(dedup_cache_path)
+        dedup_key = computeDedupKey(code_hash, requirements)
+        duplicate_results = dedup.reuseResult(dedup_key, nb_path, repo_path)
+        if duplicate_results is not None:
+            print(f"NB {nb_path} is a duplicate of {duplicate_results['duplicate_of']}, reusing its results")
+            nb_cache[nb_key] = duplicate_results
+            return duplicate_results
+
     print(f"* Processing NB: {nb_path}")
     nb = ReadNB(nb_path)
     total_code_cells = nb.getTotalCodeCells()
@@ -256,7 +313,11 @@ def processNB(nb_path, results_cache_path, err_cache_path, resume):
 
     final_execution_result_dict = None
     
-    result = nbExecutionWithFixingMissingModuleANDInputDataANDNameError(nb_path)
+    budget = ExecutionBudget(notebook_budget) if notebook_budget else None
+    with span('fix_loop') as fix_loop_span, archiveScope(nb_key), \
+            scratchWorkspace(repo_path, nb_path, scratch_root) as exec_nb_path:
+        result = nbExecutionWithFixingMissingModuleANDInputDataANDNameError(exec_nb_path, budget, repo_path, run_config)
+        fix_loop_span['executions'] = len(result['all_exec_results'])
     print(f"Result : {result}")
     all_fix_errors_results = result['all_exec_results']
     file_creation_error = result['err_in_file_creation']
@@ -265,6 +326,13 @@ def processNB(nb_path, results_cache_path, err_cache_path, resume):
     success_module_fixing_llm = result['success_module_fixing_llm']
     installed_modules = result['installed_modules']
 
+    # Keep only the compact summary of the per-cell profiles of all executions
+    execution_profile = summarizeExecutionProfiles(all_fix_errors_results)
+    resource_usage = summarizeResourceUsage(all_fix_errors_results, run_config.kernel_limits)
+    for exec_r in all_fix_errors_results:
+        exec_r.pop('profile', None)
+        exec_r.pop('resource_usage', None)
+
     agg_results = aggregateFileModuleNameFixingResults(all_fix_errors_results)
 
     if "last_name_error_found" in agg_results:
@@ -296,6 +364,11 @@ def processNB(nb_path, results_cache_path, err_cache_path, resume):
     else:
         paper_results['Final_max_execute_cells'] = final_execution_result_dict['err_cell_num']
 
+    # A batched repair inserts one definition cell per variable where a single repair inserts one: only the
+    # single one is counted, as in the results of the single repairs
+    if final_execution_result_dict['err_cell_num'] > 0:
+        paper_results['Final_max_execute_cells'] -= sum(max(insertedCells(d) - 1, 0) for d in all_fix_errors_results[:-1])
+
     # RESULTS ANALYSIS
     paper_results['Increased_execution_cells'] = paper_results['Final_max_execute_cells'] - paper_results[
         'Initial_max_execute_cells']
@@ -307,12 +380,18 @@ def processNB(nb_path, results_cache_path, err_cache_path, resume):
     paper_results = {**paper_results, **agg_results}
     paper_results['FileCreationError (Manual)'] = file_creation_error
     paper_results['nb_path'] = nb_path
+    paper_results['repo_path'] = repo_path
     paper_results['total_module_fixing_using_llm'] = total_module_fixing_llm
     paper_results['success_module_fixing_using_llm'] = success_module_fixing_llm
     paper_results['missing_modules'] = installed_modules
     paper_results['ast_status'] = ast_status
+    paper_results['execution_profile'] = execution_profile
+    paper_results['execution_budget'] = budget.summary() if budget is not None else None
+    paper_results['resource_usage'] = resource_usage
 
     print(f'* For screen {paper_results}')
 
-    nb_cache[nb_name] = paper_results
+    nb_cache[nb_key] = paper_results
+    if dedup is not None:
+        dedup.recordResult(dedup_key, nb_path, paper_results)
     return paper_results
@@ -0,0 +1,122 @@
+"""
+Cost model of a repository, used to schedule repositories before they are dispatched to the envs.
+The cost (in expected seconds) of a repository is estimated from:
+- static features of its notebooks: number of notebooks, code cells, import statements and file size
+- the observed execution time of notebooks of the same repository already in the results store (resume)
+- a calibration factor learned from the estimated and actual costs of previous repositories,
+  kept in the cost history [DiskCache]
+The parallel scheduler packs the repositories onto the envs longest-first (LPT), so the heaviest
+repositories start early and the run does not end with one env grinding alone; the sequential
+scheduler runs the shortest first, so most repositories finish early.
+"""
+
+import heapq
+import os
+import re
+from diskcache import Index
+from nb_stream import readNotebookSources
+
+REPO_OVERHEAD_SECONDS = 120     # venv copy and requirements install
+NOTEBOOK_OVERHEAD_SECONDS = 15  # kernel startup and static analysis
+CELL_SECONDS = 3
+IMPORT_SECONDS = 5              # a missing module costs a pip install and a re-execution
+MB_SECONDS = 2                  # large notebooks tend to carry large outputs and data
+MIN_HISTORY = 5                 # repositories needed before the estimates are calibrated
+
+IMPORT_PATTERN = re.compile(r'^\s*(import|from)\s+\w', re.MULTILINE)
+
+
+def notebookFeatures(nb_path):
+    """Code cells, import statements and size in MB of a notebook"""
+    features = {'code_cells': 0, 'imports': 0, 'size_mb': 0.0}
+    try:
+        features['size_mb'] = os.path.getsize(nb_path) / 1024 / 1024
+        nb = readNotebookSources(nb_path)
+    except Exception:
+        return features
+    for cell in nb.get('cells', []):
+        if cell.get('cell_type') != 'code':
+            continue
+        source = cell.get('source', '')
+        if isinstance(source, list):
+            source = ''.join(source)
+        features['code_cells'] += 1
+        features['imports'] += len(IMPORT_PATTERN.findall(source))
+    return features
+
+
+def staticNotebookCost(features):
+    return (NOTEBOOK_OVERHEAD_SECONDS + CELL_SECONDS * features['code_cells'] +
+            IMPORT_SECONDS * features['imports'] + MB_SECONDS * features['size_mb'])
+
+
+def loadObservedNotebookTimes(results_store):
+    """
+    Execution time of every notebook in the results store, by repository
+    :return: dict {repo_path: [seconds, ...]}
+    """
+    observed = {}
+    for _, record in results_store.items():
+        if not isinstance(record, dict) or not record.get('execution_profile'):
+            continue
+        seconds = record['execution_profile'].get('total_execution_time')
+        if seconds is not None and record.get('repo_path'):
+            observed.setdefault(os.path.normpath(record['repo_path']), []).append(seconds)
+    return observed
+
+
+class RepoCostModel:
+    def __init__(self, observed_times=None, history_path=None):
+        """
+        :param observed_times: execution times of evaluated notebooks by repository, from loadObservedNotebookTimes
+        :param history_path: path to the cost history [DiskCache] of previous repositories, used for calibration
+        """
+        self.observed_times = observed_times or {}
+        self.history = Index(history_path) if history_path else None
+        self.calibration = self._calibration()
+
+    def _calibration(self):
+        if self.history is None or len(self.history) < MIN_HISTORY:
+            return 1.0
+        # Calibrate against the uncalibrated estimates
+        estimated = sum(r['estimated'] / r.get('calibration', 1.0) for r in self.history.values())
+        actual = sum(r['actual'] for r in self.history.values())
+        if estimated <= 0:
+            return 1.0
+        return min(max(actual / estimated, 0.1), 10.0)
+
+    def estimate(self, repo_path, nb_paths):
+        """Expected seconds to process the notebooks nb_paths of repo_path"""
+        observed = self.observed_times.get(os.path.normpath(repo_path))
+        if observed:
+            # Notebooks of this repo were already executed: their mean time is the best guess for the rest
+            notebooks_cost = len(nb_paths) * (NOTEBOOK_OVERHEAD_SECONDS + sum(observed) / len(observed))
+        else:
+            notebooks_cost = sum(staticNotebookCost(notebookFeatures(nb_path)) for nb_path in nb_paths)
+        return round((REPO_OVERHEAD_SECONDS + notebooks_cost) * self.calibration, 1)
+
+
+def recordRepoCost(history_path, repo_path, nb_count, estimated, actual, calibration=1.0):
+    """Keep the estimated and actual costs of a processed repository, to check and calibrate the model"""
+    if history_path and estimated is not None:
+        Index(history_path)[repo_path] = {'nb_count': nb_count, 'estimated': estimated, 'calibration': calibration,
+                                          'actual': round(actual, 1)}
+
+
+def packRepos(costs, n_envs):
+    """
+    Assign repositories to envs longest-processing-time first: each repository, heaviest first,
+    goes to the env with the least work so far
+    :param costs: dict {repo_path: estimated cost}
+    :return: (list of repo_path lists, one per env and heaviest first, list of the estimated load of each env)
+    """
+    assignments = [[] for _ in range(n_envs)]
+    loads = [(0.0, env) for env in range(n_envs)]
+    for repo_path in sorted(costs, key=costs.get, reverse=True):
+        load, env = heapq.heappop(loads)
+        assignments[env].append(repo_path)
+        heapq.heappush(loads, (load + costs[repo_path], env))
+    env_loads = [0.0] * n_envs
+    for load, env in loads:
+        env_loads[env] = load
+    return assignments, env_loads
@@ -0,0 +1,226 @@
+"""
+Versioned results store.
+Results are keyed by a stable notebook identity: repository + notebook path relative to the
+repository + hash of the code cells, so notebooks sharing a basename (`main.ipynb`,
+`analysis.ipynb`, ...) never collide, and an edited notebook is evaluated again.
+
+Workers do not write into the shared store directly: each one appends to its own shard under
+`<cache_path>/shards/<shard_id>` with batched commits, and ShardedResultsStore presents the
+root store and all shards as one logical store.
+"""
+
+import os
+import shutil
+from diskcache import Index
+
+RESULTS_SCHEMA_VERSION = 2
+SCHEMA_VERSION_KEY = '__schema_version__'
+KEY_SEPARATOR = '|'
+UNREADABLE_HASH = 'unreadable'
+
+
+class ResultsSchemaError(Exception):
+    pass
+
+
+def notebookLocation(repo_path, nb_path):
+    """
+    Identify a notebook by its repository and its path relative to the repository
+    :return: `repo|relative/path.ipynb`
+    """
+    if repo_path is None:
+        repo_path = os.path.dirname(nb_path)
+    repo_path = os.path.normpath(repo_path)
+    rel_path = os.path.relpath(os.path.normpath(nb_path), repo_path)
+    return f'{repo_path}{KEY_SEPARATOR}{rel_path}'
+
+
+def notebookIdentity(repo_path, nb_path, code_hash):
+    """
+    The key under which the results of a notebook are stored
+    :return: `v2|repo|relative/path.ipynb|code_hash`
+    """
+    code_hash = code_hash or UNREADABLE_HASH
+    return f'v{RESULTS_SCHEMA_VERSION}{KEY_SEPARATOR}{notebookLocation(repo_path, nb_path)}{KEY_SEPARATOR}{code_hash}'
+
+
+def splitNotebookIdentity(key):
+    """Split a key into (location, code_hash); returns None for keys that are not notebook identities."""
+    if not isinstance(key, str) or not key.startswith(f'v{RESULTS_SCHEMA_VERSION}{KEY_SEPARATOR}'):
+        return None
+    location, code_hash = key.split(KEY_SEPARATOR, 1)[1].rsplit(KEY_SEPARATOR, 1)
+    return location, code_hash
+
+
+class ResultsStore:
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.index = Index(cache_path)
+        self._checkSchemaVersion()
+
+    def _checkSchemaVersion(self):
+        # Workers open each other's new shards concurrently: read, count and stamp the version atomically
+        with self.index.transact():
+            version = self.index.get(SCHEMA_VERSION_KEY)
+            if version is None:
+                if len(self.index) > 0:
+                    raise ResultsSchemaError(
+                        f"{self.cache_path} is a legacy results cache, migrate it with migrate_results_cache.py")
+                self.index[SCHEMA_VERSION_KEY] = version = RESULTS_SCHEMA_VERSION
+        if version != RESULTS_SCHEMA_VERSION:
+            raise ResultsSchemaError(
+                f"{self.cache_path} has schema version {version}, expected {RESULTS_SCHEMA_VERSION}")
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        return self.index[key]
+
+    def __setitem__(self, key, record):
+        self.index[key] = record
+
+    def get(self, key, default=None):
+        return self.index.get(key, default)
+
+    def keys(self):
+        for key in self.index.keys():
+            if key != SCHEMA_VERSION_KEY:
+                yield key
+
+    def items(self):
+        for key, record in self.index.items():
+            if key != SCHEMA_VERSION_KEY:
+                yield key, record
+
+    def writeBatch(self, records):
+        """Write several records in a single SQLite transaction"""
+        with self.index.transact():
+            for key, record in records.items():
+                self.index[key] = record
+
+    def loadEvaluatedIndex(self, evaluated=None):
+        """
+        Bulk-load the identities of all stored notebooks into memory
+        :param evaluated: optional dict to extend, so several stores can share one index
+        :return: dict {location: set(code_hash)}
+        """
+        if evaluated is None:
+            evaluated = {}
+        for key in self.keys():
+            parts = splitNotebookIdentity(key)
+            if parts is not None:
+                location, code_hash = parts
+                evaluated.setdefault(location, set()).add(code_hash)
+        return evaluated
+
+
+class ShardedResultsStore:
+    """
+    One logical results store made of the root store and the per-worker shards.
+    With a shard_id, writes are buffered and committed to that worker's shard in batches;
+    without one (orchestrator, export tools), writes go straight to the root store.
+    """
+    SHARDS_DIR = 'shards'
+
+    def __init__(self, cache_path, shard_id=None, batch_size=50):
+        self.cache_path = cache_path
+        self.shard_id = shard_id
+        self.batch_size = batch_size
+        self.pending = {}
+        self.root = ResultsStore(cache_path)
+        self.shards = {}
+
+        shards_path = os.path.join(cache_path, self.SHARDS_DIR)
+        if os.path.isdir(shards_path):
+            for name in sorted(os.listdir(shards_path)):
+                self.shards[name] = ResultsStore(os.path.join(shards_path, name))
+        if shard_id is not None and shard_id not in self.shards:
+            self.shards[shard_id] = ResultsStore(os.path.join(shards_path, shard_id))
+
+    def _stores(self):
+        """All stores, the worker's own shard first and the root store last"""
+        if self.shard_id is not None:
+            yield self.shards[self.shard_id]
+        for name, shard in self.shards.items():
+            if name != self.shard_id:
+                yield shard
+        yield self.root
+
+    def __setitem__(self, key, record):
+        if self.shard_id is None:
+            self.root[key] = record
+            return
+        self.pending[key] = record
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.shards[self.shard_id].writeBatch(self.pending)
+            self.pending = {}
+
+    def close(self):
+        self.flush()
+
+    def __contains__(self, key):
+        return key in self.pending or any(key in store for store in self._stores())
+
+    def get(self, key, default=None):
+        if key in self.pending:
+            return self.pending[key]
+        for store in self._stores():
+            if key in store:
+                return store[key]
+        return default
+
+    def __getitem__(self, key):
+        record = self.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def items(self):
+        """Iterate over all records; a key present in several stores is yielded once, from the first store"""
+        stores = list(self._stores())
+        yield from self.pending.items()
+        for i, store in enumerate(stores):
+            for key, record in store.items():
+                if key in self.pending or any(key in prior for prior in stores[:i]):
+                    continue
+                yield key, record
+
+    def loadEvaluatedIndex(self, evaluated=None):
+        if evaluated is None:
+            evaluated = {}
+        for store in self._stores():
+            store.loadEvaluatedIndex(evaluated)
+        for key in self.pending:
+            parts = splitNotebookIdentity(key)
+            if parts is not None:
+                evaluated.setdefault(parts[0], set()).add(parts[1])
+        return evaluated
+
+    def compact(self):
+        """
+        Merge all shards into the root store and delete them.
+        Only call this when no worker is writing, e.g. at the end of a run.
+        """
+        self.flush()
+        for name, shard in list(self.shards.items()):
+            batch = {}
+            for key, record in shard.items():
+                batch[key] = record
+                if len(batch) >= self.batch_size:
+                    self.root.writeBatch(batch)
+                    batch = {}
+            self.root.writeBatch(batch)
+            shard.index.cache.close()
+            shutil.rmtree(os.path.join(self.cache_path, self.SHARDS_DIR, name), ignore_errors=True)
+            del self.shards[name]
+        self.shard_id = None
+
+
+def isNotebookEvaluated(evaluated, repo_path, nb_path, code_hash):
+    """O(1) membership test against the index returned by ResultsStore.loadEvaluatedIndex"""
+    return (code_hash or UNREADABLE_HASH) in evaluated.get(notebookLocation(repo_path, nb_path), ())
@@ -0,0 +1,50 @@
+"""
+Run configuration file shared by main.py and create_envs.py: a JSON object whose keys are the
+command-line options (without the leading dashes), e.g.
+    {"backup_envs_path": "/data/envs/backup", "source_envs_path": "/data/envs/source", "max_envs": 16}
+Options given on the command line take precedence over the file. Keys that a script does not know are
+left to the other script, so both can read the same file.
+
+RunConfig holds the options of the run that change how each notebook is executed and fixed. processNB
+passes it on to the executions and the fixes of the notebook.
+"""
+
+import json
+
+
+def parseArgsWithConfig(parser, required=()):
+    """
+    Parse the command line, taking the defaults of the options from the --config file
+    :param parser: the argparse parser of the script; a --config option is added to it
+    :param required: destinations of the options that must be given, on the command line or in the file
+    :return: the parsed arguments
+    """
+    parser.add_argument('--config', type=str, default=None, help='JSON file with the values of any of these options')
+    args, _ = parser.parse_known_args()
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        known = {action.dest for action in parser._actions}
+        parser.set_defaults(**{key: value for key, value in config.items() if key in known})
+    args = parser.parse_args()
+    missing = [f'--{name}' for name in required if getattr(args, name) is None]
+    if missing:
+        parser.error(f"the following arguments are required (on the command line or in --config): {', '.join(missing)}")
+    return args
+
+
+class RunConfig:
+    def __init__(self, kernel_limits=None, block_network=False, lean_execution=False, pip_policy=None,
+                 batch_name_repair=False):
+        """
+        :param kernel_limits: KernelLimits of the notebook kernels, None for no limits
+        :param block_network: start the kernels without network access
+        :param lean_execution: execute the notebooks with the lean papermill engine
+        :param pip_policy: PipPolicy of the installs of missing modules, None for the default policy
+        :param batch_name_repair: define all the variables a notebook never defines with its first NameError
+        """
+        self.kernel_limits = kernel_limits
+        self.block_network = bool(block_network)
+        self.lean_execution = bool(lean_execution)
+        self.pip_policy = pip_policy
+        self.batch_name_repair = bool(batch_name_repair)
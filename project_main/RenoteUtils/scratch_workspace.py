@@ -0,0 +1,49 @@
+"""
+Scratch workspaces: each notebook of a repository is executed in its own copy of the repository,
+so notebooks of the same repository can run in parallel on one env. Generated input files,
+`_NameFixed` / `_reordered_temp` notebooks and outputs are written to the copy and discarded with it.
+The copy is made with `cp --reflink=auto`, which shares the file data copy-on-write on file systems
+supporting it (btrfs, XFS, ...), and falls back to a plain copy elsewhere.
+Results are still keyed on the original notebook path.
+"""
+
+import os
+import shutil
+import subprocess
+import uuid
+from contextlib import contextmanager
+from work_journal import addCleanupObligation
+
+SCRATCH_PREFIX = 'renote-scratch-'
+
+
+def copyRepository(repo_path, target):
+    """Copy repo_path to target (which must not exist), copy-on-write where possible"""
+    r = subprocess.run(['cp', '-a', '--reflink=auto', repo_path, target], capture_output=True)
+    if r.returncode != 0:
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.copytree(repo_path, target, symlinks=True)
+
+
+@contextmanager
+def scratchWorkspace(repo_path, nb_path, scratch_root):
+    """
+    Yield the path of the notebook inside a scratch copy of its repository, removed on exit
+    :param repo_path: the repository of the notebook
+    :param nb_path: the notebook, inside repo_path
+    :param scratch_root: directory of the scratch copies; None to execute the notebook in place
+    """
+    if not scratch_root or repo_path is None:
+        yield nb_path
+        return
+
+    # The owner pid in the name tells the disk governor whether the copy is orphaned
+    workspace = os.path.join(scratch_root, f'{SCRATCH_PREFIX}{os.getpid()}-{uuid.uuid4().hex}')
+    addCleanupObligation(workspace)
+    os.makedirs(workspace)
+    scratch_repo = os.path.join(workspace, os.path.basename(os.path.normpath(repo_path)))
+    try:
+        copyRepository(repo_path, scratch_repo)
+        yield os.path.join(scratch_repo, os.path.relpath(nb_path, repo_path))
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
@@ -0,0 +1,128 @@
+"""
+Span tracing of the notebook pipeline.
+Every process writes complete events ("ph": "X") of the Chrome trace event format, one JSON object
+per line, to its own file `<trace_dir>/trace-<worker>-<pid>.jsonl`. merge_traces.py combines the
+files of all workers into one timeline that can be opened in chrome://tracing or Perfetto.
+In a process that did not enable tracing, span() is a no-op.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_trace_dir = None
+_worker_id = None
+_trace_file = None
+_trace_file_pid = None
+_lock = threading.Lock()
+# Per thread and per asyncio task, so concurrent repos of the supervisor keep their own ids
+_context = ContextVar('trace_context', default=({},))
+
+
+def enableTracing(trace_dir, worker_id=None):
+    """
+    Start writing spans of this process (and of its forked children) to trace_dir
+    :param trace_dir: directory of the per-worker trace files, created if needed
+    :param worker_id: name shown for this process in the timeline, e.g. the env name
+    """
+    global _trace_dir, _worker_id
+    if not trace_dir:
+        return
+    os.makedirs(trace_dir, exist_ok=True)
+    _trace_dir = trace_dir
+    _worker_id = worker_id
+
+
+def isTracingEnabled():
+    return _trace_dir is not None
+
+
+def _getTraceFile():
+    """Open the trace file lazily, and again after a fork, so each process writes its own file"""
+    global _trace_file, _trace_file_pid
+    pid = os.getpid()
+    if _trace_file is None or _trace_file_pid != pid:
+        worker = _worker_id or 'main'
+        _trace_file = open(os.path.join(_trace_dir, f'trace-{worker}-{pid}.jsonl'), 'a', encoding='utf-8')
+        _trace_file_pid = pid
+        _writeEvent({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': f'{worker} ({pid})'}})
+    return _trace_file
+
+
+def _writeEvent(event):
+    _trace_file.write(json.dumps(event, default=str) + '\n')
+    _trace_file.flush()
+
+
+def _currentContext():
+    return _context.get()
+
+
+@contextmanager
+def traceContext(**ids):
+    """Attach ids (e.g. repo=..., nb=...) to every span opened inside this block"""
+    stack = _currentContext()
+    token = _context.set(stack + ({**stack[-1], **ids},))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+@contextmanager
+def span(name, category='renote', **args):
+    """
+    Record the wall time of the enclosed block as one span
+    :param name: the phase, e.g. `venv_copy`, `execute_notebook`, `llm_call`
+    :param args: extra values shown with the span; the traceContext ids are added automatically
+    """
+    if _trace_dir is None:
+        yield args
+        return
+
+    start = time.time()
+    try:
+        yield args
+    finally:
+        end = time.time()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.get_ident() % 100000,
+            'args': {**_currentContext()[-1], **args},
+        }
+        with _lock:
+            _getTraceFile()
+            _writeEvent(event)
+
+
+def mergeTraceFiles(trace_dir, output_path):
+    """
+    Merge the per-worker trace files into one Chrome trace JSON file
+    :return: the number of events written
+    """
+    events = []
+    for filename in sorted(os.listdir(trace_dir)):
+        if not (filename.startswith('trace-') and filename.endswith('.jsonl')):
+            continue
+        with open(os.path.join(trace_dir, filename), 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # The last line of a worker that was killed can be truncated
+                    continue
+    events.sort(key=lambda e: e.get('ts', 0))
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
@@ -0,0 +1,259 @@
+"""
+Crash-safe work journal of the repositories and notebooks being processed.
+The journal is an append-only JSONL file shared by the orchestrator and all workers; every record is
+fsync'ed before the work it describes goes on. For each unit of work (a repo or a notebook):
+- start: the owner (host, boot, pid) takes a lease, renewed by a heartbeat while the work runs
+- obligation: a file or directory about to be created by the work (generated input files, `_NameFixed` /
+  `_reordered_temp` notebooks, scratch copies, per-env JSON files), written before the file is created
+- done: the work is finished and its results are durable; its obligations were rolled back first
+- rolled_back: the obligations of an abandoned work were removed
+On restart, recoverJournal rolls back the obligations of the work whose lease expired or whose owner is
+gone (including after a reboot), compacts the journal, and returns the finished notebooks, so only the
+unfinished ones are queued again.
+"""
+
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+DEFAULT_LEASE_SECONDS = 600
+REPO = 'repo'
+NOTEBOOK = 'nb'
+
+_journal_path = None
+_lease_seconds = DEFAULT_LEASE_SECONDS
+# Per thread and per asyncio task, so concurrent repos of the supervisor keep their own obligations
+_context = ContextVar('journal_work', default=())
+
+
+def _bootId():
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+HOST = socket.gethostname()
+BOOT_ID = _bootId()
+
+
+def enableJournal(journal_path, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Journal the work of this process (and of its forked children) to journal_path
+    :param journal_path: the JSONL journal, shared by all processes of the run
+    :param lease_seconds: how long a unit of work stays claimed without a heartbeat
+    """
+    global _journal_path, _lease_seconds
+    if not journal_path:
+        return
+    directory = os.path.dirname(os.path.abspath(journal_path))
+    os.makedirs(directory, exist_ok=True)
+    _journal_path = journal_path
+    _lease_seconds = lease_seconds
+
+
+def isJournalEnabled():
+    return _journal_path is not None
+
+
+def _append(record):
+    """Append one record and make it durable; a single write of one line is atomic with O_APPEND"""
+    record['ts'] = time.time()
+    line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+    fd = os.open(_journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _readJournal(journal_path):
+    records = []
+    if not os.path.exists(journal_path):
+        return records
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A record torn by a crash in the middle of a write
+                continue
+    return records
+
+
+def _workStack():
+    return _context.get()
+
+
+class _Lease:
+    """Claims a unit of work and keeps the claim alive from a heartbeat thread"""
+    def __init__(self, scope, key):
+        self.scope = scope
+        self.key = key
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _record(self, event, **fields):
+        _append({'event': event, 'scope': self.scope, 'key': self.key, **fields})
+
+    def start(self):
+        self._record('start', host=HOST, boot_id=BOOT_ID, pid=os.getpid(), expires=time.time() + _lease_seconds)
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(_lease_seconds / 3):
+            self._record('renew', pid=os.getpid(), expires=time.time() + _lease_seconds)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+@contextmanager
+def journaledWork(scope, key):
+    """
+    Journal the work done inside this block: its lease, its cleanup obligations and its completion.
+    The obligations are rolled back when the block exits, whether it completes or raises.
+    :param scope: REPO or NOTEBOOK
+    :param key: the repo path, or the notebook identity
+    """
+    if _journal_path is None:
+        yield
+        return
+
+    lease = _Lease(scope, key)
+    lease.start()
+    work = {'scope': scope, 'key': key, 'obligations': []}
+    token = _context.set(_workStack() + (work,))
+    completed = False
+    try:
+        yield
+        completed = True
+    finally:
+        _context.reset(token)
+        lease.stop()
+        rollBack(work['obligations'])
+        lease._record('done' if completed else 'rolled_back')
+
+
+def addCleanupObligation(path):
+    """
+    Journal that the current work is about to create path, so it is removed if the work is abandoned.
+    Call it before creating the file; paths that already exist are never rolled back.
+    """
+    stack = _workStack()
+    if _journal_path is None or not stack or os.path.lexists(path):
+        return
+    work = stack[-1]
+    path = os.path.abspath(path)
+    work['obligations'].append(path)
+    _append({'event': 'obligation', 'scope': work['scope'], 'key': work['key'], 'path': path})
+
+
+def firstMissingAncestor(path):
+    """The outermost directory of path that does not exist yet (path itself if its parent exists)"""
+    path = os.path.abspath(path)
+    missing = path
+    parent = os.path.dirname(path)
+    while parent != missing and not os.path.exists(parent):
+        missing = parent
+        parent = os.path.dirname(parent)
+    return missing
+
+
+def rollBack(paths):
+    for path in reversed(paths):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.lexists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f'>> Cannot roll back {path}: {e}')
+
+
+def _isLeaseLive(work, now):
+    if work['expires'] < now:
+        return False
+    if work['host'] == HOST:
+        if work['boot_id'] != BOOT_ID:
+            return False
+        try:
+            os.kill(work['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+    return True
+
+
+def recoverJournal():
+    """
+    Roll back the unfinished work of dead owners and compact the journal.
+    Call it before dispatching work, e.g. when the orchestrator starts.
+    :return: dict {REPO: set of finished repo paths, NOTEBOOK: set of finished notebook identities,
+                   'leased': set of (scope, key) still held by live owners}
+    """
+    if _journal_path is None:
+        return {REPO: set(), NOTEBOOK: set(), 'leased': set()}
+
+    works = {}
+    for record in _readJournal(_journal_path):
+        work_id = (record.get('scope'), record.get('key'))
+        event = record.get('event')
+        if event == 'start':
+            works[work_id] = {'done': False, 'host': record['host'], 'boot_id': record['boot_id'], 'pid': record['pid'],
+                              'expires': record['expires'], 'obligations': [], 'records': [record]}
+            continue
+        work = works.get(work_id)
+        if work is None:
+            if event == 'done':
+                # A compacted journal keeps only the done records
+                works[work_id] = {'done': True, 'records': [record]}
+            continue
+        work['records'].append(record)
+        if event == 'renew':
+            work['expires'] = max(work['expires'], record['expires'])
+        elif event == 'obligation':
+            work['obligations'].append(record['path'])
+        elif event == 'done':
+            work['done'] = True
+        elif event == 'rolled_back':
+            work['obligations'] = []
+
+    now = time.time()
+    finished = {REPO: set(), NOTEBOOK: set(), 'leased': set()}
+    kept = []
+    rolled_back = 0
+    for (scope, key), work in works.items():
+        if work['done']:
+            finished.setdefault(scope, set()).add(key)
+            kept.append({'event': 'done', 'scope': scope, 'key': key, 'ts': work['records'][-1].get('ts')})
+        elif _isLeaseLive(work, now):
+            finished['leased'].add((scope, key))
+            kept += work['records']
+        elif work['obligations']:
+            rollBack(work['obligations'])
+            rolled_back += 1
+
+    # Rewrite the journal with what is still needed: the finished work and the live leases
+    tmp_path = f'{_journal_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in kept:
+            f.write(json.dumps(record, default=str) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, _journal_path)
+
+    print(f"Journal: {len(finished[NOTEBOOK])} notebooks and {len(finished[REPO])} repos done, "
+          f"{rolled_back} abandoned works rolled back, {len(finished['leased'])} still leased")
+    return finished
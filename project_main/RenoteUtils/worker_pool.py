@@ -0,0 +1,188 @@
+"""
+Resource-aware sizing of the env worker pool.
+The number of envs processing repositories is taken from the machine instead of a fixed count:
+- cores: one env per core to start with, then more or fewer envs as the load average stays low or high
+- memory: the available memory divided by the memory of one env, which is the configured estimate
+  until the process trees of the running envs (process_repo.py and its kernels) have been measured
+- disk: every env needs its own copy of the backup venv on the envs volume
+The pool is resized during the run: it grows by one env at a time and shrinks at once, and an env
+that leaves the pool first finishes its current repository. An env without a backup venv is provisioned
+on demand by cloning an existing backup venv.
+"""
+
+import asyncio
+import os
+import shutil
+from disk_governor import directorySize
+from exec_profile import readProcStatusKB
+from kernel_limits import findDescendants
+from metrics import emitEvent
+
+DEFAULT_ENV_MEMORY_MB = 2048
+DISK_RESERVE_MB = 5 * 1024      # free space left on the envs volume when sizing the pool
+HIGH_LOAD = 1.5                 # load average per core above which the pool shrinks
+LOW_LOAD = 0.7                  # load average per core below which the pool may grow
+MEMORY_HEADROOM = 1.2           # margin on the largest env memory observed
+RESIZE_INTERVAL = 60
+
+
+def envName(i):
+    return f'nb{i}_venv'
+
+
+def availableMemoryMB():
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def cpuCount():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def processTreeRSSMB(pid):
+    """Resident memory of a process and of all processes below it, in MB"""
+    return sum(readProcStatusKB(p, 'VmRSS') or 0 for p in [pid] + findDescendants(pid)) / 1024
+
+
+def provisionEnv(backup_envs_path, source_envs_path, template_env, env):
+    """
+    Create the backup venv of env by cloning the backup venv template_env.
+    The venvs are used from source_envs_path, so the paths of the template written in bin/ are rewritten.
+    """
+    template_path = os.path.join(backup_envs_path, template_env)
+    env_path = os.path.join(backup_envs_path, env)
+    print(f'Provisioning the env {env} from {template_env}')
+    shutil.copytree(template_path, env_path, symlinks=True)
+    old_prefix = os.path.join(source_envs_path, template_env).encode()
+    new_prefix = os.path.join(source_envs_path, env).encode()
+    bin_dir = os.path.join(env_path, 'bin')
+    for name in os.listdir(bin_dir):
+        path = os.path.join(bin_dir, name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            content = f.read()
+        if old_prefix in content:
+            with open(path, 'wb') as f:
+                f.write(content.replace(old_prefix, new_prefix))
+    emitEvent('env_provisioned', env=env, template=template_env)
+
+
+class WorkerPoolSizer:
+    def __init__(self, backup_envs_path, source_envs_path, max_envs=32, env_memory_mb=None, interval=RESIZE_INTERVAL, provision=True):
+        """
+        :param backup_envs_path: directory of the backup venvs nb1_venv, nb2_venv, ...
+        :param source_envs_path: directory of the working copies of the venvs
+        :param max_envs: largest number of envs of the pool
+        :param env_memory_mb: memory of one env (process_repo.py and its kernels) until it is measured
+        :param interval: seconds between two resizes
+        :param provision: whether missing backup venvs are cloned; replayed runs use no venv
+        """
+        self.backup_envs_path = backup_envs_path
+        self.source_envs_path = source_envs_path
+        self.max_envs = max_envs
+        self.env_memory_mb = env_memory_mb or DEFAULT_ENV_MEMORY_MB
+        self.interval = interval
+        self.provision_envs = provision
+        self.peak_env_memory_mb = 0.0
+        self.env_size_mb = None
+
+    def allEnvs(self):
+        """Names of all the envs the pool may use"""
+        return [envName(i) for i in range(1, self.max_envs + 1)]
+
+    def _envSizeMB(self):
+        if self.env_size_mb is None:
+            template = self.templateEnv()
+            self.env_size_mb = directorySize(os.path.join(self.backup_envs_path, template)) / 1024 / 1024 if template else 0
+        return self.env_size_mb
+
+    def templateEnv(self):
+        for env in self.allEnvs():
+            if os.path.isdir(os.path.join(self.backup_envs_path, env)):
+                return env
+        return None
+
+    def envMemoryMB(self):
+        if self.peak_env_memory_mb:
+            return self.peak_env_memory_mb * MEMORY_HEADROOM
+        return self.env_memory_mb
+
+    def capacity(self, active, used_memory_mb=0.0):
+        """Number of envs that the memory and disk allow, counting the memory already used by the active envs"""
+        capacity = self.max_envs
+        available_mb = availableMemoryMB()
+        if available_mb is not None:
+            capacity = min(capacity, int((available_mb + used_memory_mb) // self.envMemoryMB()))
+        env_size_mb = self._envSizeMB()
+        if env_size_mb and os.path.isdir(self.source_envs_path):
+            free_mb = shutil.disk_usage(self.source_envs_path).free / 1024 / 1024
+            capacity = min(capacity, active + int(max(free_mb - DISK_RESERVE_MB, 0) // env_size_mb))
+        return capacity
+
+    def initialSize(self):
+        size = max(1, min(cpuCount(), self.capacity(0)))
+        print(f"Worker pool: {size} envs ({cpuCount()} cores, {availableMemoryMB()} MB available, "
+              f"{self.envMemoryMB():.0f} MB per env, at most {self.max_envs})")
+        return size
+
+    def targetSize(self, active, env_memory_mb):
+        """
+        Size of the pool after observing the active envs
+        :param env_memory_mb: dict {env: current memory of its process tree in MB}
+        """
+        if env_memory_mb:
+            self.peak_env_memory_mb = max(self.peak_env_memory_mb, max(env_memory_mb.values()))
+        load = os.getloadavg()[0] / cpuCount()
+        target = self.capacity(active, sum(env_memory_mb.values()))
+        if load > HIGH_LOAD:
+            target = min(target, active - 1)
+        elif load < LOW_LOAD:
+            target = min(target, active + 1)
+        else:
+            target = min(target, active)
+        return max(1, target), load
+
+    def provision(self, envs):
+        """Create the backup venvs missing for envs; return the envs that can be used"""
+        if not self.provision_envs:
+            return list(envs)
+        template = self.templateEnv()
+        ready = []
+        for env in envs:
+            if not os.path.isdir(os.path.join(self.backup_envs_path, env)):
+                if template is None:
+                    break
+                try:
+                    provisionEnv(self.backup_envs_path, self.source_envs_path, template, env)
+                except OSError as e:
+                    print(f'>> Cannot provision the env {env}: {e}')
+                    break
+            ready.append(env)
+        return ready
+
+    async def autoscale(self, pool):
+        """Resize the pool every interval until it is done"""
+        while True:
+            await asyncio.sleep(self.interval)
+            active = len(pool.active)
+            env_memory_mb = {env: processTreeRSSMB(process.pid) for env, process in pool.runningStages().items()}
+            target, load = self.targetSize(active, env_memory_mb)
+            if target == active:
+                continue
+            envs = await asyncio.to_thread(self.provision, self.allEnvs()[:target])
+            if len(envs) == active:
+                continue
+            print(f'>> Worker pool: {active} -> {len(envs)} envs (load {load:.2f} per core, '
+                  f'{self.envMemoryMB():.0f} MB per env, {availableMemoryMB()} MB available)')
+            emitEvent('pool_resized', size=len(envs), previous=active, load=load, env_memory_mb=self.envMemoryMB())
+            pool.scaleTo(envs)
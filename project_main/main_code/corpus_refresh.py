@@ -0,0 +1,120 @@
+"""
+Git-aware incremental refresh of the corpus.
+A snapshot of every repository is kept [DiskCache]: its git HEAD, the hash of its dependency manifests and,
+for each notebook, the hash of its code cells with the size and mtime of the file. When the corpus is pulled
+again, planRefresh compares each repository with its snapshot:
+- the notebooks that `git diff --name-only <recorded HEAD>` does not list (or, without git, whose size and
+  mtime did not change) keep their recorded hash and are not read at all
+- the other notebooks are hashed again; a notebook with a new hash has no result yet, so it is evaluated
+- if a manifest changed, every notebook of the repository is evaluated again, as its results depend on
+  the installed packages
+Unchanged notebooks keep their results, since results are keyed on the code hash, so a refresh costs
+time in proportion to what changed. The snapshot of a repository is written once it is processed.
+"""
+
+import os
+import subprocess
+import time
+from diskcache import Index
+from requirement_file_process import computeManifestHash, manifest_kind, is_requirements_file
+from nb_dedup import computeCodeHash
+
+
+def _git(repo_path, *args):
+    r = subprocess.run(['git', '-C', repo_path, *args], capture_output=True, text=True)
+    return r.stdout if r.returncode == 0 else None
+
+
+def gitHead(repo_path):
+    """The HEAD commit of the repository, None if repo_path is not the top of a git repository"""
+    out = _git(repo_path, 'rev-parse', '--show-toplevel', 'HEAD')
+    if out is None:
+        return None
+    toplevel, head = out.split()
+    # A repository copied inside another git repository must not take the HEAD of its parent
+    if os.path.realpath(toplevel) != os.path.realpath(repo_path):
+        return None
+    return head
+
+
+def gitChangedFiles(repo_path, old_head):
+    """Paths, relative to the repository, that differ between old_head and the working tree; None if old_head is unknown"""
+    out = _git(repo_path, 'diff', '--name-only', '--no-renames', old_head)
+    if out is None:
+        return None
+    return {os.path.normpath(path) for path in out.splitlines() if path}
+
+
+def _fileStat(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def planRepoRefresh(repo_path, nb_paths, snapshot):
+    """
+    Compare a repository with its snapshot
+    :param snapshot: the recorded snapshot of the repository, None if it was never processed
+    :return: (new snapshot, dict {nb_path: code hash}, whether the manifests changed, number of notebooks hashed)
+    """
+    snapshot = snapshot or {}
+    recorded = snapshot.get('notebooks', {})
+    head = gitHead(repo_path)
+    changed = gitChangedFiles(repo_path, snapshot['head']) if head and snapshot.get('head') else None
+
+    if changed is not None:
+        manifests_changed = any(manifest_kind(os.path.basename(path)) or is_requirements_file(os.path.basename(path))
+                                for path in changed)
+        manifest_hash = computeManifestHash(repo_path) if manifests_changed else snapshot['manifest_hash']
+    else:
+        manifest_hash = computeManifestHash(repo_path)
+        manifests_changed = 'manifest_hash' in snapshot and manifest_hash != snapshot['manifest_hash']
+
+    code_hashes = {}
+    notebooks = {}
+    hashed = 0
+    for nb_path in nb_paths:
+        if "ipynb_checkpoints" in nb_path or not os.path.exists(nb_path):
+            continue
+        rel_path = os.path.normpath(os.path.relpath(nb_path, repo_path))
+        stat = _fileStat(nb_path)
+        entry = recorded.get(rel_path)
+        if entry is not None and (rel_path not in changed if changed is not None else tuple(entry['stat']) == stat):
+            code_hash = entry['hash']
+        else:
+            code_hash = computeCodeHash(nb_path)
+            hashed += 1
+        code_hashes[nb_path] = code_hash
+        notebooks[rel_path] = {'hash': code_hash, 'stat': stat}
+
+    new_snapshot = {'head': head, 'manifest_hash': manifest_hash, 'notebooks': notebooks, 'time': time.time()}
+    return new_snapshot, code_hashes, manifests_changed, hashed
+
+
+def planRefresh(all_repos, snapshot_path):
+    """
+    Compare every repository of the corpus with its snapshot
+    :param all_repos: dict {repo_path: [nb_path, ...]}
+    :param snapshot_path: path to the repository snapshots [DiskCache]
+    :return: dict with code_hashes {nb_path: code hash}, stale_repos (repos whose manifests changed)
+             and snapshots {repo_path: snapshot to record once the repo is processed}
+    """
+    snapshots = Index(snapshot_path)
+    plan = {'code_hashes': {}, 'stale_repos': set(), 'snapshots': {}}
+    hashed = 0
+    total = 0
+    for repo_path, nb_paths in all_repos.items():
+        snapshot, code_hashes, manifests_changed, repo_hashed = planRepoRefresh(repo_path, nb_paths, snapshots.get(repo_path))
+        plan['code_hashes'].update(code_hashes)
+        plan['snapshots'][repo_path] = snapshot
+        if manifests_changed:
+            plan['stale_repos'].add(repo_path)
+        hashed += repo_hashed
+        total += len(code_hashes)
+    print(f"Refresh: {hashed}/{total} notebooks changed or new, dependency manifests changed in {len(plan['stale_repos'])} repos")
+    return plan
+
+
+def recordRepoSnapshot(snapshot_path, repo_path, snapshot):
+    """Keep the snapshot of a repository whose notebooks are all evaluated"""
+    if snapshot_path and snapshot is not None:
+        Index(snapshot_path)[repo_path] = snapshot
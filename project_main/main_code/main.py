@@ -1,11 +1,10 @@
-import subprocess
+import asyncio
 import json
 import sys
 import argparse
 import os
+import time
 import pandas as pd
-from diskcache import Index
-from joblib import Parallel, delayed
 
 sys.path.append('../RenoteUtils/')
  
@@ -19,30 +18,22 @@ if sys.version_info >= (3, 12):
     collections.MutableSet = collections.abc.MutableSet
     collections.Callable = collections.abc.Callable
 
-from process_nb import processNB, checkIfNBIsAlreadyEvaluated
-from requirement_file_process import convertRequirementFile, findRequirementsFile
+from requirement_file_process import writeMergedRequirementsFile
 from nb_utils import readNoteBook
-
-
-def divide_list_into_parts(lst, num_parts):
-    out = []
-    if num_parts < len(lst):
-        step = len(lst) // num_parts
-        i = 0
-        count = 0
-        while count < num_parts:
-            out.append(lst[i:i + step])
-            i += step
-            count += 1
-
-        while i < len(lst):
-            out[-1].append(lst[i])
-            i += 1
-    else:
-        for i in range(len(lst)):
-            out.append([lst[i]])
-
-    return out
+from nb_dedup import computeCodeHash
+from results_store import ShardedResultsStore, notebookIdentity, isNotebookEvaluated
+from trace_utils import enableTracing, traceContext, span
+from metrics import enableMetrics, emitEvent, MetricsAggregator
+from exec_budget import DEFAULT_NOTEBOOK_BUDGET
+from repo_cost import RepoCostModel, loadObservedNotebookTimes, recordRepoCost, packRepos
+from work_journal import enableJournal, recoverJournal, journaledWork, addCleanupObligation, REPO, NOTEBOOK
+from disk_governor import DiskGovernor, DiskSpaceExhausted, setDiskGovernor, getDiskGovernor, acquirePipCacheLock, DISK_FULL, DEFAULT_MAX_PAUSE_SECONDS
+from env_supervisor import runSupervisor, runStage, COPY, INSTALL, EXECUTE, DEFAULT_STAGE_TIMEOUTS
+from corpus_refresh import planRefresh, recordRepoSnapshot
+from worker_pool import WorkerPoolSizer, envName, DEFAULT_ENV_MEMORY_MB
+from run_config import parseArgsWithConfig
+
+MAIN_CODE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 def readAllCSVToDict(directory_path):
@@ -87,24 +78,35 @@ def combineAllNBPaths(project_dict):
     return all_nb_paths
 
 
-def filterEvaluatedNB(all_repos, results_cache, err_cache):
+def filterEvaluatedNB(all_repos, results_cache, err_cache, journaled_nbs=None, refresh=None):
+    # journaled_nbs: identities of the notebooks the work journal records as done or leased by a live worker
+    # refresh: plan of planRefresh, with the known code hashes and the repos whose manifests changed
     filtered_dict = {}
+    journaled_nbs = journaled_nbs or set()
+    code_hashes = refresh['code_hashes'] if refresh else {}
+    stale_repos = refresh['stale_repos'] if refresh else set()
+
+    # Load the identities of all evaluated notebooks once, instead of one cache lookup per notebook
+    evaluated = results_cache.loadEvaluatedIndex()
+    evaluated = err_cache.loadEvaluatedIndex(evaluated)
 
     for repo_path, nb_paths in all_repos.items():
         filtered_nb_paths = []
         for nb_path in nb_paths:
             if "ipynb_checkpoints" in nb_path:
                 continue
-            nb_name = os.path.basename(nb_path)
-            res = checkIfNBIsAlreadyEvaluated(results_cache, nb_name)
-            res_err = checkIfNBIsAlreadyEvaluated(err_cache, nb_path)
-            if res is None and res_err is None:
+            code_hash = code_hashes[nb_path] if nb_path in code_hashes else computeCodeHash(nb_path)
+            # The results of a repo whose dependency manifests changed are all out of date
+            stale = repo_path in stale_repos
+            if not stale and notebookIdentity(repo_path, nb_path, code_hash) in journaled_nbs:
+                continue
+            if stale or not isNotebookEvaluated(evaluated, repo_path, nb_path, code_hash):
                 # filtered_nb_paths.append(nb_path)
                 result = readNoteBook(nb_path)
                 if result[1] == "Success":
                     filtered_nb_paths.append(nb_path)
                 else:
-                    err_cache[nb_path] = {"nb_path": nb_path, "status": result[1]}
+                    err_cache[notebookIdentity(repo_path, nb_path, code_hash)] = {"nb_path": nb_path, "repo_path": repo_path, "status": result[1]}
         if filtered_nb_paths:
             if repo_path not in filtered_dict:
                 filtered_dict[repo_path] = []
@@ -113,7 +115,7 @@ def filterEvaluatedNB(all_repos, results_cache, err_cache):
     return filtered_dict
 
 
-def shellProcessNB(local_env, config):
+async def processRepoOnEnv(local_env, config):
     repo_path = config['repo_path']
     nb_paths = config['nb_paths']       # list
     json_paths = config['json_paths']
@@ -124,177 +126,395 @@ def shellProcessNB(local_env, config):
     source_venv_path = os.path.join(config['source_envs_path'], local_env)
     i = config['index']
     repo_name = os.path.basename(repo_path)
+    timeouts = config.get('stage_timeouts') or DEFAULT_STAGE_TIMEOUTS
+    # Replayed runs do not install anything, so they run in the current interpreter without a venv
+    replay = config.get('archive_mode') == 'replay'
+    governor = getDiskGovernor()
+    if governor is not None:
+        # Do not start copying the env and installing the requirements on a (nearly) full disk
+        try:
+            await asyncio.to_thread(governor.waitForSpace, local_env)
+        except DiskSpaceExhausted as e:
+            print(f'>> Repo {repo_name} skipped on {local_env}: {e}')
+            emitEvent('repo_skipped', env=local_env, repo=repo_path, reason=DISK_FULL)
+            for nb_path in nb_paths:
+                emitEvent('notebook_done', repo=repo_path, nb=nb_path, status=DISK_FULL, duration=0)
+            return
+    emitEvent('repo_start', env=local_env, repo=repo_path, nb_count=len(nb_paths))
+    repo_start = time.time()
 
     print(
         f"        ############################# [{i + 1}/{config['total_repos']}] START ANALYSIS FOR REPO `{repo_name}` #############################")
     print(f'Env {local_env} is processing the repo {repo_name}')
 
-    # Check if the backup path exists or not
-    if not os.path.exists(backup_venv_path):
-        raise FileNotFoundError(f"Backup virtual environment path '{backup_venv_path}' does not exist.")
-
-    # Check if the old path exists or not
-    if not os.path.exists(source_venv_path):
-        print(f'Source venv not existing. Copying from the backup venv to {source_venv_path}')
-        subprocess.run(f"cp -r {backup_venv_path} {config['source_envs_path']}", shell=True)
-        # raise FileNotFoundError(f"Old virtual environment path '{source_venv_path}' does not exist.")
-    else:
-        # Delete the old venv
-        print(f'Deleting the old venv: {source_venv_path}')
-        subprocess.run(f'rm -rf {source_venv_path}', shell=True)
-
-        # Copy the backup venv to the old venv
-        print(f'Copying the backup venv to the old venv: {source_venv_path}')
-        subprocess.run(f"cp -r {backup_venv_path} {config['source_envs_path']}", shell=True)
-
-    # Activate the virtual environment
-    activate_script = os.path.join(source_venv_path, 'bin', 'activate')
-    command_activate = f'source {activate_script} &&'
-
-    # Install requirements, if any
-    requirements_file = findRequirementsFile(repo_path)
+    # A failed copy or install still releases the env, removes the requirements file and is counted
     out_req_file = None
-    command_install_requirements = ''
-    if requirements_file:
-        out_req_file = convertRequirementFile(requirements_file)
-        command_install_requirements = f'pip install -r {out_req_file} &&'
-
-    data = {
-        'repo_path': repo_path,
-        'nb_paths': nb_paths,
-        'results_cache_path': results_cache_path,
-        'err_cache_path': err_cache_path,
-        'resume': resume
-    }
-
-    # Save the data to a json file
-    json_path = os.path.join(json_paths, f'{os.path.basename(source_venv_path)}.json')
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4)
-
-    # Run the process_repo.py script
-    command_run_process_repo = f'python process_repo.py --json_path {json_path} &&'
+    try:
+        with traceContext(repo=repo_path, env=local_env), span('repo', nb_count=len(nb_paths)), journaledWork(REPO, repo_path):
+            # Check if the backup path exists or not
+            if not replay and not os.path.exists(backup_venv_path):
+                raise FileNotFoundError(f"Backup virtual environment path '{backup_venv_path}' does not exist.")
+
+            if not replay:
+                with span('venv_copy'):
+                    # Replace the copy left by the previous repo of this env with a fresh copy of the backup venv
+                    print(f'Copying the backup venv to {source_venv_path}')
+                    returncode = await runStage(f"rm -rf {source_venv_path} && cp -r {backup_venv_path} {config['source_envs_path']}",
+                                                COPY, local_env, timeouts.get(COPY), repo=repo_path)
+                    if returncode != 0:
+                        raise RuntimeError(f"Copying the backup venv {backup_venv_path} failed" + (" (timed out)" if returncode is None else ""))
+
+            # Activate the virtual environment
+            activate_script = os.path.join(source_venv_path, 'bin', 'activate')
+            command_activate = f'source {activate_script} &&'
+
+            # Install requirements, if any. All manifests of the repo are merged into one file for a single batched install
+            with span('requirements_install') as install_span:
+                out_req_file = os.path.join(json_paths, f'{local_env}_requirements.txt')
+                addCleanupObligation(out_req_file)
+                out_req_file, requirements = await asyncio.to_thread(writeMergedRequirementsFile, repo_path, out_req_file,
+                                                                     config.get('manifest_cache_path'))
+                install_span['requirements'] = len(requirements['requirements'])
+                if out_req_file and not replay:
+                    print(f"Installing {len(requirements['requirements'])} requirements from {requirements['manifests']}")
+                    start = time.time()
+                    pip_cache_lock = await asyncio.to_thread(acquirePipCacheLock)
+                    try:
+                        returncode = await runStage(f'{command_activate} pip install -r {out_req_file}', INSTALL, local_env,
+                                                    timeouts.get(INSTALL), repo=repo_path)
+                    finally:
+                        if pip_cache_lock is not None:
+                            pip_cache_lock.close()
+                    emitEvent('pip_install', requirements_file=out_req_file, duration=time.time() - start, returncode=returncode)
+
+            data = {
+                'repo_path': repo_path,
+                'nb_paths': nb_paths,
+                'results_cache_path': results_cache_path,
+                'err_cache_path': err_cache_path,
+                'resume': resume,
+                'requirements': requirements['requirements'],
+                'dedup_cache_path': config.get('dedup_cache_path'),
+                'shard_id': local_env,
+                'trace_dir': config.get('trace_dir'),
+                'metrics_dir': config.get('metrics_dir'),
+                'llm_backend': config.get('llm_backend'),
+                'archive_path': config.get('archive_path'),
+                'archive_mode': config.get('archive_mode'),
+                'notebook_budget': config.get('notebook_budget'),
+                'kernel_limits': config.get('kernel_limits'),
+                'block_network': config.get('block_network'),
+                'lean_execution': config.get('lean_execution'),
+                'notebook_workers': config.get('notebook_workers'),
+                'scratch_dir': config.get('scratch_dir'),
+                'journal_path': config.get('journal_path'),
+                'disk_governor': config.get('disk_governor'),
+                'pip_policy': config.get('pip_policy'),
+                'batch_name_repair': config.get('batch_name_repair')
+            }
+
+            # Save the data to a json file
+            json_path = os.path.join(json_paths, f'{os.path.basename(source_venv_path)}.json')
+            addCleanupObligation(json_path)
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=4)
+
+            # Run the process_repo.py script
+            with span('process_repo'):
+                command = f'{command_activate} python process_repo.py --json_path {json_path}'
+                if replay:
+                    command = f'{sys.executable} process_repo.py --json_path {json_path}'
+                returncode = await runStage(command, EXECUTE, local_env, timeouts.get(EXECUTE), cwd=MAIN_CODE_DIR, repo=repo_path)
+                if returncode != 0:
+                    print(f"=== Error occurred while processing the repo {repo_name} === " +
+                          ("timed out" if returncode is None else f"exit code {returncode}"))
+                else:
+                    # All notebooks of the repo are evaluated against its current content and manifests
+                    recordRepoSnapshot(config.get('snapshot_path'), repo_path, config.get('snapshot'))
 
-    # Deactivate the virtual environment
-    command_deactivate = 'deactivate'
+    finally:
+        # Delete the output requirements file
+        if out_req_file and os.path.exists(out_req_file):
+            os.remove(out_req_file)
 
-    # Execute the full command
-    try:    
-        command = f'{command_activate} {command_install_requirements} {command_run_process_repo} {command_deactivate}'
-        subprocess.run(command, shell=True)
-    except Exception as e:
-        print(f"=== Error occurred while processing the repo {repo_name} === \n{e}")
+        if governor is not None and not replay:
+            await asyncio.to_thread(governor.releaseEnvCopy, source_venv_path)
 
-    # Delete the output requirements file
-    if out_req_file:
-        os.remove(out_req_file)
+        # Log the estimated and actual cost of the repo, to check and calibrate the cost model
+        duration = time.time() - repo_start
+        estimated_cost = config.get('estimated_cost')
+        emitEvent('repo_done', env=local_env, repo=repo_path, duration=duration, estimated_cost=estimated_cost)
+        recordRepoCost(config.get('cost_history_path'), repo_path, len(nb_paths), estimated_cost, duration, config.get('cost_calibration', 1.0))
+        if estimated_cost is not None:
+            print(f'Repo {repo_name}: estimated {estimated_cost:.0f}s, took {duration:.0f}s')
 
     print(
         f"        ############################# [{i + 1}/{config['total_repos']}] END ANALYSIS FOR REPO `{repo_name}` #############################")
 
 
-def getAllReposWithNBLists(all_repo_dir_path, results_cache_path, err_cache_path):
+def getAllReposWithNBLists(all_repo_dir_path, results_cache_path, err_cache_path, journal_path=None, snapshot_path=None):
     if not os.path.exists(results_cache_path):
         raise FileNotFoundError(f"Results cache path '{results_cache_path}' does not exist.")
     if not os.path.exists(err_cache_path):
         raise FileNotFoundError(f"Error cache path '{err_cache_path}' does not exist.")
-    results_cache = Index(results_cache_path)
-    err_cache = Index(err_cache_path)
+    results_cache = ShardedResultsStore(results_cache_path)
+    err_cache = ShardedResultsStore(err_cache_path)
     all_repos_unfiltered = readAllCSVToDict(all_repo_dir_path)  # dict
-    all_repos = filterEvaluatedNB(all_repos_unfiltered, results_cache, err_cache)
+    journaled_nbs = None
+    if journal_path:
+        # Roll back what crashed workers left behind, and skip the notebooks the journal knows are done
+        enableJournal(journal_path)
+        with span('recover_journal'):
+            journal = recoverJournal()
+        journaled_nbs = journal[NOTEBOOK] | {key for scope, key in journal['leased'] if scope == NOTEBOOK}
+    refresh = None
+    if snapshot_path:
+        # Only read the notebooks that changed since the repos were last processed
+        with span('plan_refresh'):
+            refresh = planRefresh(all_repos_unfiltered, snapshot_path)
+    with span('filter_evaluated'):
+        all_repos = filterEvaluatedNB(all_repos_unfiltered, results_cache, err_cache, journaled_nbs, refresh)
     all_nbs = combineAllNBPaths(all_repos)
-    return all_repos, all_nbs
-
-
-def processNBFolderSequential(all_repo_dir_path, json_paths, results_cache_path, err_cache_path, resume):
-    all_repos, all_nbs = getAllReposWithNBLists(all_repo_dir_path, results_cache_path, err_cache_path)
+    if refresh:
+        for repo_path in all_repos_unfiltered:
+            if repo_path not in all_repos:
+                # Nothing to evaluate: the repo is up to date as it is
+                recordRepoSnapshot(snapshot_path, repo_path, refresh['snapshots'].get(repo_path))
+    return all_repos, all_nbs, refresh
+
+
+def estimateRepoCosts(all_repos, results_cache_path, cost_history_path=None):
+    # Expected seconds per repo, from the static features of its notebooks and the notebooks already evaluated
+    with span('estimate_repo_costs'):
+        model = RepoCostModel(loadObservedNotebookTimes(ShardedResultsStore(results_cache_path)), cost_history_path)
+        costs = {repo_path: model.estimate(repo_path, nb_paths) for repo_path, nb_paths in all_repos.items()}
+    print(f"Estimated cost of the {len(costs)} repos: {sum(costs.values()) / 3600:.1f} env-hours (calibration x{model.calibration:.2f})")
+    return costs, model.calibration
+
+
+def diskGovernorConfig(disk_low_watermark_mb, disk_resume_watermark_mb, all_repos, envs, json_paths, results_cache_path, err_cache_path,
+                       scratch_dir, backup_envs_path, source_envs_path, disk_max_pause=None):
+    # Watch the volumes of the envs, the repos and the caches; the workers watch the same volumes
+    if not disk_low_watermark_mb:
+        return None
+    paths = [source_envs_path, backup_envs_path, json_paths, results_cache_path, err_cache_path, scratch_dir] + list(all_repos)
+    governor = DiskGovernor(paths, disk_low_watermark_mb, disk_resume_watermark_mb, source_envs_path=source_envs_path,
+                            active_envs=envs, scratch_dir=scratch_dir, max_pause=disk_max_pause)
+    governor.paths = governor.volumes()
+    print(f"Disk governor on {governor.paths}: evict and pause below {governor.low_watermark_mb} MB, resume above {governor.resume_watermark_mb} MB")
+    return governor.asDict()
+
+
+def compactResultStores(results_cache_path, err_cache_path):
+    # All workers are done: merge their shards into the root stores
+    ShardedResultsStore(results_cache_path).compact()
+    ShardedResultsStore(err_cache_path).compact()
+
+
+def startMetrics(metrics_dir, metrics_port, all_repos, all_nbs, envs):
+    # Aggregate the events of all workers into live metrics, rewritten to <metrics_dir>/metrics.prom
+    if not metrics_dir:
+        return None
+    enableMetrics(metrics_dir, 'orchestrator')
+    print(f"Live metrics in {os.path.join(metrics_dir, 'metrics.prom')}" + (f" and on http://127.0.0.1:{metrics_port}/metrics" if metrics_port else ''))
+    return MetricsAggregator(metrics_dir, len(all_repos), len(all_nbs), envs, port=metrics_port).start()
+
+
+def processNBFolder(all_repo_dir_path, json_paths, results_cache_path, err_cache_path, resume, manifest_cache_path=None, dedup_cache_path=None, trace_dir=None,
+                    metrics_dir=None, metrics_port=None, llm_backend=None, archive_path=None, archive_mode=None,
+                    notebook_budget=DEFAULT_NOTEBOOK_BUDGET, kernel_limits=None, block_network=False, lean_execution=False,
+                    notebook_workers=1, scratch_dir=None, cost_history_path=None, journal_path=None,
+                    disk_low_watermark_mb=0, disk_resume_watermark_mb=None, disk_max_pause=DEFAULT_MAX_PAUSE_SECONDS, n_envs=0, max_envs=32, env_memory_mb=None,
+                    stage_timeouts=None, snapshot_path=None, pip_policy=None, batch_name_repair=False,
+                    backup_envs_path="path_to_your_backup_envs", source_envs_path="path_to_your_source_envs"):
+    """
+    Process all the repos on the envs nb1_venv, nb2_venv, ..., supervised by the asyncio supervisor of this process
+    :param n_envs: number of envs processing repos at the same time; 0 to size the pool from the cores, memory
+                   and disk, and to resize it during the run
+    :param max_envs: largest pool when it is sized automatically; missing backup venvs are provisioned on demand
+    :param env_memory_mb: memory of one env until it is measured (default: from the kernel memory limit)
+    :param disk_max_pause: seconds a paused repo or notebook waits for disk space before it fails; None for no limit
+    :param stage_timeouts: dict of the seconds allowed to the copy, install and execute stages of a repo
+    :param snapshot_path: path to the repo snapshots [DiskCache] of the incremental refresh, None to disable it
+    :param pip_policy: dict of the pip installs of missing modules (cache_path, failure_ttl, timeout, only_binary)
+    :param batch_name_repair: define all the variables a notebook never defines with its first NameError, in one LLM call
+    """
+    replay = archive_mode == 'replay'
+    if not replay and not os.path.isdir(backup_envs_path):
+        raise FileNotFoundError(f"Backup envs path '{backup_envs_path}' does not exist; set backup_envs_path on the command line or in the --config file")
+    enableTracing(trace_dir)
+    all_repos, all_nbs, refresh = getAllReposWithNBLists(all_repo_dir_path, results_cache_path, err_cache_path, journal_path, snapshot_path)
 
     print(f"TOTAL {len(all_repos)} REPOS & {len(all_nbs)} NOTEBOOKS NOT EVALUATED YET")
-
-    backup_envs_path = "path_to_your_backup_envs" # Change this to the path where you backup the virtual environments
-    source_envs_path = "path_to_your_source_envs" # Change this to the path where you create virtual environments
-
-    for i, repo in enumerate(all_repos.items()):
-        repo_path, nb_paths = repo
-        config = {
+    sizer = None
+    if n_envs > 0:
+        envs = [envName(i) for i in range(1, n_envs + 1)]
+        all_envs = envs
+    else:
+        # Size the pool from the machine, and let the supervisor resize it as the envs are observed
+        env_memory_mb = env_memory_mb or ((kernel_limits or {}).get('memory_mb') or DEFAULT_ENV_MEMORY_MB) * max(notebook_workers, 1)
+        sizer = WorkerPoolSizer(backup_envs_path, source_envs_path, max_envs, env_memory_mb, provision=not replay)
+        envs = sizer.provision(sizer.allEnvs()[:sizer.initialSize()])
+        if not envs:
+            raise FileNotFoundError(f"No backup venv (nb1_venv, ...) in '{backup_envs_path}'; create them with create_envs.py")
+        all_envs = sizer.allEnvs()
+    print(f'envs: {envs}')
+    metrics = startMetrics(metrics_dir, metrics_port, all_repos, all_nbs, all_envs)
+    disk_governor = diskGovernorConfig(disk_low_watermark_mb, disk_resume_watermark_mb, all_repos, all_envs, json_paths,
+                                       results_cache_path, err_cache_path, scratch_dir, backup_envs_path, source_envs_path,
+                                       disk_max_pause)
+    if disk_governor:
+        setDiskGovernor({**disk_governor, 'orphan_dirs': list(all_repos)})
+
+    costs, calibration = estimateRepoCosts(all_repos, results_cache_path, cost_history_path)
+    if n_envs == 1:
+        # With a single env the total time does not depend on the order: run the shortest repos first
+        order = sorted(costs, key=costs.get)
+    else:
+        # Heaviest first: each env takes the next repo when it is free, so no env is left with a giant repo at the end
+        order = sorted(costs, key=costs.get, reverse=True)
+        _, env_loads = packRepos(costs, len(envs))
+        print(f"Estimated makespan: {max(env_loads) / 3600:.1f} hours on {len(envs)} envs")
+    tasks = [
+        {
             'index': i,
+            'total_repos': len(all_repos),
             'repo_path': repo_path,
-            'nb_paths': nb_paths,
+            'nb_paths': all_repos[repo_path],
+            'estimated_cost': costs[repo_path],
+            'cost_calibration': calibration,
+            'cost_history_path': cost_history_path,
             'results_cache_path': results_cache_path,
             'err_cache_path': err_cache_path,
-            'resume': resume,
+            # Cached results of a repo whose manifests changed must not be reused
+            'resume': 0 if refresh and repo_path in refresh['stale_repos'] else resume,
             'backup_envs_path': backup_envs_path,
             'source_envs_path': source_envs_path,
-            'total_repos': len(all_repos),
-            'json_paths': json_paths
-        }
-        try:
-            shellProcessNB('nb1_venv', config)
-        except Exception as e:
-            print(f"Error in processing the repository {repo_path}, Error: {e}")
-            print('>>> EXITING THE PROCESSING OF THE REPOSITORY DUE TO ERROR <<<')
-            continue
-
-def executeTask(env, task_li):
-    for config in task_li:
-        shellProcessNB(env, config)
-
-def split_dict(input_dict, chunk_size):
-    # Convert dictionary items to a list of tuples
-    items = list(input_dict.items())
-    
-    # Create a list of smaller dictionaries with specified chunk size
-    return [dict(items[i:i + chunk_size]) for i in range(0, len(items), chunk_size)]
-
-def processNBFolderParallel(all_repo_dir_path, json_paths, results_cache_path, err_cache_path, resume):
-    all_repos, all_nbs = getAllReposWithNBLists(all_repo_dir_path, results_cache_path, err_cache_path)
-
-    print(f"TOTAL {len(all_repos)} REPOS & {len(all_nbs)} NOTEBOOKS NOT EVALUATED YET")
-    envs = [f'nb{i}_venv' for i in range(1, 33)]
-    print(f'envs: {envs}')
-
-    backup_envs_path = "path_to_your_backup_envs" # Change this to the path where you backup the virtual environments
-    source_envs_path = "path_to_your_source_envs" # Change this to the path where you create virtual environments
-
-    list_of_all_repos = split_dict(all_repos, chunk_size=len(envs) * 3)
-    for repo_list in list_of_all_repos:
-        all_repos_with_assign_ids = [
-            {
-                'index': i,
-                'total_repos': len(repo_list),
-                'repo_path': repo_path,
-                'nb_paths': nb_paths,
-                'results_cache_path': results_cache_path,
-                'err_cache_path': err_cache_path,
-                'resume': resume,
-                'backup_envs_path': backup_envs_path,
-                'source_envs_path': source_envs_path,
-                'json_paths': json_paths
-            } for i, (repo_path, nb_paths) in enumerate(repo_list.items())
-        ]
-        li_of_li_tasks = divide_list_into_parts(all_repos_with_assign_ids, len(envs))
-        assert len(li_of_li_tasks) == len(envs)
-        results = Parallel(backend='multiprocessing', n_jobs=len(envs))(delayed(executeTask)(env, task_l) for env, task_l in zip(envs, li_of_li_tasks))
+            'json_paths': json_paths,
+            'manifest_cache_path': manifest_cache_path,
+            'dedup_cache_path': dedup_cache_path,
+            'trace_dir': trace_dir,
+            'metrics_dir': metrics_dir,
+            'llm_backend': llm_backend,
+            'archive_path': archive_path,
+            'archive_mode': archive_mode,
+            'notebook_budget': notebook_budget,
+            'kernel_limits': kernel_limits,
+            'block_network': block_network,
+            'lean_execution': lean_execution,
+            'notebook_workers': notebook_workers,
+            'scratch_dir': scratch_dir,
+            'journal_path': journal_path,
+            'disk_governor': disk_governor,
+            'stage_timeouts': stage_timeouts,
+            'snapshot_path': snapshot_path,
+            'pip_policy': pip_policy,
+            'batch_name_repair': batch_name_repair,
+            'snapshot': refresh['snapshots'].get(repo_path) if refresh else None
+        } for i, repo_path in enumerate(order)
+    ]
+    completed = runSupervisor(envs, tasks, processRepoOnEnv, sizer)
+
+    compactResultStores(results_cache_path, err_cache_path)
+    if metrics is not None:
+        metrics.stop()
+    if not completed:
+        print('>>> RUN CANCELLED, resume it with --resume 1 <<<')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Read all .ipynb files in a directory.')
-    parser.add_argument('--all_repo_dir_path', type=str, required=True, help='Path to the text file containing the notebooks')
-    parser.add_argument('--json_paths', type=str, required=True, help='Path to the json files storing repo information for process_repo.py')
-    parser.add_argument('--results_cache_path', type=str, required=True, help='Path to the results cache [DiskCache]')
-    parser.add_argument('--err_cache_path', type=str, required=True, help='Path to the error cache [DiskCache]')
+    parser.add_argument('--all_repo_dir_path', type=str, help='Path to the text file containing the notebooks')
+    parser.add_argument('--json_paths', type=str, help='Path to the json files storing repo information for process_repo.py')
+    parser.add_argument('--results_cache_path', type=str, help='Path to the results cache [DiskCache]')
+    parser.add_argument('--err_cache_path', type=str, help='Path to the error cache [DiskCache]')
     parser.add_argument('--resume', type=int,  help='Check the cache before processing the notebook if 1, else process all the notebooks', default=0)
-    args = parser.parse_args()
-   
-    # Use this line if you want to run the process in parallel
-    processNBFolderParallel(all_repo_dir_path=args.all_repo_dir_path, 
-                            json_paths=args.json_paths, 
-                            results_cache_path=args.results_cache_path, 
-                            err_cache_path=args.err_cache_path, 
-                            resume=args.resume)
-
-    # Uncomment the following line if you want to run the process in sequence   
-    # processNBFolderSequential(all_repo_dir_path=args.all_repo_dir_path,
-    #                          json_paths=args.json_paths,
-    #                          results_cache_path=args.results_cache_path,
-    #                          err_cache_path=args.err_cache_path,
-    #                          resume=args.resume)
+    parser.add_argument('--dedup_cache_path', type=str, default=None, help='Path to the notebook deduplication cache [DiskCache], shared by all workers')
+    parser.add_argument('--trace_dir', type=str, default=None, help='Directory of the per-worker trace files; merge them with merge_traces.py')
+    parser.add_argument('--metrics_dir', type=str, default=None, help='Directory of the worker events and of the live metrics.prom file')
+    parser.add_argument('--metrics_port', type=int, default=None, help='Also serve the live metrics at http://127.0.0.1:<port>/metrics')
+    parser.add_argument('--backup_envs_path', type=str, default="path_to_your_backup_envs", help='Path where you backup the virtual environments')
+    parser.add_argument('--source_envs_path', type=str, default="path_to_your_source_envs", help='Path where you create virtual environments')
+    parser.add_argument('--llm_backend', type=str, default=None, help='Replace Ollama by a chat function, `module:function` or `path/to/file.py:function`')
+    parser.add_argument('--archive_path', type=str, default=None, help='Path to the archive [DiskCache] of LLM calls, pip installs and executions')
+    parser.add_argument('--archive_mode', type=str, choices=['record', 'replay'], default=None, help='record the interactions into --archive_path, or replay them from it')
+    parser.add_argument('--notebook_budget', type=int, default=DEFAULT_NOTEBOOK_BUDGET, help='Wall-clock seconds allowed to all executions of a notebook, including the fix iterations (0 for no budget)')
+    parser.add_argument('--kernel_memory_mb', type=int, default=None, help='Memory limit (RSS) of each notebook kernel and its child processes in MB')
+    parser.add_argument('--kernel_cpu_seconds', type=int, default=None, help='CPU time limit of each notebook kernel in seconds')
+    parser.add_argument('--kernel_max_procs', type=int, default=None, help='Number of processes each notebook kernel may spawn')
+    parser.add_argument('--kernel_max_file_mb', type=int, default=None, help='Size limit in MB of each file written by a notebook kernel')
+    parser.add_argument('--kernel_cgroup_root', type=str, default=None, help='cgroup v2 directory delegated to this user, used for the memory and process limits')
+    parser.add_argument('--block_network', type=int, default=0, help='1 to make network access from the notebooks fail at once with the status NetworkAccessBlocked')
+    parser.add_argument('--lean_execution', type=int, default=0, help='1 to discard the outputs of the notebooks during execution, keeping only errors and a stdout tail')
+    parser.add_argument('--notebook_workers', type=int, default=1, help='Number of notebooks of a repo executed in parallel on its env')
+    parser.add_argument('--scratch_dir', type=str, default=None, help='Directory of the per-notebook scratch copies of the repos (default: the temp directory when notebook_workers > 1)')
+    parser.add_argument('--cost_history_path', type=str, default=None, help='Path to the estimated and actual cost of processed repos [DiskCache], used to calibrate the scheduling')
+    parser.add_argument('--journal_path', type=str, default=None, help='Path to the work journal [JSONL]; on restart, the leftovers of crashed work are rolled back and only unfinished notebooks are run')
+    parser.add_argument('--disk_low_watermark_mb', type=int, default=0, help='Free MB on the env, repo and cache volumes below which caches are evicted and dispatch pauses (0 to disable)')
+    parser.add_argument('--disk_resume_watermark_mb', type=int, default=None, help='Free MB every volume needs before a paused dispatch resumes (default: twice the low watermark)')
+    parser.add_argument('--disk_max_pause', type=int, default=DEFAULT_MAX_PAUSE_SECONDS, help='Seconds a paused dispatch waits for disk space before failing the repo or notebook with NoSpaceLeftOnDevice (0 for no limit)')
+    parser.add_argument('--n_envs', type=int, default=0, help='Number of envs processing repos at the same time (1 to process them one at a time, shortest first); 0 to size the pool from the cores, memory and disk during the run')
+    parser.add_argument('--max_envs', type=int, default=32, help='Largest number of envs when the pool is sized automatically; missing backup venvs are cloned on demand')
+    parser.add_argument('--env_memory_mb', type=int, default=None, help='Memory of one env in MB until it is measured (default: the kernel memory limit, or 2048)')
+    parser.add_argument('--copy_timeout', type=int, default=DEFAULT_STAGE_TIMEOUTS[COPY], help='Seconds allowed to copy the venv of a repo (0 for no limit)')
+    parser.add_argument('--install_timeout', type=int, default=DEFAULT_STAGE_TIMEOUTS[INSTALL], help='Seconds allowed to install the requirements of a repo (0 for no limit)')
+    parser.add_argument('--execute_timeout', type=int, default=0, help='Seconds allowed to process all the notebooks of a repo (0 for no limit)')
+    parser.add_argument('--snapshot_path', type=str, default=None, help='Path to the git HEAD, manifest hash and notebook hashes of each processed repo [DiskCache]; re-pulled repos are refreshed incrementally')
+    parser.add_argument('--pip_cache_path', type=str, default=None, help='Path to the outcomes of the pip installs of missing modules [DiskCache], shared by all workers')
+    parser.add_argument('--pip_failure_ttl_hours', type=float, default=168, help='Hours a failed install of a missing module is not tried again')
+    parser.add_argument('--pip_timeout', type=int, default=600, help='Seconds allowed to the pip install of a missing module (0 for no limit)')
+    parser.add_argument('--pip_only_binary', type=int, default=0, help='1 to install missing modules from wheels only, never building source distributions')
+    parser.add_argument('--batch_name_repair', type=int, default=0, help='1 to define all the variables a notebook never defines in one LLM call and one execution, instead of one per NameError')
+    parser.add_argument('--manifest_cache_path', type=str, default=None, help='Path to the merged requirements cache [DiskCache], keyed on manifest content')
+    args = parseArgsWithConfig(parser, required=['all_repo_dir_path', 'json_paths', 'results_cache_path', 'err_cache_path'])
+    kernel_limits = {
+        'memory_mb': args.kernel_memory_mb,
+        'cpu_seconds': args.kernel_cpu_seconds,
+        'max_procs': args.kernel_max_procs,
+        'max_file_mb': args.kernel_max_file_mb,
+        'cgroup_root': args.kernel_cgroup_root
+    }
+    pip_policy = {
+        'cache_path': args.pip_cache_path,
+        'failure_ttl': args.pip_failure_ttl_hours * 3600,
+        'timeout': args.pip_timeout or None,
+        'only_binary': args.pip_only_binary > 0
+    }
+    stage_timeouts = {
+        COPY: args.copy_timeout or None,
+        INSTALL: args.install_timeout or None,
+        EXECUTE: args.execute_timeout or None
+    }
+
+    processNBFolder(all_repo_dir_path=args.all_repo_dir_path,
+                    json_paths=args.json_paths,
+                    results_cache_path=args.results_cache_path,
+                    err_cache_path=args.err_cache_path,
+                    resume=args.resume,
+                    manifest_cache_path=args.manifest_cache_path,
+                    dedup_cache_path=args.dedup_cache_path,
+                    trace_dir=args.trace_dir,
+                    metrics_dir=args.metrics_dir,
+                    metrics_port=args.metrics_port,
+                    llm_backend=args.llm_backend,
+                    archive_path=args.archive_path,
+                    archive_mode=args.archive_mode,
+                    notebook_budget=args.notebook_budget,
+                    kernel_limits=kernel_limits,
+                    block_network=args.block_network > 0,
+                    lean_execution=args.lean_execution > 0,
+                    notebook_workers=args.notebook_workers,
+                    scratch_dir=args.scratch_dir,
+                    cost_history_path=args.cost_history_path,
+                    journal_path=args.journal_path,
+                    disk_low_watermark_mb=args.disk_low_watermark_mb,
+                    disk_resume_watermark_mb=args.disk_resume_watermark_mb,
+                    disk_max_pause=args.disk_max_pause or None,
+                    n_envs=args.n_envs,
+                    max_envs=args.max_envs,
+                    env_memory_mb=args.env_memory_mb,
+                    stage_timeouts=stage_timeouts,
+                    snapshot_path=args.snapshot_path,
+                    pip_policy=pip_policy,
+                    batch_name_repair=args.batch_name_repair > 0,
+                    backup_envs_path=args.backup_envs_path,
+                    source_envs_path=args.source_envs_path)
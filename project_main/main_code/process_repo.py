@@ -2,8 +2,11 @@ import sys
 import argparse
 import json
 import os
+import time
+import tempfile
+import multiprocessing
 import collections.abc
-from diskcache import Index
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 if sys.version_info >= (3, 12):
     # Add compatibility layer for Python 3.12+
@@ -15,6 +18,134 @@ if sys.version_info >= (3, 12):
     
 sys.path.append('../RenoteUtils/')
 from process_nb import processNB
+from nb_dedup import computeCodeHash
+from results_store import ShardedResultsStore, notebookIdentity
+from trace_utils import enableTracing, traceContext, span
+from metrics import enableMetrics, emitEvent
+from localLLM import setChatBackend
+from interaction_archive import enableArchive
+from kernel_limits import kernelLimitsFromConfig
+from work_journal import enableJournal, isJournalEnabled, journaledWork, NOTEBOOK
+from disk_governor import setDiskGovernor, getDiskGovernor, DiskSpaceExhausted, DISK_FULL
+from pip_policy import PipPolicy
+from run_config import RunConfig
+
+# Shard of the results and error stores this notebook worker process writes to
+_worker_shard_id = None
+
+
+def configureProcess(data):
+    """Set up tracing, metrics, the LLM backend, the archive, the journal and the disk governor of this process"""
+    shard_id = data.get("shard_id")
+    enableTracing(data.get("trace_dir"), shard_id)
+    enableMetrics(data.get("metrics_dir"), shard_id)
+    if data.get("llm_backend"):
+        setChatBackend(data["llm_backend"])
+    enableArchive(data.get("archive_path"), data.get("archive_mode"))
+    enableJournal(data.get("journal_path"))
+    if data.get("disk_governor"):
+        setDiskGovernor({**data["disk_governor"], "orphan_dirs": [data["repo_path"]]})
+
+
+def runConfigFromData(data):
+    """The RunConfig of the notebooks of the repo: kernel sandbox, lean execution, pip policy and NameError repair mode"""
+    return RunConfig(kernel_limits=kernelLimitsFromConfig(data.get("kernel_limits")),
+                     block_network=data.get("block_network"),
+                     lean_execution=data.get("lean_execution"),
+                     pip_policy=PipPolicy(**(data.get("pip_policy") or {})),
+                     batch_name_repair=data.get("batch_name_repair"))
+
+
+def processRepoNotebook(data, i, nb_path, results_store, err_store, scratch_root=None, run_config=None):
+    repo_path = data["repo_path"]
+    nb_paths = data["nb_paths"]
+    nb_name = os.path.basename(nb_path)
+    print(
+        f"                 ------------ [{i + 1}/{len(nb_paths)}] START of Renote Analysis for {nb_name} ------------")
+    start = time.time()
+    nb_key = notebookIdentity(repo_path, nb_path, computeCodeHash(nb_path))
+    governor = getDiskGovernor()
+    try:
+        with journaledWork(NOTEBOOK, nb_key):
+            resume = data["resume"]
+            for attempt in range(2):
+                if governor is not None:
+                    # Raises DiskSpaceExhausted out of the journaled work, so the notebook is not journaled as done
+                    governor.waitForSpace(env=data.get("shard_id"))
+                try:
+                    with traceContext(repo=repo_path, nb=nb_path), span('notebook'):
+                        res = processNB(nb_path=nb_path, results_cache_path=data["results_cache_path"], err_cache_path=data["err_cache_path"],
+                                  resume=resume, repo_path=repo_path, requirements=data.get("requirements", []),
+                                  dedup_cache_path=data.get("dedup_cache_path"), results_store=results_store, err_store=err_store,
+                                  notebook_budget=data.get("notebook_budget"), scratch_root=scratch_root,
+                                  run_config=run_config)
+                    status = res['Final_Status'] if res else 'cached'
+                except Exception as e:
+                    err_store[nb_key] = {"nb_path": nb_path, "repo_path": repo_path, "status": str(e)}
+                    status = type(e).__name__
+                if status != DISK_FULL or governor is None or attempt > 0:
+                    break
+                # The disk filled up while the notebook ran: free space and run it once more, replacing its result
+                print(f">> {nb_name} ran out of disk space, retrying once space is available")
+                resume = 0
+            if isJournalEnabled():
+                # The results must be durable before the notebook is journaled as done
+                results_store.flush()
+                err_store.flush()
+    except DiskSpaceExhausted as e:
+        # A temporary shortage: no result is stored, so the next run evaluates the notebook
+        print(f">> {nb_name} skipped: {e}")
+        status = DISK_FULL
+    emitEvent('notebook_done', repo=repo_path, nb=nb_path, status=status, duration=time.time() - start)
+    return status
+
+
+def initNotebookWorker(data, worker_counter):
+    """
+    Initializer of a notebook worker process: configure it and take the next free worker slot, so each process
+    writes to its own shards whichever notebooks it is given
+    :param worker_counter: multiprocessing.Value shared by the workers of the pool
+    """
+    global _worker_shard_id
+    configureProcess(data)
+    with worker_counter.get_lock():
+        slot = worker_counter.value
+        worker_counter.value += 1
+    _worker_shard_id = f"{data['shard_id']}-nb{slot}" if data.get("shard_id") is not None else None
+
+
+def processRepoNotebookInWorker(data, i, nb_path, scratch_root):
+    """Process one notebook in a notebook worker process, writing to the worker's own shards"""
+    shard_id = _worker_shard_id
+    results_store = ShardedResultsStore(data["results_cache_path"], shard_id=shard_id)
+    err_store = ShardedResultsStore(data["err_cache_path"], shard_id=shard_id)
+    try:
+        return processRepoNotebook(data, i, nb_path, results_store, err_store, scratch_root, runConfigFromData(data))
+    finally:
+        results_store.close()
+        err_store.close()
+
+
+def processNotebooksParallel(data, notebook_workers, scratch_root):
+    """
+    Process the notebooks of the repo in notebook_workers forked processes sharing the env.
+    Each notebook is executed in its own scratch copy of the repo, so they do not see each other's files.
+    """
+    nb_paths = data["nb_paths"]
+    context = multiprocessing.get_context('fork')
+    worker_counter = context.Value('i', 0)
+    with ProcessPoolExecutor(max_workers=min(notebook_workers, len(nb_paths)), mp_context=context,
+                             initializer=initNotebookWorker, initargs=(data, worker_counter)) as pool:
+        futures = {}
+        for i, nb_path in enumerate(nb_paths):
+            futures[pool.submit(processRepoNotebookInWorker, data, i, nb_path, scratch_root)] = nb_path
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                # The worker process died, e.g. killed by the OOM killer
+                print(f">> Notebook worker failed on {futures[future]}: {e}")
+                emitEvent('notebook_done', repo=data["repo_path"], nb=futures[future], status=type(e).__name__, duration=0)
 
 
 def main(json_path):
@@ -22,23 +153,27 @@ def main(json_path):
     with open(json_path, "r", encoding='utf-8') as json_file:
         data = json.load(json_file)
 
-    # Get the data
-    repo_path = data["repo_path"]
     nb_paths = data["nb_paths"]
-    results_cache_path = data["results_cache_path"]
-    err_cache_path = data["err_cache_path"]
-    resume = data["resume"]
+    notebook_workers = max(data.get("notebook_workers") or 1, 1)
+    # Notebooks running in parallel need their own copy of the repo
+    scratch_root = data.get("scratch_dir") or (tempfile.gettempdir() if notebook_workers > 1 else None)
+
+    configureProcess(data)
 
     # Process the notebooks
-    for i, nb_path in enumerate(nb_paths):
-        nb_name = os.path.basename(nb_path)
-        print(
-            f"                 ------------ [{i + 1}/{len(nb_paths)}] START of Renote Analysis for {nb_name} ------------")
+    if notebook_workers > 1 and len(nb_paths) > 1:
+        processNotebooksParallel(data, notebook_workers, scratch_root)
+    else:
+        # Each worker writes to its own shard of the results and error stores, in batches
+        results_store = ShardedResultsStore(data["results_cache_path"], shard_id=data.get("shard_id"))
+        err_store = ShardedResultsStore(data["err_cache_path"], shard_id=data.get("shard_id"))
+        run_config = runConfigFromData(data)
         try:
-            processNB(nb_path=nb_path, results_cache_path=results_cache_path, err_cache_path=err_cache_path, resume=resume)
-        except Exception as e:
-            err_cache = Index(err_cache_path)
-            err_cache[nb_path] = {"nb_path": nb_path, "status": str(e)}
+            for i, nb_path in enumerate(nb_paths):
+                processRepoNotebook(data, i, nb_path, results_store, err_store, scratch_root, run_config)
+        finally:
+            results_store.close()
+            err_store.close()
 
     # Remove the json file
     if os.path.exists(json_path):
@@ -1,7 +1,13 @@
 import os
 import re
+import ast
+import json
+import hashlib
+import tomllib
+import configparser
 import yaml
 import chardet
+from diskcache import Index
 
 # List of Conda-specific packages that won't work in a venv environment
 CONDA_SPECIFIC_PACKAGES = [
@@ -29,33 +35,45 @@ def convert_conda_to_venv_line(package_line):
             # print(f"Warning: Could not convert package line: {package_line}")
             return None
 
+def read_text_lines(file_path):
+    """Read a text file once, falling back to chardet only when it is not valid UTF-8."""
+    with open(file_path, "rb") as rawdata:
+        raw = rawdata.read()
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        encoding = chardet.detect(raw[:10000])["encoding"] or "utf-8"
+        text = raw.decode(encoding, errors="ignore")
+    return text.splitlines()
+
+def is_conda_env_lines(lines):
+    """Check if the lines come from a Conda environment file."""
+    for line in lines:
+        line = line.strip()
+        if line.startswith("# platform:") or ("=" in line and not "==" in line):
+            return True
+    return False
+
 def is_conda_env_file(file_path):
     """Check if the file is a Conda environment file."""
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as infile:
-        for line in infile:
-            line = line.strip()
-            if line.startswith("# platform:") or ("=" in line and not "==" in line):
-                return True
-    return False
+    return is_conda_env_lines(read_text_lines(file_path))
 
-def convert_conda_to_venv_file(conda_file):
-    """Convert a Conda requirements.txt file to a venv-compatible requirements.txt."""
+def convert_conda_to_venv_lines(lines):
+    """Convert the lines of a Conda requirements.txt file to venv-compatible lines."""
     venv_lines = []
-    with open(conda_file, "rb") as rawdata:
-        result = chardet.detect(rawdata.read(10000))
-        encoding = result["encoding"]
-
-    # Use detected encoding
-    with open(conda_file, "r", encoding=encoding) as infile:
-        for line in infile:
-            line = line.strip()
-            if not line or is_conda_specific_package(line):
-                continue
-            venv_line = convert_conda_to_venv_line(line)
-            if venv_line:
-                venv_lines.append(venv_line)
+    for line in lines:
+        line = line.strip()
+        if not line or is_conda_specific_package(line):
+            continue
+        venv_line = convert_conda_to_venv_line(line)
+        if venv_line:
+            venv_lines.append(venv_line)
     return venv_lines
 
+def convert_conda_to_venv_file(conda_file):
+    """Convert a Conda requirements.txt file to a venv-compatible requirements.txt."""
+    return convert_conda_to_venv_lines(read_text_lines(conda_file))
+
 def convert_yaml_to_txt(yaml_file):
     """Convert a YAML requirements file to a requirements.txt format."""
     with open(yaml_file, 'r') as infile:
@@ -108,6 +126,14 @@ def extract_packages_from_file(file_path):
 
     return list(packages)
 
+# Requirement files of other formats, used when a repository has no requirements.txt
+OTHER_REQUIREMENTS_FILES = ['requirements.yml', 'requirements.yaml'] + \
+    [f"requirements{ext}" for ext in ['.in', '.ci', '.tx', '.sh', '.md', '.py', '.go']]
+
+def is_requirements_file(filename):
+    """Whether findRequirementsFile may return a file of this name"""
+    return filename == 'requirements.txt' or filename in OTHER_REQUIREMENTS_FILES
+
 def findRequirementsFile(repo_path):
     """Find the requirements file in the given repository."""
 
@@ -117,16 +143,8 @@ def findRequirementsFile(repo_path):
             return os.path.join(dirpath, 'requirements.txt')
 
     # If requirements.txt is not found, look for other formats
-    other_files = ['requirements.yml', 'requirements.yaml']
-    other_extensions = ['.in', '.ci', '.tx', '.sh', '.md', '.py', '.go']
-
     for dirpath, _, filenames in os.walk(repo_path):
-        for filename in other_files:
-            if filename in filenames:
-                return os.path.join(dirpath, filename)
-
-        for ext in other_extensions:
-            filename = f"requirements{ext}"
+        for filename in OTHER_REQUIREMENTS_FILES:
             if filename in filenames:
                 return os.path.join(dirpath, filename)
 
@@ -140,9 +158,10 @@ def convertRequirementFile(requirements_file):
     output_file = os.path.join(os.path.dirname(requirements_file), 'requirements_venv.txt')
 
     if file_ext == '.txt':
-        if is_conda_env_file(requirements_file):
+        lines = read_text_lines(requirements_file)
+        if is_conda_env_lines(lines):
             # print("Converting Conda environment to venv format...")
-            packages = convert_conda_to_venv_file(requirements_file)
+            packages = convert_conda_to_venv_lines(lines)
         else:
             # print("File is already in txt format")
             packages = extract_packages_from_file(requirements_file)
@@ -161,3 +180,263 @@ def convertRequirementFile(requirements_file):
 
     # print(f"Converted requirements saved to: {output_file}")
     return os.path.abspath(output_file)
+
+############################################################################################################
+# Unified dependency manifest extraction
+############################################################################################################
+
+# Manifest file names, in decreasing priority when two manifests disagree on a package
+MANIFEST_PRIORITY = ['requirements.txt', 'Pipfile', 'pyproject.toml', 'setup.cfg', 'setup.py',
+                     'environment.yml', 'environment.yaml', 'requirements.yml', 'requirements.yaml', 'requirements.in']
+
+# Directories that never contain the repo's own manifests
+SKIP_DIRS = {'.git', '.hg', '.svn', 'node_modules', 'venv', '.venv', 'env', 'site-packages',
+             '.ipynb_checkpoints', '__pycache__', '.tox'}
+
+# Names that must never end up in the merged requirement set
+IGNORED_REQUIREMENTS = {'python', 'pip', 'setuptools', 'wheel'}
+
+REQUIREMENT_PATTERN = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._\-]*)\s*(\[[^\]]*\])?\s*(.*)$')
+
+MANIFEST_CACHE_VERSION = 2
+
+
+def normalize_package_name(name):
+    """Normalize a package name following PEP 503."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def parse_requirement(line):
+    """
+    Parse a single requirement line into (normalized_name, extras, specifier)
+    :return: the parsed tuple or None if the line is not a package requirement
+    """
+    line = line.split('#')[0].split(';')[0].strip()
+    if not line or line.startswith(('-', 'git+', 'http:', 'https:', 'file:', '.', '/')):
+        return None
+    match = REQUIREMENT_PATTERN.match(line)
+    if not match:
+        return None
+    name, extras, spec = match.groups()
+    if is_conda_specific_package(name) or normalize_package_name(name) in IGNORED_REQUIREMENTS:
+        return None
+    spec = spec.replace(' ', '').strip('()')
+    # Conda pins `pkg=1.0` or `pkg=1.0=build` become `pkg==1.0`
+    conda_pin = re.match(r'^=([0-9][^=]*)(=.*)?$', spec)
+    if conda_pin:
+        spec = f'=={conda_pin.group(1)}'
+    if spec and not re.match(r'^(==|>=|<=|~=|!=|>|<|===)', spec):
+        return None
+    return normalize_package_name(name), extras or '', spec
+
+def poetry_spec_to_pip(spec):
+    """Convert a Poetry/Pipfile version spec (`^1.2`, `~1.2`, `*`) to a pip specifier."""
+    if isinstance(spec, dict):
+        spec = spec.get('version', '*')
+    if not isinstance(spec, str):
+        return ''
+    spec = spec.replace(' ', '')
+    if spec in ('', '*'):
+        return ''
+    if spec.startswith('^') or (spec.startswith('~') and not spec.startswith('~=')):
+        return f'>={spec[1:]}'
+    if re.match(r'^[0-9]', spec):
+        return f'=={spec}'
+    return spec
+
+def parse_requirements_txt_manifest(file_path):
+    lines = read_text_lines(file_path)
+    if is_conda_env_lines(lines):
+        lines = convert_conda_to_venv_lines(lines)
+    return [line for line in lines if line.strip() and not line.strip().startswith('#')]
+
+def parse_pyproject_manifest(file_path):
+    with open(file_path, 'rb') as f:
+        data = tomllib.load(f)
+    requirements = list(data.get('project', {}).get('dependencies', []))
+    poetry_deps = data.get('tool', {}).get('poetry', {}).get('dependencies', {})
+    for name, spec in poetry_deps.items():
+        requirements.append(f'{name}{poetry_spec_to_pip(spec)}')
+    return requirements
+
+def parse_setup_cfg_manifest(file_path):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_string('\n'.join(read_text_lines(file_path)))
+    if not config.has_option('options', 'install_requires'):
+        return []
+    return [line.strip() for line in config.get('options', 'install_requires').splitlines() if line.strip()]
+
+def parse_setup_py_manifest(file_path):
+    """Read a literal `install_requires=[...]` from setup.py without executing it."""
+    tree = ast.parse('\n'.join(read_text_lines(file_path)))
+    for node in ast.walk(tree):
+        if isinstance(node, ast.keyword) and node.arg == 'install_requires':
+            try:
+                value = ast.literal_eval(node.value)
+            except Exception:
+                return []
+            return [v for v in value if isinstance(v, str)]
+    return []
+
+def parse_pipfile_manifest(file_path):
+    with open(file_path, 'rb') as f:
+        data = tomllib.load(f)
+    return [f'{name}{poetry_spec_to_pip(spec)}' for name, spec in data.get('packages', {}).items()]
+
+def parse_conda_yaml_manifest(file_path):
+    return convert_yaml_to_txt(file_path)
+
+MANIFEST_PARSERS = {
+    'requirements.txt': parse_requirements_txt_manifest,
+    'requirements.in': parse_requirements_txt_manifest,
+    'pyproject.toml': parse_pyproject_manifest,
+    'setup.cfg': parse_setup_cfg_manifest,
+    'setup.py': parse_setup_py_manifest,
+    'Pipfile': parse_pipfile_manifest,
+    'environment.yml': parse_conda_yaml_manifest,
+    'environment.yaml': parse_conda_yaml_manifest,
+    'requirements.yml': parse_conda_yaml_manifest,
+    'requirements.yaml': parse_conda_yaml_manifest,
+}
+
+def manifest_kind(filename):
+    """Return the manifest kind of a file name, or None if it is not a manifest."""
+    if filename in MANIFEST_PARSERS:
+        return filename
+    # requirements-dev.txt, requirements_gpu.txt, ...
+    if filename.startswith('requirements') and filename.endswith(('.txt', '.in')):
+        return 'requirements.txt'
+    return None
+
+def findAllManifestFiles(repo_path):
+    """Find every dependency manifest in the repository, sorted by priority and depth."""
+    manifests = []
+    for dirpath, dirnames, filenames in os.walk(repo_path):
+        dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        for filename in filenames:
+            kind = manifest_kind(filename)
+            if kind is not None:
+                manifests.append((kind, os.path.join(dirpath, filename)))
+
+    def sort_key(item):
+        kind, path = item
+        return (MANIFEST_PRIORITY.index(kind), os.path.relpath(path, repo_path).count(os.sep), path)
+
+    return sorted(manifests, key=sort_key)
+
+def computeManifestHash(repo_path, manifests=None):
+    """Hash the content of all manifests so that any edit invalidates the cached requirement set."""
+    if manifests is None:
+        manifests = findAllManifestFiles(repo_path)
+    h = hashlib.sha256(f'v{MANIFEST_CACHE_VERSION}'.encode())
+    if not manifests:
+        # The requirements then come from the fallback file, which must key the cache too
+        requirements_file = findRequirementsFile(repo_path)
+        manifests = [(None, requirements_file)] if requirements_file else []
+    for _, path in manifests:
+        h.update(os.path.relpath(path, repo_path).encode())
+        with open(path, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+def pin_version(spec):
+    match = re.match(r'^===?([^,]+)$', spec)
+    return match.group(1) if match else None
+
+def version_key(version):
+    return tuple(int(p) if p.isdigit() else -1 for p in re.split(r'[.\-+]', version))
+
+def resolve_requirement(candidates):
+    """
+    Pick one requirement out of the candidates proposed by different manifests
+    :param candidates: list of (priority, extras, spec, source) tuples
+    :return: the chosen (extras, spec) and a conflict note, if the manifests disagreed
+    """
+    extras = sorted({c[1] for c in candidates if c[1]}, key=len)
+    extras = extras[-1] if extras else ''
+    specs = {c[2] for c in candidates if c[2]}
+    if len(specs) <= 1:
+        return extras, (specs.pop() if specs else ''), None
+
+    pins = [(version_key(pin_version(c[2])), c) for c in candidates if pin_version(c[2])]
+    if pins:
+        # Prefer the highest pinned version, it is the most likely to have wheels for our Python
+        chosen = max(pins, key=lambda p: (p[0], -p[1][0]))[1]
+    else:
+        # Ranges only: keep the one of the most authoritative manifest
+        chosen = min((c for c in candidates if c[2]), key=lambda c: c[0])
+    return extras, chosen[2], {'specs': sorted(specs), 'chosen': chosen[2], 'source': chosen[3]}
+
+def mergeManifestRequirements(repo_path, manifests):
+    """Parse every manifest and merge them into one deduplicated, conflict-resolved requirement set."""
+    candidates = {}
+    sources = []
+    for priority, (kind, path) in enumerate(manifests):
+        try:
+            lines = MANIFEST_PARSERS[kind](path)
+        except Exception as e:
+            print(f"Cannot parse the manifest {path}: {e}")
+            continue
+        sources.append(os.path.relpath(path, repo_path))
+        for line in lines:
+            parsed = parse_requirement(str(line))
+            if parsed is None:
+                continue
+            name, extras, spec = parsed
+            candidates.setdefault(name, []).append((priority, extras, spec, sources[-1]))
+
+    requirements = []
+    conflicts = {}
+    for name in sorted(candidates):
+        extras, spec, conflict = resolve_requirement(candidates[name])
+        requirements.append(f'{name}{extras}{spec}')
+        if conflict is not None:
+            conflicts[name] = conflict
+
+    return {'requirements': requirements, 'manifests': sources, 'conflicts': conflicts}
+
+def extractRepoRequirements(repo_path, cache_path=None):
+    """
+    Extract the merged requirement set of a repository from all of its manifests.
+    Falls back to the heuristic single-file conversion when the repo has no structured manifest.
+    :param repo_path: path to the repository
+    :param cache_path: optional DiskCache path; results are keyed on the manifests' content hash
+    :return: dict with requirements, manifests, conflicts and manifest_hash
+    """
+    manifests = findAllManifestFiles(repo_path)
+    manifest_hash = computeManifestHash(repo_path, manifests)
+
+    cache = Index(cache_path) if cache_path else None
+    if cache is not None and manifest_hash in cache:
+        return cache[manifest_hash]
+
+    if manifests:
+        result = mergeManifestRequirements(repo_path, manifests)
+    else:
+        result = {'requirements': [], 'manifests': [], 'conflicts': {}}
+        requirements_file = findRequirementsFile(repo_path)
+        if requirements_file:
+            packages = extract_packages_from_file(requirements_file)
+            parsed = [parse_requirement(p) for p in packages if isinstance(p, str)]
+            result['requirements'] = sorted({f'{n}{e}{s}' for n, e, s in filter(None, parsed)})
+            result['manifests'] = [os.path.relpath(requirements_file, repo_path)]
+    result['manifest_hash'] = manifest_hash
+
+    if cache is not None:
+        cache[manifest_hash] = result
+    return result
+
+def writeMergedRequirementsFile(repo_path, output_file, cache_path=None):
+    """
+    Write the merged requirement set of a repository to a pip requirements file.
+    :return: (path to the file or None if the repo has no requirements, the extraction result)
+    """
+    result = extractRepoRequirements(repo_path, cache_path)
+    if result['conflicts']:
+        print(f"Resolved conflicting requirements in {repo_path}: {json.dumps(result['conflicts'])}")
+    if not result['requirements']:
+        return None, result
+
+    with open(output_file, 'w', encoding='utf-8') as outfile:
+        for package in result['requirements']:
+            outfile.write(f"{package}\n")
+    return os.path.abspath(output_file), result
@@ -0,0 +1,54 @@
+"""
+Concurrent opens of the sharded results store: workers open each other's shards while they are created.
+"""
+
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_ROOT, 'project_main', 'RenoteUtils'))
+
+from results_store import ShardedResultsStore, ResultsStore, ResultsSchemaError, SCHEMA_VERSION_KEY
+
+N_WORKERS = 6
+N_TRIALS = 30
+
+
+def _openShard(cache_path, shard_id, barrier, errors):
+    barrier.wait()
+    try:
+        store = ShardedResultsStore(cache_path, shard_id=shard_id)
+        store[f'key-{shard_id}'] = {'status': 'ok'}
+        store.close()
+    except ResultsSchemaError as e:
+        errors.put(str(e))
+
+
+def test_concurrent_shard_opens(tmp_path):
+    context = multiprocessing.get_context('fork')
+    for trial in range(N_TRIALS):
+        cache_path = str(tmp_path / f'results-{trial}')
+        ShardedResultsStore(cache_path)
+        barrier = context.Barrier(N_WORKERS)
+        errors = context.Queue()
+        processes = [context.Process(target=_openShard, args=(cache_path, f'env-nb{i}', barrier, errors))
+                     for i in range(N_WORKERS)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert errors.empty(), errors.get()
+        assert all(process.exitcode == 0 for process in processes)
+        store = ShardedResultsStore(cache_path)
+        assert sorted(key for key, _ in store.items()) == sorted(f'key-env-nb{i}' for i in range(N_WORKERS))
+
+
+def test_legacy_cache_is_rejected(tmp_path):
+    store = ResultsStore(str(tmp_path / 'legacy'))
+    del store.index[SCHEMA_VERSION_KEY]
+    store['old.ipynb'] = {'status': 'ok'}
+    with pytest.raises(ResultsSchemaError):
+        ResultsStore(str(tmp_path / 'legacy'))